@@ -25,6 +25,149 @@ logger.info("Environment variables loaded for app.py")
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'fallback-secret-key')
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Messages submitted through the API are queued in a local SQLite file and
+# sent by background threads through the gateway's JSON /send API
+INGEST_MAX_MESSAGES = int(os.getenv('INGEST_MAX_MESSAGES', 500000))  # Messages accepted per request
+INGEST_MAX_CONTENT = int(os.getenv('INGEST_MAX_CONTENT', 1600))  # Characters per message
+INGEST_API_KEY = os.getenv('INGEST_API_KEY')  # Required as X-API-Key on the batch endpoints when set
+DEFAULT_COUNTRY_CODE = os.getenv('DEFAULT_COUNTRY_CODE', '+52')  # Prepended to 10-digit numbers
+try:
+    import ingest_queue
+    from ingest_queue import IngestQueue, IngestWorker
+    from phone_numbers import normalize_number
+    ingest = IngestQueue(os.getenv('INGEST_DB', ingest_queue.DEFAULT_PATH),
+                         lease=float(os.getenv('INGEST_LEASE', 120)))
+except ImportError as e:
+    logger.warning(f"Message queue disabled: {str(e)}")
+    ingest = None
+
+# Idempotency keys are claimed in the ingest file next to the batches they
+# queued, so they survive restarts and are shared by the processes on a host.
+# Like the queue itself that file is local: serverless instances do not share
+# it, and a retry landing on another instance is not recognized there.
+try:
+    from idempotency import IdempotencyStore, IdempotencyConflict, digest
+    idempotency_store = IdempotencyStore(ingest.claim_key if ingest else None,
+                                         ingest.release_key if ingest else None,
+                                         ttl=float(os.getenv('IDEMPOTENCY_TTL', 86400)),
+                                         local_size=int(os.getenv('IDEMPOTENCY_LOCAL_SIZE', 10000)))
+except ImportError as e:
+    logger.warning(f"Idempotency keys disabled: {str(e)}")
+    idempotency_store = None
+
+# Gateway router for the queued messages, built on first use
+sms_router = None
+
+def send_queued(numbers, content):
+    """Send one group of queued messages, one (number, success, message id or error) per number"""
+    global sms_router
+    if sms_router is None:
+        from routing import Router, Route, CircuitBreaker, SendAPIBackend
+        backend = SendAPIBackend(os.getenv('SMS_API_URL', 'http://45.61.157.94:20003/send'),
+                                 os.getenv('SMPP_USERNAME', 'XQB250213A'),
+                                 os.getenv('SMPP_PASSWORD', 'ABD55DBB'),
+                                 os.getenv('SMS_SENDER_ID', 'SMSHub'))
+        sms_router = Router([Route('http', backend, {'': 0.0}, CircuitBreaker())])
+    return [result[:3] for result in sms_router.send_batch(numbers, content)]
+
+ingest_worker = None
+if ingest is not None and int(os.getenv('INGEST_WORKERS', 2)) > 0:
+    ingest_worker = IngestWorker(ingest, send_queued, workers=int(os.getenv('INGEST_WORKERS', 2)),
+                                 batch_size=int(os.getenv('INGEST_BATCH_SIZE', 500)))
+    ingest_worker.start()
+
+def json_response(data, status=200, headers=None):
+    return Response(json.dumps(data), mimetype='application/json', status=status, headers=headers)
+
+def complete_idempotent(idempotency, response):
+    """Store the response of a claimed request for its retries"""
+    if idempotency is None:
+        return
+    if ingest is not None:
+        ingest.complete_key(idempotency[0], response)
+    idempotency_store.complete(idempotency[0], idempotency[1], response)
+
+def release_idempotent(idempotency):
+    """Drop the claim of a request that queued nothing, so a retry with the key is processed"""
+    if idempotency is not None:
+        idempotency_store.release(idempotency[0])
+
+def queue_messages(messages):
+    """
+    Validate, normalize and queue submitted messages as one batch
+    :param messages: Iterable of (index, number, content) as submitted
+    :return: (response data, HTTP status)
+    """
+    country_code = request.args.get('country_code', DEFAULT_COUNTRY_CODE)
+    accepted, errors = [], []
+    rejected = 0
+    for index, number, content in messages:
+        if not isinstance(content, str) or not content.strip():
+            reason = 'missing content'
+        elif len(content) > INGEST_MAX_CONTENT:
+            reason = f'content longer than {INGEST_MAX_CONTENT} characters'
+        elif not isinstance(number, (str, int)) or isinstance(number, bool):
+            reason = 'missing number'
+        else:
+            number, reason = normalize_number(str(number), country_code)
+            if reason is None:
+                accepted.append((number, content))
+                continue
+        rejected += 1
+        if len(errors) < 100:
+            errors.append({'index': index, 'error': reason})
+
+    if not accepted:
+        return {'status': 'error', 'message': 'No valid messages', 'rejected': rejected, 'errors': errors}, 422
+
+    batch_id, queued = ingest.enqueue(accepted, rejected)
+    if ingest_worker is not None:
+        ingest_worker.notify()
+    logger.info(f"Queued batch {batch_id} with {queued} messages ({rejected} rejected)")
+    return {
+        'status': 'accepted',
+        'batch_id': batch_id,
+        'accepted': queued,
+        'rejected': rejected,
+        'errors': errors,
+        'status_url': f"/api/messages/batch/{batch_id}"
+    }, 202
+
+def parse_batch():
+    """
+    Read the messages of a batch request
+    :return: List of (index, number, content); raises ValueError for a malformed body
+    """
+    if request.mimetype in ('application/x-ndjson', 'application/jsonl'):
+        # One {"number": ..., "content": ...} object per line
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if line.strip():
+                try:
+                    items.append(json.loads(line))
+                except ValueError:
+                    items.append(None)
+        default_content = request.args.get('content')
+    else:
+        body = request.get_json(silent=True)
+        if isinstance(body, list):
+            items, default_content = body, None
+        elif isinstance(body, dict) and isinstance(body.get('messages'), list):
+            items, default_content = body['messages'], body.get('content')
+        elif isinstance(body, dict) and isinstance(body.get('numbers'), list):
+            # The same content to many numbers
+            items, default_content = [{'number': number} for number in body['numbers']], body.get('content')
+        else:
+            raise ValueError('Expected a JSON list of messages, an object with messages or numbers, or NDJSON')
+
+    if len(items) > INGEST_MAX_MESSAGES:
+        raise ValueError(f'A batch is limited to {INGEST_MAX_MESSAGES} messages')
+    return [(index, item.get('number'), item.get('content', default_content)) if isinstance(item, dict)
+            else (index, None, None)
+            for index, item in enumerate(items)]
+
 # Main index route (handles /api/ and potentially other paths based on vercel.json)
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>', methods=['GET'])
@@ -88,13 +231,46 @@ def send_sms_route():
                 status=400
             )
             
-        logger.info(f"SMS request received for numbers: {numbers}")
+        if ingest is None:
+            return json_response({'status': 'error', 'message': 'Message queue is not available'}, 503)
+            
+        # A retried request gets the original response instead of being processed again
+        idempotency = None
+        client_key = request.headers.get('Idempotency-Key')
+        if client_key and idempotency_store is not None:
+            fingerprint = digest(numbers, content)
+            try:
+                key, replay = idempotency_store.begin('send-sms', client_key, fingerprint)
+            except IdempotencyConflict as e:
+                return Response(
+                    json.dumps({'status': 'error', 'message': str(e)}),
+                    mimetype='application/json',
+                    status=e.status
+                )
+            if replay is not None:
+                return Response(
+                    json.dumps(replay),
+                    mimetype='application/json',
+                    status=200,
+                    headers={'Idempotent-Replayed': 'true'}
+                )
+            idempotency = (key, fingerprint)
+            
+        try:
+            if isinstance(numbers, str):
+                numbers = [number for number in numbers.replace('\n', ',').split(',') if number.strip()]
+            response_data, status = queue_messages((index, number, content) for index, number in enumerate(numbers))
+        except Exception:
+            release_idempotent(idempotency)
+            raise
+        if status != 202:
+            release_idempotent(idempotency)
+            return json_response(response_data, status)
+
+        response_data.update({'status': 'success', 'message': 'SMS request queued', 'numbers': numbers})
+        complete_idempotent(idempotency, response_data)
         return Response(
-            json.dumps({
-                'status': 'success',
-                'message': 'SMS request received and logged (app.py)',
-                'numbers': numbers
-            }),
+            json.dumps(response_data),
             mimetype='application/json',
             status=200
         )
@@ -106,6 +282,59 @@ def send_sms_route():
             status=500
         )
 
+# Bulk message API for machine clients
+@app.route('/messages/batch', methods=['POST'])
+@app.route('/api/messages/batch', methods=['POST'])
+def submit_batch_route():
+    """Queue a JSON or NDJSON batch of messages and return its batch id"""
+    if INGEST_API_KEY and request.headers.get('X-API-Key') != INGEST_API_KEY:
+        return json_response({'status': 'error', 'message': 'Invalid API key'}, 401)
+    if ingest is None:
+        return json_response({'status': 'error', 'message': 'Message queue is not available'}, 503)
+    try:
+        # A retried request gets the original batch id instead of queuing the batch again
+        idempotency = None
+        client_key = request.headers.get('Idempotency-Key')
+        if client_key and idempotency_store is not None:
+            fingerprint = digest(request.mimetype, request.query_string, request.get_data(as_text=True))
+            try:
+                key, replay = idempotency_store.begin('messages-batch', client_key, fingerprint)
+            except IdempotencyConflict as e:
+                return json_response({'status': 'error', 'message': str(e)}, e.status)
+            if replay is not None:
+                return json_response(replay, 202, headers={'Idempotent-Replayed': 'true'})
+            idempotency = (key, fingerprint)
+
+        try:
+            response_data, status = queue_messages(parse_batch())
+        except ValueError as e:
+            response_data, status = {'status': 'error', 'message': str(e)}, 400
+        except Exception:
+            # Nothing was queued, a retry with the same key may queue the batch
+            release_idempotent(idempotency)
+            raise
+        if status == 202:
+            complete_idempotent(idempotency, response_data)
+        else:
+            release_idempotent(idempotency)
+        return json_response(response_data, status)
+    except Exception as e:
+        logger.exception(f"Error queuing batch: {str(e)}")
+        return json_response({'status': 'error', 'message': str(e)}, 500)
+
+@app.route('/messages/batch/<batch_id>', methods=['GET'])
+@app.route('/api/messages/batch/<batch_id>', methods=['GET'])
+def batch_status_route(batch_id):
+    """Progress of a queued batch"""
+    if INGEST_API_KEY and request.headers.get('X-API-Key') != INGEST_API_KEY:
+        return json_response({'status': 'error', 'message': 'Invalid API key'}, 401)
+    if ingest is None:
+        return json_response({'status': 'error', 'message': 'Message queue is not available'}, 503)
+    status = ingest.status(batch_id)
+    if status is None:
+        return json_response({'status': 'error', 'message': 'Batch not found'}, 404)
+    return json_response(status)
+
 # Keep this for local testing
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=int(os.getenv('PORT', 8000))) 
\ No newline at end of file
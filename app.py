@@ -1,14 +1,42 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response, stream_with_context
+from markupsafe import Markup
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql, sqlite
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 import os
 from dotenv import load_dotenv
 import smtplib
 from email.mime.text import MIMEText
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta, timezone
 from sms_client import sms_client, SMSClient
+from smpp_client import smpp_client
+from bulk_jobs import BulkJobEngine
+from delivery_receipts import DeliveryReceiptListener
+from report_poller import ReportPoller
+from gateway_cache import SharedCache
+from bulk_insert import BulkInsertWriter
+from recipients import open_upload, iter_recipients, render_content
+from phone_numbers import NumberNormalizer, normalize_number
+from rates import RateTable, RateCard
+from routing import Router, Route, CircuitBreaker, HTTPGatewayBackend, SMPPBackend, SendAPIBackend
+from rate_limit import TokenBucketLimiter, DEFAULT_PATH as RATE_LIMIT_DEFAULT_PATH
+from scheduler import TRANSACTIONAL
+from timer_wheel import ScheduledDispatcher
+from outbox import OutboxDispatcher
+from retry import RetryPolicy
+from idempotency import IdempotencyStore, IdempotencyConflict, digest, digest_stream
+from user_cache import UserCache
+from sqlalchemy import event
+import base64
+import click
+import csv
+import json
 import logging
+import socket
+import zipfile
+import time
+import uuid
 
 # Load environment variables
 load_dotenv()
@@ -33,9 +61,91 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-# Add a global variable to track system balance
-system_balance = 1000.0  # Initial balance in euros
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 10))  # Seconds a logged-in user is reused between requests
+INITIAL_SYSTEM_BALANCE = float(os.getenv('INITIAL_SYSTEM_BALANCE', 1000.0))  # Seed balance in euros
+BALANCE_CACHE_TTL = float(os.getenv('BALANCE_CACHE_TTL', 2))  # Seconds a balance read is reused
 DEFAULT_SMS_RATE = float(os.getenv('DEFAULT_SMS_RATE', 0.05))  # Default cost per SMS in euros
+DEFAULT_COUNTRY_CODE = os.getenv('DEFAULT_COUNTRY_CODE', '+52')  # Prepended to 10-digit numbers
+RATE_TABLE_TTL = float(os.getenv('RATE_TABLE_TTL', 60))  # Seconds before the rate table is reloaded
+
+# Bulk send worker pool settings
+BULK_WORKERS = int(os.getenv('BULK_WORKERS', 4))
+BULK_CHUNK_SIZE = int(os.getenv('BULK_CHUNK_SIZE', 100))
+BULK_PRIORITY_WORKERS = int(os.getenv('BULK_PRIORITY_WORKERS', 1))  # Threads reserved for single sends
+BULK_CHUNK_ATTEMPTS = int(os.getenv('BULK_CHUNK_ATTEMPTS', 3))  # Tries of a chunk that raised before its messages fail
+MESSAGE_INSERT_CHUNK_SIZE = int(os.getenv('MESSAGE_INSERT_CHUNK_SIZE', 5000))
+BULK_JOB_LEASE = timedelta(seconds=int(os.getenv('BULK_JOB_LEASE_SECONDS', 300)))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Delivery receipt write batching
+DLR_BATCH_SIZE = int(os.getenv('DLR_BATCH_SIZE', 500))
+DLR_FLUSH_INTERVAL = float(os.getenv('DLR_FLUSH_INTERVAL', 0.5))
+
+# HTTP gateway delivery report polling
+REPORT_POLLER_ENABLED = os.getenv('REPORT_POLLER_ENABLED', 'true').lower() == 'true'
+REPORT_PAGE_SIZE = int(os.getenv('REPORT_PAGE_SIZE', 1000))
+REPORT_MIN_INTERVAL = float(os.getenv('REPORT_MIN_INTERVAL', 5))
+REPORT_MAX_INTERVAL = float(os.getenv('REPORT_MAX_INTERVAL', 300))
+REPORT_MAX_AGE = timedelta(hours=int(os.getenv('REPORT_MAX_AGE_HOURS', 72)))
+AWAITING_REPORT_STATUSES = ('sent',)  # Accepted by the gateway, not yet final
+FINAL_STATUSES = ('delivered', 'undelivered', 'expired', 'rejected', 'failed')  # Never changed by a later report
+
+# Message statuses counted as successful on the dashboard, everything else counts as failed
+SUCCESS_STATUSES = ('sent', 'delivered')
+STAT_PERIODS = ('hour', 'day', 'month')
+
+# Gateway routes as JSON, each with a backend (http, smpp or send_api) and
+# costs by destination prefix ('' carries every destination), e.g.
+# [{"name": "smpp", "backend": "smpp", "costs": {"52": 0.008}, "rate": 100}, {"name": "http", "backend": "http", "costs": {"": 0.01}}]
+SMS_ROUTES = json.loads(os.getenv('SMS_ROUTES', '[{"name": "http", "backend": "http", "costs": {"": 0}}]'))
+# Routes whose messages are polled with the HTTP gateway's getreport API, the others report over SMPP
+REPORT_ROUTES = [config['name'] for config in SMS_ROUTES if config.get('backend', config['name']) == 'http']
+SMS_GATEWAY = os.getenv('SMS_GATEWAY')  # Name of the route tried first
+SMS_SENDER_ID = os.getenv('SMS_SENDER_ID', 'SMSHub')
+ROUTE_FAILURE_THRESHOLD = int(os.getenv('ROUTE_FAILURE_THRESHOLD', 5))
+ROUTE_RESET_TIMEOUT = float(os.getenv('ROUTE_RESET_TIMEOUT', 30))
+ROUTE_LATENCY_WEIGHT = float(os.getenv('ROUTE_LATENCY_WEIGHT', 0.01))
+
+# Send rate limits in messages per second, shared by the workers on a host
+# through RATE_LIMIT_DB. Routes take "rate"/"burst" from SMS_ROUTES; 0 disables a limit.
+RATE_LIMIT_DB = os.getenv('RATE_LIMIT_DB', RATE_LIMIT_DEFAULT_PATH)
+SMPP_BIND_RATE = float(os.getenv('SMPP_BIND_RATE', 0))  # Per SMPP bind
+PREFIX_RATE_LIMITS = json.loads(os.getenv('PREFIX_RATE_LIMITS', '{}'))  # {prefix: rate}, e.g. {"52": 200}
+USER_RATE_LIMIT = float(os.getenv('USER_RATE_LIMIT', 0))  # Per user, unless set on the user
+
+# Scheduled sends: timer resolution, seconds held in memory ahead of now, rows per load
+SCHEDULE_TICK = float(os.getenv('SCHEDULE_TICK', 1))
+SCHEDULE_HORIZON = float(os.getenv('SCHEDULE_HORIZON', 300))
+SCHEDULE_BATCH_SIZE = int(os.getenv('SCHEDULE_BATCH_SIZE', 1000))
+
+# Idempotency keys of send requests: seconds remembered, keys cached per process
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', 86400))
+IDEMPOTENCY_LOCAL_SIZE = int(os.getenv('IDEMPOTENCY_LOCAL_SIZE', 10000))
+
+# Outbox of single sends: dispatcher threads, rows per claim, seconds between polls when idle
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', 1))
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 100))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', 1))
+OUTBOX_LEASE = timedelta(seconds=int(os.getenv('OUTBOX_LEASE_SECONDS', 300)))
+
+# Retries of temporary send failures: sends per message, backoff base and cap in seconds
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', 5))
+RETRY_BASE_DELAY = float(os.getenv('RETRY_BASE_DELAY', 1))
+RETRY_MAX_DELAY = float(os.getenv('RETRY_MAX_DELAY', 60))
+# HTTP gateway status values that mean "try again later", e.g. "-9,-12"
+GATEWAY_RETRYABLE_STATUSES = [int(status) for status in os.getenv('GATEWAY_RETRYABLE_STATUSES', '').split(',')
+                              if status.strip()]
+
+# Message history paging
+MESSAGES_PAGE_SIZE = int(os.getenv('MESSAGES_PAGE_SIZE', 50))
+MESSAGES_MAX_PAGE_SIZE = 200
+
+# Gateway statistics/balance cache shared by all worker processes
+GATEWAY_CACHE_TTL = float(os.getenv('GATEWAY_CACHE_TTL', 60))
+GATEWAY_CACHE_STALE_TTL = float(os.getenv('GATEWAY_CACHE_STALE_TTL', 3600))
+GATEWAY_CACHE_LOCAL_TTL = float(os.getenv('GATEWAY_CACHE_LOCAL_TTL', 5))
+GATEWAY_CACHE_WAIT = float(os.getenv('GATEWAY_CACHE_WAIT', 3))
+GATEWAY_STATS_MAX_DAYS = 92
 
 # Message model for tracking SMS
 class Message(db.Model):
@@ -44,9 +154,175 @@ class Message(db.Model):
     numbers = db.Column(db.String(500), nullable=False)
     content = db.Column(db.Text, nullable=False)
     status = db.Column(db.String(20), default='pending')
-    message_id = db.Column(db.String(50))
+    message_id = db.Column(db.String(50), index=True)  # Gateway/SMSC message id
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     cost = db.Column(db.Float, default=0.0)
+    bulk_job_id = db.Column(db.Integer, db.ForeignKey('bulk_job.id'), index=True)
+    scheduled_at = db.Column(db.DateTime)  # UTC send time of scheduled messages
+    attempts = db.Column(db.Integer, default=0)  # Sends tried, retries of temporary failures included
+    route = db.Column(db.String(50))  # Name of the gateway route that accepted the message
+
+    __table_args__ = (
+        # Lets the report poller walk messages awaiting a report by id
+        db.Index('ix_message_status_id', 'status', 'id'),
+        # Keyset pagination of a user's history on (created_at, id)
+        db.Index('ix_message_user_created_id', 'user_id', 'created_at', 'id'),
+        # Lets the scheduled dispatcher load due messages as an index range
+        db.Index('ix_message_status_scheduled_id', 'status', 'scheduled_at', 'id'),
+    )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'numbers': self.numbers,
+            'content': self.content,
+            'status': self.status,
+            'cost': self.cost,
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'scheduled_at': self.scheduled_at.strftime('%Y-%m-%d %H:%M:%S') if self.scheduled_at else None
+        }
+
+# Per-user message statistics rolled up by hour, day and month
+class MessageStat(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    period = db.Column(db.String(10), nullable=False)  # hour, day, month
+    bucket = db.Column(db.DateTime, nullable=False)  # Start of the period
+    status = db.Column(db.String(20), nullable=False)
+    messages = db.Column(db.Integer, default=0)
+    recipients = db.Column(db.Integer, default=0)
+    cost = db.Column(db.Float, default=0.0)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'period', 'bucket', 'status', name='uq_message_stat_bucket'),
+    )
+
+# Shared cache of gateway responses (see gateway_cache.SharedCache)
+class CacheEntry(db.Model):
+    key = db.Column(db.String(100), primary_key=True)
+    value = db.Column(db.Text, nullable=False)  # JSON
+    fetched_at = db.Column(db.Float, nullable=False)  # Unix time
+    refresh_until = db.Column(db.Float)  # Lease of the process refreshing the entry
+
+# Gateway daily statistics history, past days are fetched only once
+class DailyStat(db.Model):
+    day = db.Column(db.Date, primary_key=True)
+    success = db.Column(db.Integer, default=0)
+    fail = db.Column(db.Integer, default=0)
+    billcnt = db.Column(db.Float, default=0.0)
+    final = db.Column(db.Boolean, default=False)  # Day was over when fetched
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'date': self.day.isoformat(),
+            'success': self.success,
+            'fail': self.fail,
+            'billcnt': self.billcnt
+        }
+
+# System balance shared by all worker processes, only changed through
+# atomic increments in update_system_balance
+class SystemAccount(db.Model):
+    key = db.Column(db.String(50), primary_key=True)
+    balance = db.Column(db.Float, nullable=False, default=0.0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Append-only history of system balance changes
+class LedgerEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    amount = db.Column(db.Float, nullable=False)  # Positive credits, negative debits
+    balance = db.Column(db.Float)  # Balance after the change
+    reason = db.Column(db.String(50), nullable=False)
+    reference = db.Column(db.String(100))  # e.g. user or bulk job the change belongs to
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Credits held for a bulk job until it has been sent, see reserve_credits
+class CreditReservation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    bulk_job_id = db.Column(db.Integer, db.ForeignKey('bulk_job.id'), unique=True)
+    amount = db.Column(db.Float, nullable=False)  # Credits taken from the user up front
+    settled = db.Column(db.Float, default=0.0)  # Credits actually spent so far
+    status = db.Column(db.String(20), default='open')  # open, released
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    released_at = db.Column(db.DateTime)
+
+# Bulk job model for campaigns drained by the background worker pool
+class BulkJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    rate = db.Column(db.Float, default=0.0)  # Cost per message at submission time
+    status = db.Column(db.String(20), default='queued')  # queued, running, completed
+    total_count = db.Column(db.Integer, default=0)
+    sent_count = db.Column(db.Integer, default=0)
+    failed_count = db.Column(db.Integer, default=0)
+    invalid_count = db.Column(db.Integer, default=0)  # Rejected at submission
+    duplicate_count = db.Column(db.Integer, default=0)  # Removed at submission
+    locked_by = db.Column(db.String(100))  # Worker process currently draining the job
+    heartbeat_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    completed_at = db.Column(db.DateTime)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'total': self.total_count,
+            'sent': self.sent_count,
+            'failed': self.failed_count,
+            'pending': self.total_count - self.sent_count - self.failed_count,
+            'invalid': self.invalid_count,
+            'duplicates': self.duplicate_count,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'completed_at': self.completed_at.isoformat() if self.completed_at else None
+        }
+
+# Per-destination rate by E.164 prefix; rows with a user_id override the shared table for that user
+class DestinationRate(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    prefix = db.Column(db.String(15), nullable=False)
+    rate = db.Column(db.Float, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'prefix', name='uq_destination_rate_prefix'),
+    )
+
+    def to_dict(self):
+        return {'id': self.id, 'prefix': self.prefix, 'rate': self.rate, 'user_id': self.user_id}
+
+# Recipients dropped from a bulk job at submission, downloadable as CSV
+class RecipientReject(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    bulk_job_id = db.Column(db.Integer, db.ForeignKey('bulk_job.id'), nullable=False, index=True)
+    number = db.Column(db.String(100), nullable=False)  # As uploaded
+    reason = db.Column(db.String(20), nullable=False)  # empty, too short, too long, duplicate
+
+# Outcome of send requests by idempotency key, so client retries are not sent twice
+class IdempotencyKey(db.Model):
+    key = db.Column(db.String(32), primary_key=True)  # digest of endpoint, user and client key
+    fingerprint = db.Column(db.String(32), nullable=False)  # digest of the request parameters
+    response = db.Column(db.Text)  # JSON, NULL while the request is in progress
+    expires_at = db.Column(db.Float, nullable=False, index=True)
+
+# Committed sends waiting for the outbox dispatcher, deleted once sent
+class OutboxEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=False, unique=True)
+    status = db.Column(db.String(20), default='pending')  # pending, sending
+    attempts = db.Column(db.Integer, default=0)
+    available_at = db.Column(db.DateTime, default=datetime.utcnow)  # Not claimed before this time
+    locked_by = db.Column(db.String(100))  # Claim token of the dispatcher sending the row
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # Lets dispatchers claim due rows in id order
+        db.Index('ix_outbox_entry_status_available_id', 'status', 'available_at', 'id'),
+    )
 
 # User model
 class User(UserMixin, db.Model):
@@ -58,6 +334,7 @@ class User(UserMixin, db.Model):
     is_admin = db.Column(db.Boolean, default=False)
     sms_rate = db.Column(db.Float, default=DEFAULT_SMS_RATE)  # Custom rate per SMS
     role = db.Column(db.String(20), default='user')  # Add role field
+    rate_limit = db.Column(db.Float)  # Messages per second, USER_RATE_LIMIT when unset
     messages = db.relationship('Message', backref='user', lazy=True)
 
     def set_password(self, password):
@@ -70,20 +347,103 @@ class User(UserMixin, db.Model):
         """Get the user's SMS rate"""
         return self.sms_rate if not self.is_admin else DEFAULT_SMS_RATE
 
+    def send_limits(self):
+        """Token buckets charged for this user's sends, see Router.send_batch"""
+        rate = self.rate_limit if self.rate_limit is not None else USER_RATE_LIMIT
+        return [(f'user:{self.id}', rate, None)] if rate else []
+
+def load_user_row(user_id):
+    """Columns of a user for the login cache, without the password hash"""
+    table = User.__table__
+    row = db.session.execute(
+        db.select(*[column for column in table.c if column.name != 'password']).where(table.c.id == user_id)
+    ).first()
+    return dict(row._mapping) if row is not None else None
+
+user_cache = UserCache(load_user_row, ttl=USER_CACHE_TTL)
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # A transient copy of the cached row; billing reads the balance with user_credits()
+    row = user_cache.get(int(user_id))
+    return User(**row) if row is not None else None
+
+def user_credits(user_id):
+    """Current credits of a user, read from the database"""
+    return db.session.query(User.credits).filter(User.id == user_id).scalar() or 0.0
+
+def invalidate_user(user_id):
+    """Drop the user from the login cache once the current transaction commits"""
+    db.session.info.setdefault('invalidate_users', set()).add(user_id)
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_committed_users(session):
+    for user_id in session.info.pop('invalidate_users', ()):
+        user_cache.invalidate(user_id)
+
+@event.listens_for(db.session, 'after_rollback')
+def _forget_rolled_back_users(session):
+    session.info.pop('invalidate_users', None)
+
+SYSTEM_ACCOUNT = 'system'
+_balance_cache = {'value': None, 'read_at': 0.0}
 
 def get_system_balance():
-    """Get the real system balance in euros"""
-    global system_balance
-    return system_balance
+    """Get the real system balance in euros (reused for BALANCE_CACHE_TTL seconds)"""
+    now = time.time()
+    if _balance_cache['value'] is not None and now - _balance_cache['read_at'] < BALANCE_CACHE_TTL:
+        return _balance_cache['value']
+    table = SystemAccount.__table__
+    with db.engine.connect() as conn:
+        balance = conn.execute(db.select(table.c.balance).where(table.c.key == SYSTEM_ACCOUNT)).scalar()
+    _balance_cache.update(value=balance or 0.0, read_at=now)
+    return _balance_cache['value']
+
+def update_system_balance(amount, reason='adjustment', reference=None, require_funds=False):
+    """
+    Atomically add amount euros to the system balance and record a ledger entry.
+    The change is part of the current session transaction and is committed with it.
+    :param require_funds: Refuse a debit that would make the balance negative
+    :return: New balance, or None if require_funds refused the debit
+    """
+    table = SystemAccount.__table__
+    stmt = table.update().where(table.c.key == SYSTEM_ACCOUNT)
+    if require_funds:
+        stmt = stmt.where(table.c.balance + amount >= 0)
+    stmt = stmt.values(balance=table.c.balance + amount, updated_at=datetime.utcnow())
+
+    if db.engine.dialect.name == 'postgresql':
+        balance = db.session.execute(stmt.returning(table.c.balance)).scalar()
+    elif db.session.execute(stmt).rowcount:
+        balance = db.session.execute(db.select(table.c.balance).where(table.c.key == SYSTEM_ACCOUNT)).scalar()
+    else:
+        balance = None
+    if balance is None:
+        return None
+
+    db.session.add(LedgerEntry(amount=amount, balance=balance, reason=reason, reference=reference))
+    _balance_cache.update(value=None, read_at=0.0)
+    return balance
+
+_rate_tables = {'table': RateTable(), 'overrides': {}, 'loaded_at': None}
 
-def update_system_balance(amount):
-    """Update the system balance in euros"""
-    global system_balance
-    system_balance += amount
-    return system_balance
+def load_rate_tables():
+    """Build the shared and per-user prefix tries from the destination_rate table"""
+    table = RateTable()
+    overrides = {}
+    for prefix, rate, user_id in db.session.query(DestinationRate.prefix, DestinationRate.rate,
+                                                  DestinationRate.user_id):
+        if user_id is None:
+            table.add(prefix, rate)
+        else:
+            overrides.setdefault(user_id, RateTable()).add(prefix, rate)
+    _rate_tables.update(table=table, overrides=overrides, loaded_at=time.time())
+
+def get_rate_card(user):
+    """Rates of a user, reloading the rate table every RATE_TABLE_TTL seconds"""
+    if _rate_tables['loaded_at'] is None or time.time() - _rate_tables['loaded_at'] >= RATE_TABLE_TTL:
+        load_rate_tables()
+    return RateCard(_rate_tables['table'], _rate_tables['overrides'].get(user.id), user.get_sms_rate())
 
 def euros_to_credits(euros, rate):
     """Convert euros to SMS credits based on rate"""
@@ -93,10 +453,185 @@ def credits_to_euros(credits, rate):
     """Convert SMS credits to euros based on rate"""
     return credits * rate
 
+def upsert_row(table, row, keys):
+    """Insert a row or overwrite the existing one with the same keys, in its own transaction"""
+    with db.engine.begin() as conn:
+        dialect = db.engine.dialect.name
+        if dialect in ('sqlite', 'postgresql'):
+            insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+            stmt = insert(table).values(**row)
+            conn.execute(stmt.on_conflict_do_update(
+                index_elements=keys,
+                set_={name: value for name, value in row.items() if name not in keys}
+            ))
+            return
+        condition = db.and_(*(table.c[name] == row[name] for name in keys))
+        if not conn.execute(table.update().where(condition).values(**row)).rowcount:
+            conn.execute(table.insert().values(**row))
+
+def load_cache_entry(key):
+    table = CacheEntry.__table__
+    with db.engine.connect() as conn:
+        row = conn.execute(db.select(table.c.value, table.c.fetched_at).where(table.c.key == key)).first()
+    if row is None:
+        return None
+    return json.loads(row.value), row.fetched_at
+
+def store_cache_entry(key, value, fetched_at):
+    upsert_row(CacheEntry.__table__,
+               {'key': key, 'value': json.dumps(value), 'fetched_at': fetched_at, 'refresh_until': None},
+               ['key'])
+
+def claim_cache_refresh(key, lease):
+    """Conditional UPDATE so only one worker process refreshes a stale entry"""
+    table = CacheEntry.__table__
+    now = time.time()
+    with db.engine.begin() as conn:
+        claimed = conn.execute(table.update().where(db.and_(
+            table.c.key == key,
+            db.or_(table.c.refresh_until.is_(None), table.c.refresh_until < now)
+        )).values(refresh_until=now + lease)).rowcount
+    return claimed == 1
+
+gateway_cache = SharedCache(load_cache_entry, store_cache_entry, claim_cache_refresh,
+                            ttl=GATEWAY_CACHE_TTL, stale_ttl=GATEWAY_CACHE_STALE_TTL,
+                            local_ttl=GATEWAY_CACHE_LOCAL_TTL, wait_timeout=GATEWAY_CACHE_WAIT)
+
+_idempotency_purge = {'at': 0.0}
+
+def claim_idempotency_key(key, fingerprint, expires_at):
+    """
+    Insert the key, or take over an expired one, in its own transaction
+    :return: None if claimed, else the stored (fingerprint, response)
+    """
+    table = IdempotencyKey.__table__
+    now = time.time()
+    row = {'key': key, 'fingerprint': fingerprint, 'response': None, 'expires_at': expires_at}
+    with db.engine.begin() as conn:
+        if now - _idempotency_purge['at'] > 3600:
+            _idempotency_purge['at'] = now
+            conn.execute(table.delete().where(table.c.expires_at < now))
+
+        dialect = db.engine.dialect.name
+        if dialect in ('sqlite', 'postgresql'):
+            insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+            stmt = insert(table).values(**row)
+            claimed = conn.execute(stmt.on_conflict_do_update(
+                index_elements=['key'],
+                set_={'fingerprint': fingerprint, 'response': None, 'expires_at': expires_at},
+                where=table.c.expires_at < now
+            )).rowcount
+        else:
+            claimed = conn.execute(table.update().where(
+                db.and_(table.c.key == key, table.c.expires_at < now)).values(**row)).rowcount
+            if not claimed and conn.execute(db.select(table.c.key).where(table.c.key == key)).first() is None:
+                claimed = conn.execute(table.insert().values(**row)).rowcount
+        if claimed:
+            return None
+        stored = conn.execute(db.select(table.c.fingerprint, table.c.response).where(table.c.key == key)).first()
+    return stored.fingerprint, json.loads(stored.response) if stored.response else None
+
+def release_idempotency_key(key):
+    table = IdempotencyKey.__table__
+    with db.engine.begin() as conn:
+        conn.execute(table.delete().where(db.and_(table.c.key == key, table.c.response.is_(None))))
+
+idempotency_store = IdempotencyStore(claim_idempotency_key, release_idempotency_key,
+                                     ttl=IDEMPOTENCY_TTL, local_size=IDEMPOTENCY_LOCAL_SIZE)
+
+def begin_idempotent(scope, *params):
+    """
+    Claim the Idempotency-Key header (or idempotency_key form field) of the current request
+    :param params: Request parameters a reused key must match
+    :return: (idempotency handle or None without a key, stored response of a retried request)
+    :raises IdempotencyConflict:
+    """
+    client_key = request.headers.get('Idempotency-Key') or request.form.get('idempotency_key')
+    if not client_key:
+        return None, None
+    fingerprint = digest(*params)
+    key, response = idempotency_store.begin(f'{scope}:{current_user.id}', client_key, fingerprint)
+    return (key, fingerprint), response
+
+def record_idempotent(idempotency, response):
+    """Store the response of a claimed request with the current session transaction"""
+    if idempotency is None:
+        return
+    table = IdempotencyKey.__table__
+    db.session.execute(table.update().where(table.c.key == idempotency[0]).values(response=json.dumps(response)))
+
+def complete_idempotent(idempotency, response):
+    """Remember the response locally once its transaction is committed"""
+    if idempotency is not None:
+        idempotency_store.complete(idempotency[0], idempotency[1], response)
+
+def release_idempotent(idempotency):
+    if idempotency is not None:
+        idempotency_store.release(idempotency[0])
+
+def flash_response(*flashes):
+    """Stored response of a form post: its flash messages as HTML"""
+    return {'flash': [[str(Markup.escape(message)), category] for message, category in flashes]}
+
+def replay_flashes(response, endpoint):
+    for message, category in response['flash']:
+        flash(Markup(message), category)
+    return redirect(url_for(endpoint))
+
+app.jinja_env.globals['new_idempotency_key'] = lambda: uuid.uuid4().hex
+
+def fetch_daily_stats(day):
+    """
+    Fetch one day of gateway statistics and keep it in the history table
+    :return: dict with date, success, fail and billcnt, or None on failure
+    """
+    success, result = sms_client.get_daily_stats(day.strftime('%Y%m%d'))
+    if not success:
+        return None
+    row = {
+        'day': day,
+        'success': int(result.get('success', 0) or 0),
+        'fail': int(result.get('fail', 0) or 0),
+        'billcnt': float(result.get('billcnt', 0) or 0),
+        'final': day < date.today(),
+        'updated_at': datetime.utcnow()
+    }
+    upsert_row(DailyStat.__table__, row, ['day'])
+    return {'date': day.isoformat(), 'success': row['success'], 'fail': row['fail'], 'billcnt': row['billcnt']}
+
+def fetch_gateway_balance():
+    success, result = sms_client.get_balance()
+    return result['balance'] if success else None
+
+def get_gateway_balance():
+    """Gateway account balance, served from the shared cache"""
+    return gateway_cache.get('balance', fetch_gateway_balance)
+
+def get_gateway_stats(date_from, date_to):
+    """
+    Gateway daily statistics for a range of days. Finished days come from the
+    history table and are only requested from the gateway the first time.
+    """
+    history = {stat.day: stat.to_dict() for stat in
+               DailyStat.query.filter(DailyStat.day.between(date_from, date_to), DailyStat.final.is_(True))}
+    today = date.today()
+    days = []
+    day = date_from
+    while day <= date_to:
+        if day == today:
+            stats = gateway_cache.get(f'daily_stats:{day.isoformat()}', lambda: fetch_daily_stats(today))
+        else:
+            stats = history.get(day) or fetch_daily_stats(day)
+        if stats:
+            days.append(stats)
+        day += timedelta(days=1)
+    return days
+
 def get_system_stats():
     """Get system-wide statistics"""
-    success, result = sms_client.get_daily_stats()
-    if success:
+    today = date.today()
+    result = gateway_cache.get(f'daily_stats:{today.isoformat()}', lambda: fetch_daily_stats(today))
+    if result:
         return {
             'total_sent': result.get('success', 0),
             'total_failed': result.get('fail', 0),
@@ -104,6 +639,689 @@ def get_system_stats():
         }
     return {'total_sent': 0, 'total_failed': 0, 'total_cost': 0}
 
+def stat_bucket(period, when):
+    """Start of the hour, day or month containing when"""
+    if period == 'hour':
+        return when.replace(minute=0, second=0, microsecond=0)
+    if period == 'day':
+        return when.replace(hour=0, minute=0, second=0, microsecond=0)
+    return when.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def record_message_stats(entries):
+    """
+    Add to the per-user rollups as part of the current transaction
+    :param entries: Iterable of (user_id, created_at, status, messages, recipients, cost);
+                    negative values move counts out of a status
+    """
+    totals = {}
+    for user_id, created_at, status, messages, recipients, cost in entries:
+        for period in STAT_PERIODS:
+            key = (user_id, period, stat_bucket(period, created_at), status)
+            total = totals.setdefault(key, [0, 0, 0.0])
+            total[0] += messages
+            total[1] += recipients
+            total[2] += cost or 0.0
+
+    rows = [
+        {'user_id': user_id, 'period': period, 'bucket': bucket, 'status': status,
+         'messages': messages, 'recipients': recipients, 'cost': cost}
+        for (user_id, period, bucket, status), (messages, recipients, cost) in totals.items()
+    ]
+    if not rows:
+        return
+
+    table = MessageStat.__table__
+    dialect = db.engine.dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        insert = sqlite.insert if dialect == 'sqlite' else postgresql.insert
+        stmt = insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['user_id', 'period', 'bucket', 'status'],
+            set_={
+                'messages': table.c.messages + stmt.excluded.messages,
+                'recipients': table.c.recipients + stmt.excluded.recipients,
+                'cost': table.c.cost + stmt.excluded.cost
+            }
+        )
+        db.session.execute(stmt, rows)
+        return
+
+    for row in rows:
+        updated = db.session.execute(
+            table.update().where(db.and_(
+                table.c.user_id == row['user_id'], table.c.period == row['period'],
+                table.c.bucket == row['bucket'], table.c.status == row['status']
+            )).values(messages=table.c.messages + row['messages'],
+                      recipients=table.c.recipients + row['recipients'],
+                      cost=table.c.cost + row['cost'])
+        ).rowcount
+        if not updated:
+            db.session.execute(table.insert().values(**row))
+
+def recipient_count(numbers):
+    return len(numbers.split(','))
+
+def encode_cursor(message):
+    """Opaque cursor pointing just past a message in (created_at, id) order"""
+    raw = f"{message.created_at.isoformat()}|{message.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor):
+    """:return: (created_at, id) or raise ValueError"""
+    created_at, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(created_at), int(message_id)
+
+def filter_messages(query, status=None, date_from=None, date_to=None):
+    """
+    Apply history filters in SQL
+    :param status: Comma separated statuses
+    :param date_from: First day included (YYYY-MM-DD)
+    :param date_to: Last day included (YYYY-MM-DD)
+    """
+    if status:
+        query = query.filter(Message.status.in_([s.strip() for s in status.split(',') if s.strip()]))
+    if date_from:
+        query = query.filter(Message.created_at >= datetime.strptime(date_from, '%Y-%m-%d'))
+    if date_to:
+        query = query.filter(Message.created_at < datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1))
+    return query
+
+def paginate_messages(query, cursor=None, limit=MESSAGES_PAGE_SIZE):
+    """
+    Newest-first page of messages using keyset pagination on (created_at, id)
+    :return: (messages, next_cursor) where next_cursor is None on the last page
+    """
+    if cursor:
+        created_at, message_id = decode_cursor(cursor)
+        query = query.filter(db.or_(
+            Message.created_at < created_at,
+            db.and_(Message.created_at == created_at, Message.id < message_id)
+        ))
+    messages = query.order_by(Message.created_at.desc(), Message.id.desc()).limit(limit + 1).all()
+    if len(messages) > limit:
+        messages = messages[:limit]
+        return messages, encode_cursor(messages[-1])
+    return messages, None
+
+def insert_message_rows(rows):
+    """Insert Message rows with one executemany in the current transaction"""
+    db.session.execute(Message.__table__.insert(), rows)
+
+def insert_reject_rows(rows):
+    db.session.execute(RecipientReject.__table__.insert(), rows)
+
+def reserve_credits(user_id, amount, bulk_job_id=None):
+    """
+    Hold amount credits for a bulk job as part of the current transaction.
+    The conditional UPDATE locks the user row, so concurrent reservations for
+    the same account cannot overdraw it.
+    :return: CreditReservation, or None if the user has insufficient credits
+    """
+    held = User.query.filter(User.id == user_id, User.credits >= amount).update(
+        {'credits': User.credits - amount}, synchronize_session=False)
+    if not held:
+        return None
+    invalidate_user(user_id)
+    reservation = CreditReservation(user_id=user_id, bulk_job_id=bulk_job_id, amount=amount)
+    db.session.add(reservation)
+    return reservation
+
+def settle_reservation(bulk_job_id, user_id, spent):
+    """
+    Record credits spent by a chunk as part of the chunk's transaction.
+    Jobs queued without a reservation are debited directly.
+    """
+    settled = CreditReservation.query.filter_by(bulk_job_id=bulk_job_id, status='open').update(
+        {'settled': CreditReservation.settled + spent}, synchronize_session=False)
+    if not settled:
+        User.query.filter_by(id=user_id).update({'credits': User.credits - spent}, synchronize_session=False)
+        invalidate_user(user_id)
+
+def release_reservation(bulk_job_id):
+    """
+    Close the reservation of a finished job and return the unspent credits
+    :return: Credits returned to the user
+    """
+    reservation = CreditReservation.query.filter_by(bulk_job_id=bulk_job_id, status='open').first()
+    if reservation is None:
+        return 0.0
+    released = CreditReservation.query.filter_by(id=reservation.id, status='open').update(
+        {'status': 'released', 'released_at': datetime.utcnow()}, synchronize_session=False)
+    if not released:
+        return 0.0
+    # settled is only written by chunk commits, which are all done at this point
+    unused = max(reservation.amount - reservation.settled, 0.0)
+    if unused:
+        User.query.filter_by(id=reservation.user_id).update(
+            {'credits': User.credits + unused}, synchronize_session=False)
+        invalidate_user(reservation.user_id)
+    return unused
+
+def claim_bulk_job(job_id):
+    """Take the lease on a bulk job so only one process drains it"""
+    now = datetime.utcnow()
+    claimed = BulkJob.query.filter(
+        BulkJob.id == job_id,
+        BulkJob.status.in_(['queued', 'running']),
+        db.or_(BulkJob.locked_by.is_(None),
+               BulkJob.locked_by == WORKER_ID,
+               BulkJob.heartbeat_at < now - BULK_JOB_LEASE)
+    ).update({'status': 'running', 'locked_by': WORKER_ID, 'heartbeat_at': now},
+             synchronize_session=False)
+    db.session.commit()
+    return claimed == 1
+
+def enqueue_bulk_job(job_id):
+    """Hand the still-queued messages of a job to the worker pool"""
+    if not claim_bulk_job(job_id):
+        logger.info(f"Bulk job {job_id} is owned by another worker")
+        return False
+
+    first_id, last_id = db.session.query(
+        db.func.min(Message.id), db.func.max(Message.id)
+    ).filter(Message.bulk_job_id == job_id, Message.status == 'queued').one()
+
+    if first_id is None:
+        complete_bulk_job(job_id)
+    else:
+        # Chunks are shared fairly between the users with running campaigns
+        user_id = db.session.query(BulkJob.user_id).filter(BulkJob.id == job_id).scalar()
+        bulk_engine.submit(job_id, first_id, last_id, tenant=user_id)
+    return True
+
+def process_bulk_chunk(job_id, first_id, last_id):
+    """Send one chunk of a bulk job and record the outcome"""
+    with app.app_context():
+        try:
+            job = BulkJob.query.get(job_id)
+            messages = Message.query.filter(
+                Message.bulk_job_id == job_id,
+                Message.status == 'queued',
+                Message.id.between(first_id, last_id)
+            ).order_by(Message.id).all()
+
+            limits = User.query.get(job.user_id).send_limits()
+
+            # Messages personalised from recipient variables differ in content,
+            # each distinct text is sent as its own batch
+            batches = {}
+            for message in messages:
+                batches.setdefault(message.content, []).append(message)
+            results = []
+            for text, batch in batches.items():
+                results.extend(zip(batch, sms_router.send_batch([message.numbers for message in batch], text,
+                                                                limits)))
+
+            sent = 0
+            failed = 0
+            spent = 0.0
+            retry_ids = []
+            retry_delay = 0.0
+            for message, (number, success, result, route) in results:
+                message.attempts = (message.attempts or 0) + 1
+                if success:
+                    message.status = 'sent'
+                    message.message_id = result
+                    message.route = route
+                    # Queued messages carry the price quoted at submission
+                    message.cost = job.rate if message.cost is None else message.cost
+                    spent += message.cost
+                    sent += 1
+                    continue
+                delay = retry_policy.decide(result, message.attempts)
+                if delay is not None:
+                    # Stays queued and is sent again by a deferred chunk
+                    retry_ids.append(message.id)
+                    retry_delay = max(retry_delay, delay)
+                else:
+                    message.status = 'failed'
+                    message.cost = 0
+                    failed += 1
+                    logger.error(f"Failed to send SMS to {message.numbers}: {result}")
+
+            record_message_stats(
+                (message.user_id, message.created_at, message.status, 1,
+                 recipient_count(message.numbers), message.cost)
+                for message in messages if message.status != 'queued'
+            )
+
+            if spent:
+                settle_reservation(job_id, job.user_id, spent)
+                update_system_balance(spent, reason='bulk_sms', reference=f'bulk_job:{job_id}')
+
+            BulkJob.query.filter_by(id=job_id).update({
+                'sent_count': BulkJob.sent_count + sent,
+                'failed_count': BulkJob.failed_count + failed,
+                'heartbeat_at': datetime.utcnow()
+            }, synchronize_session=False)
+            db.session.commit()
+
+            if retry_ids:
+                logger.warning(f"Retrying {len(retry_ids)} messages of job {job_id} in {retry_delay:.1f}s")
+                bulk_engine.defer(job_id, min(retry_ids), max(retry_ids), retry_delay, tenant=job.user_id)
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+def fail_bulk_chunk(job_id, first_id, last_id):
+    """
+    Fail the still-queued messages of a chunk that could not be processed.
+    Their credits were never settled, so they are returned when the job's
+    reservation is released.
+    """
+    with app.app_context():
+        try:
+            messages = Message.query.filter(
+                Message.bulk_job_id == job_id,
+                Message.status == 'queued',
+                Message.id.between(first_id, last_id)
+            ).all()
+            for message in messages:
+                message.status = 'failed'
+                message.cost = 0
+            record_message_stats(
+                (message.user_id, message.created_at, 'failed', 1, recipient_count(message.numbers), 0)
+                for message in messages
+            )
+            BulkJob.query.filter_by(id=job_id).update({
+                'failed_count': BulkJob.failed_count + len(messages)
+            }, synchronize_session=False)
+            db.session.commit()
+            logger.error(f"Failed {len(messages)} messages of job {job_id} in chunk {first_id}-{last_id}")
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+def complete_bulk_job(job_id):
+    """Mark a bulk job as completed, release its lease and its unspent credits"""
+    completed = BulkJob.query.filter_by(id=job_id, locked_by=WORKER_ID).update({
+        'status': 'completed',
+        'locked_by': None,
+        'completed_at': datetime.utcnow()
+    }, synchronize_session=False)
+    released = release_reservation(job_id) if completed else 0.0
+    db.session.commit()
+    job = BulkJob.query.get(job_id)
+    logger.info(f"Bulk job {job_id} completed: {job.sent_count} sent, {job.failed_count} failed, "
+                f"{released:.2f} credits released")
+
+def finish_bulk_job(job_id):
+    """Called by the worker pool once every chunk of a job has been processed"""
+    with app.app_context():
+        try:
+            complete_bulk_job(job_id)
+        finally:
+            db.session.remove()
+
+def resume_bulk_jobs():
+    """Resume bulk jobs that were interrupted by a restart"""
+    jobs = BulkJob.query.filter(BulkJob.status.in_(['queued', 'running'])).all()
+    for job in jobs:
+        if enqueue_bulk_job(job.id):
+            logger.info(f"Resumed bulk job {job.id}")
+
+retry_policy = RetryPolicy(RETRY_MAX_ATTEMPTS, RETRY_BASE_DELAY, RETRY_MAX_DELAY, GATEWAY_RETRYABLE_STATUSES)
+
+bulk_engine = BulkJobEngine(process_bulk_chunk, finish_bulk_job,
+                            workers=BULK_WORKERS, chunk_size=BULK_CHUNK_SIZE,
+                            priority_workers=BULK_PRIORITY_WORKERS, failed_handler=fail_bulk_chunk,
+                            max_chunk_attempts=BULK_CHUNK_ATTEMPTS, chunk_retry_delay=RETRY_BASE_DELAY)
+
+def apply_status_updates(updates):
+    """
+    Write a batch of gateway status updates [(message_id, status), ...]
+    Messages already in a final status keep it, a late or reordered report cannot undo a delivery.
+    :return: Message ids that did not match any stored message
+    """
+    with app.app_context():
+        try:
+            message_ids = [message_id for message_id, status in updates]
+            rows = db.session.query(
+                Message.message_id, Message.user_id, Message.created_at,
+                Message.status, Message.numbers, Message.cost
+            ).filter(Message.message_id.in_(message_ids)).all()
+            matched = {row.message_id for row in rows}
+            if matched:
+                # Move each changed message from its old status to the new one in the rollups
+                new_status = dict(updates)
+                transitions = []
+                changes = []
+                for row in rows:
+                    status = new_status[row.message_id]
+                    if status == row.status or row.status in FINAL_STATUSES:
+                        continue
+                    recipients = recipient_count(row.numbers)
+                    transitions.append((row.user_id, row.created_at, row.status, -1, -recipients, -(row.cost or 0.0)))
+                    transitions.append((row.user_id, row.created_at, status, 1, recipients, row.cost))
+                    changes.append({'b_message_id': row.message_id, 'b_old_status': row.status, 'b_status': status})
+
+                if changes:
+                    record_message_stats(transitions)
+                    # Only from the status read above, so the rollups match what was written
+                    db.session.execute(
+                        Message.__table__.update()
+                        .where(Message.message_id == db.bindparam('b_message_id'),
+                               Message.status == db.bindparam('b_old_status'))
+                        .values(status=db.bindparam('b_status')),
+                        changes
+                    )
+                    db.session.commit()
+            return [message_id for message_id in message_ids if message_id not in matched]
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+def fetch_pending_reports(after_id, limit):
+    """Page of (id, message_id) for messages sent over the HTTP gateway still awaiting a delivery report"""
+    with app.app_context():
+        try:
+            return db.session.query(Message.id, Message.message_id).filter(
+                Message.status.in_(AWAITING_REPORT_STATUSES),
+                Message.route.in_(REPORT_ROUTES),
+                Message.id > after_id,
+                Message.message_id.isnot(None),
+                Message.created_at >= datetime.utcnow() - REPORT_MAX_AGE
+            ).order_by(Message.id).limit(limit).all()
+        finally:
+            db.session.remove()
+
+report_poller = ReportPoller(fetch_pending_reports, sms_client.get_report_batch, apply_status_updates,
+                             page_size=REPORT_PAGE_SIZE, min_interval=REPORT_MIN_INTERVAL,
+                             max_interval=REPORT_MAX_INTERVAL)
+
+# Delivery receipts arrive on the SMPP reader threads and are written in batches
+dlr_listener = DeliveryReceiptListener(apply_status_updates, batch_size=DLR_BATCH_SIZE,
+                                       flush_interval=DLR_FLUSH_INTERVAL,
+                                       fallback=smpp_client.handle_message)
+smpp_client.pool.set_deliver_handler(dlr_listener.handle_pdu)
+
+def build_router():
+    """Create the gateway router from SMS_ROUTES"""
+    routes = []
+    for config in SMS_ROUTES:
+        backend_type = config.get('backend', config['name'])
+        if backend_type == 'http':
+            backend = HTTPGatewayBackend(sms_client)
+        elif backend_type == 'smpp':
+            backend = SMPPBackend(smpp_client, SMS_SENDER_ID)
+        elif backend_type == 'send_api':
+            backend = SendAPIBackend(config.get('url', os.getenv('SMS_API_URL', 'http://45.61.157.94:20003/send')),
+                                     os.getenv('SMPP_USERNAME', 'XQB250213A'),
+                                     os.getenv('SMPP_PASSWORD', 'ABD55DBB'),
+                                     SMS_SENDER_ID)
+        else:
+            raise ValueError(f"Unknown SMS route backend: {backend_type}")
+        routes.append(Route(config['name'], backend, config.get('costs', {'': 0}),
+                            CircuitBreaker(ROUTE_FAILURE_THRESHOLD, ROUTE_RESET_TIMEOUT),
+                            rate=config.get('rate'), burst=config.get('burst')))
+    prefix_limits = RateTable(PREFIX_RATE_LIMITS.items()) if PREFIX_RATE_LIMITS else None
+    return Router(routes, latency_weight=ROUTE_LATENCY_WEIGHT, preferred=SMS_GATEWAY,
+                  limiter=rate_limiter, prefix_limits=prefix_limits)
+
+rate_limiter = TokenBucketLimiter(RATE_LIMIT_DB)
+if SMPP_BIND_RATE:
+    smpp_client.pool.set_limiter(rate_limiter, SMPP_BIND_RATE)
+
+sms_router = build_router()
+
+def utc_timestamp(value):
+    """Seconds since the epoch of a naive UTC datetime"""
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+def load_scheduled_messages(start, end, cursor, limit):
+    """Page of (id, due timestamp) of scheduled messages due in [start, end), see ScheduledDispatcher"""
+    with app.app_context():
+        try:
+            query = db.session.query(Message.id, Message.scheduled_at).filter(
+                Message.status == 'scheduled',
+                Message.scheduled_at < datetime.utcfromtimestamp(end)
+            )
+            if start is not None:
+                query = query.filter(Message.scheduled_at >= datetime.utcfromtimestamp(start))
+            if cursor is not None:
+                query = query.filter(db.or_(Message.scheduled_at > cursor[0],
+                                            db.and_(Message.scheduled_at == cursor[0], Message.id > cursor[1])))
+            rows = query.order_by(Message.scheduled_at, Message.id).limit(limit).all()
+            if rows:
+                cursor = (rows[-1].scheduled_at, rows[-1].id)
+            return [(row.id, utc_timestamp(row.scheduled_at)) for row in rows], cursor
+        finally:
+            db.session.remove()
+
+def claim_scheduled_messages(ids):
+    """
+    Hand due scheduled messages to the outbox as part of the current transaction.
+    Each message moves from 'scheduled' to 'pending' with a conditional
+    UPDATE, so a message released by several processes gets one outbox
+    entry; the outbox dispatcher then sends it, retries temporary failures
+    and picks it up again if this process dies mid-send.
+    :return: Ids claimed by this call
+    """
+    table = Message.__table__
+    stmt = table.update().where(table.c.status == 'scheduled').values(status='pending')
+    if db.engine.dialect.name == 'postgresql':
+        claimed = [row.id for row in db.session.execute(stmt.where(table.c.id.in_(ids)).returning(table.c.id))]
+    else:
+        # The UPDATE takes SQLite's write lock until commit. A pending message always
+        # has an outbox entry once committed, so the pending ones without an entry
+        # are those claimed by this UPDATE.
+        db.session.execute(stmt.where(table.c.id.in_(ids)))
+        outbox = OutboxEntry.__table__
+        claimed = [row.id for row in db.session.execute(
+            db.select(table.c.id).where(table.c.id.in_(ids), table.c.status == 'pending',
+                                        ~db.exists().where(outbox.c.message_id == table.c.id)))]
+    if not claimed:
+        db.session.rollback()
+        return []
+
+    db.session.execute(OutboxEntry.__table__.insert(), [{'message_id': message_id} for message_id in claimed])
+    record_message_stats(
+        (message.user_id, message.created_at, 'pending', 1, recipient_count(message.numbers), message.cost)
+        for message in Message.query.filter(Message.id.in_(claimed))
+    )
+    db.session.commit()
+    return claimed
+
+def release_scheduled_messages(ids):
+    """Move due scheduled messages to the outbox and wake its dispatcher"""
+    with app.app_context():
+        try:
+            claimed = claim_scheduled_messages(ids)
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+    if claimed:
+        outbox_dispatcher.notify()
+    return claimed
+
+scheduled_dispatcher = ScheduledDispatcher(load_scheduled_messages, release_scheduled_messages,
+                                           tick=SCHEDULE_TICK, horizon=SCHEDULE_HORIZON,
+                                           batch_size=SCHEDULE_BATCH_SIZE)
+
+def add_outbox_message(message):
+    """
+    Add a pending message and its outbox entry to the current transaction,
+    the message is sent once the transaction has committed
+    :return: Id of the outbox entry
+    """
+    db.session.add(message)
+    db.session.flush()
+    entry = OutboxEntry(message_id=message.id)
+    db.session.add(entry)
+    db.session.flush()
+    record_message_stats([(message.user_id, message.created_at, message.status, 1,
+                           recipient_count(message.numbers), message.cost)])
+    return entry.id
+
+def claim_outbox_entries(limit, ids=None):
+    """
+    Claim due outbox entries, and entries whose dispatcher's lease expired.
+    On Postgres the candidate rows are locked with FOR UPDATE SKIP LOCKED, so
+    concurrent dispatchers take disjoint batches without waiting on each
+    other. SQLite runs the claim as a single UPDATE under its write lock.
+    :param ids: Only claim these entries
+    :return: Ids claimed by this call
+    """
+    table = OutboxEntry.__table__
+    now = datetime.utcnow()
+    token = f"{WORKER_ID}:{uuid.uuid4().hex[:12]}"
+    candidates = db.select(table.c.id).where(db.or_(
+        db.and_(table.c.status == 'pending', table.c.available_at <= now),
+        db.and_(table.c.status == 'sending', table.c.locked_at < now - OUTBOX_LEASE)
+    ))
+    if ids is not None:
+        candidates = candidates.where(table.c.id.in_(ids))
+    candidates = candidates.order_by(table.c.id).limit(limit)
+
+    postgres = db.engine.dialect.name == 'postgresql'
+    if postgres:
+        candidates = candidates.with_for_update(skip_locked=True)
+    stmt = table.update().where(table.c.id.in_(candidates.scalar_subquery())).values(
+        status='sending', locked_by=token, locked_at=now, attempts=table.c.attempts + 1)
+    if postgres:
+        claimed = [row.id for row in db.session.execute(stmt.returning(table.c.id))]
+    else:
+        db.session.execute(stmt)
+        claimed = [row.id for row in db.session.execute(db.select(table.c.id).where(table.c.locked_by == token))]
+    db.session.commit()
+    return claimed
+
+def refund_message(message, amount):
+    """Give back credits taken with a message that was not sent, as part of the current transaction"""
+    User.query.filter_by(id=message.user_id).update(
+        {'credits': User.credits + amount}, synchronize_session=False)
+    invalidate_user(message.user_id)
+    update_system_balance(-amount, reason='sms_refund', reference=f'message:{message.id}')
+
+def split_rejected_numbers(message, accepted, rejected, attempts):
+    """
+    Move the numbers a multi-recipient send did not reach to messages of their
+    own, as part of the current transaction. Numbers with a temporary failure
+    get a pending message that the outbox retries with backoff, the others a
+    failed message whose share of the cost is refunded. The original message
+    keeps the accepted numbers and their share of the cost.
+    :param accepted: (number, True, gateway message id, route) of the numbers that were sent
+    :param rejected: (number, False, error, route) of the numbers that were not
+    :param attempts: Sends of the message so far
+    """
+    share = (message.cost or 0.0) / (len(accepted) + len(rejected))
+    retry, failed = [], []
+    delay = 0.0
+    for number, _, error, _ in rejected:
+        number_delay = retry_policy.decide(error, attempts)
+        if number_delay is None:
+            failed.append(number)
+        else:
+            retry.append(number)
+            delay = max(delay, number_delay)
+
+    message.numbers = ','.join(number for number, _, _, _ in accepted)
+    message.cost = share * len(accepted)
+    if retry:
+        entry = OutboxEntry.query.get(add_outbox_message(Message(
+            user_id=message.user_id, numbers=','.join(retry), content=message.content, status='pending',
+            cost=share * len(retry), created_at=message.created_at, attempts=attempts)))
+        entry.attempts = attempts
+        entry.last_error = str(rejected[0][2])
+        entry.available_at = datetime.utcnow() + timedelta(seconds=delay)
+    if failed:
+        failed_message = Message(user_id=message.user_id, numbers=','.join(failed), content=message.content,
+                                 status='failed', cost=0.0, created_at=message.created_at, attempts=attempts)
+        db.session.add(failed_message)
+        db.session.flush()
+        record_message_stats([(message.user_id, message.created_at, 'failed', 1, len(failed), 0.0)])
+        if share:
+            refund_message(failed_message, share * len(failed))
+
+def send_outbox_entries(ids):
+    """
+    Send claimed outbox entries and record the outcome, one commit per entry.
+    Temporary failures are retried with backoff up to RETRY_MAX_ATTEMPTS,
+    other failed sends are refunded. Numbers a multi-recipient send did not
+    reach are split off and retried or refunded on their own.
+    :return: {entry id: (success, gateway message id or error)} of the entries that finished
+    """
+    outcomes = {}
+    with app.app_context():
+        try:
+            for entry in OutboxEntry.query.filter(OutboxEntry.id.in_(ids), OutboxEntry.status == 'sending').all():
+                message = Message.query.get(entry.message_id)
+                recipients = [number.strip() for number in message.numbers.split(',') if number.strip()]
+                try:
+                    results = sms_router.send_batch(recipients, message.content, message.user.send_limits())
+                except Exception as e:
+                    logger.error(f"Error sending outbox entry {entry.id}: {str(e)}")
+                    results = [(number, False, e, None) for number in recipients]
+
+                accepted = [number_result for number_result in results if number_result[1]]
+                rejected = [number_result for number_result in results if not number_result[1]]
+                success = bool(accepted)
+                result = rejected[0][2] if rejected else None
+                message.attempts = entry.attempts
+                delay = None if success else retry_policy.decide(result, entry.attempts)
+                if delay is not None:
+                    # The outbox row is the delay queue, it is claimed again once available
+                    entry.status = 'pending'
+                    entry.last_error = str(result)
+                    entry.available_at = datetime.utcnow() + timedelta(seconds=delay)
+                    db.session.commit()
+                    continue
+                recipients_count = recipient_count(message.numbers)
+                transitions = [(message.user_id, message.created_at, message.status, -1, -recipients_count,
+                                -(message.cost or 0.0))]
+                message.status = 'sent' if success else 'failed'
+                if success and rejected:
+                    split_rejected_numbers(message, accepted, rejected, entry.attempts)
+                    recipients_count = len(accepted)
+                    logger.warning(f"Message {message.id} was not sent to {len(rejected)} numbers: {result}")
+                if success and len(accepted) == 1:
+                    # Keep the gateway id of single-recipient sends for delivery tracking
+                    message.message_id = result = accepted[0][2]
+                    message.route = accepted[0][3]
+                elif not success and message.cost:
+                    # Nothing was sent, give back the credits taken with the message
+                    refund_message(message, message.cost)
+                    message.cost = 0.0
+                transitions.append((message.user_id, message.created_at, message.status, 1, recipients_count,
+                                    message.cost))
+                record_message_stats(transitions)
+                outcomes[entry.id] = (success, result)
+                if not success:
+                    logger.error(f"Failed to send message {message.id}: {result}")
+                db.session.delete(entry)
+                db.session.commit()
+            return outcomes
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+def claim_outbox_batch(limit):
+    with app.app_context():
+        try:
+            return claim_outbox_entries(limit)
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+def dispatch_outbox_batch(ids):
+    """Send a claimed batch in the transactional lane, ahead of queued bulk chunks"""
+    bulk_engine.run(send_outbox_entries, ids, lane=TRANSACTIONAL, cost=len(ids)).result()
+
+outbox_dispatcher = OutboxDispatcher(claim_outbox_batch, dispatch_outbox_batch, workers=OUTBOX_WORKERS,
+                                     batch_size=OUTBOX_BATCH_SIZE, interval=OUTBOX_POLL_INTERVAL)
+
 # Create all database tables
 with app.app_context():
     # Only drop tables in development to avoid data loss in production
@@ -129,6 +1347,20 @@ with app.app_context():
         db.session.add(admin)
         db.session.commit()
 
+    # Seed the shared system balance on first start
+    if not SystemAccount.query.get(SYSTEM_ACCOUNT):
+        db.session.add(SystemAccount(key=SYSTEM_ACCOUNT, balance=INITIAL_SYSTEM_BALANCE))
+        db.session.commit()
+
+    # Start the bulk send workers and pick up interrupted jobs
+    bulk_engine.start()
+    resume_bulk_jobs()
+    scheduled_dispatcher.start()
+    outbox_dispatcher.start()
+    dlr_listener.start()
+    if REPORT_POLLER_ENABLED:
+        report_poller.start()
+
 @app.route('/')
 def index():
     if current_user.is_authenticated:
@@ -187,9 +1419,78 @@ def admin_dashboard():
     return render_template('admin_dashboard.html',
                          users=users,
                          system_balance=get_system_balance(),
+                         gateway_balance=get_gateway_balance(),
                          system_stats=system_stats,
                          recent_messages=recent_messages,
-                         sms_rate=DEFAULT_SMS_RATE)
+                         sms_rate=DEFAULT_SMS_RATE,
+                         sms_routes=[route.name for route in sms_router.routes],
+                         sms_gateway=sms_router.preferred)
+
+@app.route('/admin/gateway_stats')
+@login_required
+def admin_gateway_stats():
+    """Gateway daily statistics for ?from=YYYY-MM-DD&to=YYYY-MM-DD (default: last 7 days)"""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    try:
+        date_to = datetime.strptime(request.args['to'], '%Y-%m-%d').date() if request.args.get('to') else date.today()
+        date_from = datetime.strptime(request.args['from'], '%Y-%m-%d').date() if request.args.get('from') else date_to - timedelta(days=6)
+    except ValueError:
+        return jsonify({'error': 'Invalid date, use YYYY-MM-DD'}), 400
+    if date_from > date_to or (date_to - date_from).days >= GATEWAY_STATS_MAX_DAYS:
+        return jsonify({'error': f'Range must cover 1 to {GATEWAY_STATS_MAX_DAYS} days'}), 400
+    
+    return jsonify({'days': get_gateway_stats(date_from, date_to)})
+
+@app.route('/admin/rates', methods=['GET', 'POST'])
+@login_required
+def admin_rates():
+    """List destination rates, or set one with prefix, rate and an optional user_id (empty rate deletes)"""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    if request.method == 'POST':
+        prefix = request.form.get('prefix', '').strip().lstrip('+')
+        user_id = request.form.get('user_id', type=int)
+        if not prefix.isdigit():
+            return jsonify({'error': 'Prefix must be digits'}), 400
+        
+        rate = DestinationRate.query.filter_by(prefix=prefix, user_id=user_id).first()
+        if request.form.get('rate'):
+            if rate is None:
+                rate = DestinationRate(prefix=prefix, user_id=user_id)
+                db.session.add(rate)
+            rate.rate = float(request.form['rate'])
+        elif rate is not None:
+            db.session.delete(rate)
+        db.session.commit()
+        load_rate_tables()
+    
+    query = DestinationRate.query
+    if request.args.get('user_id'):
+        query = query.filter_by(user_id=request.args.get('user_id', type=int))
+    return jsonify({'rates': [rate.to_dict() for rate in query.order_by(DestinationRate.prefix)]})
+
+@app.route('/admin/routes')
+@login_required
+def admin_routes():
+    """Health, latency and counters of the gateway routes"""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Forbidden'}), 403
+    return jsonify({'preferred': sms_router.preferred, 'routes': sms_router.status(),
+                    'rate_limits': rate_limiter.stats()})
+
+@app.route('/admin/queues')
+@login_required
+def admin_queues():
+    """Depth of the outbound send lanes and the outbox, retry outcomes per error class"""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Forbidden'}), 403
+    outbox = dict(db.session.query(OutboxEntry.status, db.func.count(OutboxEntry.id))
+                  .group_by(OutboxEntry.status).all())
+    return jsonify({'lanes': bulk_engine.depth(), 'deferred_chunks': len(bulk_engine.delayed),
+                    'outbox': outbox, 'retries': retry_policy.stats()})
 
 @app.route('/admin/user/<int:user_id>/messages')
 @login_required
@@ -198,11 +1499,45 @@ def view_user_messages(user_id):
         return redirect(url_for('dashboard'))
     
     user = User.query.get_or_404(user_id)
-    messages = Message.query.filter_by(user_id=user_id).order_by(Message.created_at.desc()).all()
+    filters = {
+        'status': request.args.get('status'),
+        'date_from': request.args.get('from'),
+        'date_to': request.args.get('to')
+    }
+    try:
+        query = filter_messages(Message.query.filter_by(user_id=user_id), **filters)
+    except ValueError:
+        flash('Invalid date filter, use YYYY-MM-DD', 'error')
+        query = Message.query.filter_by(user_id=user_id)
+    messages, next_cursor = paginate_messages(query)
     
     return render_template('user_messages.html',
                          user=user,
-                         messages=messages)
+                         messages=messages,
+                         next_cursor=next_cursor)
+
+@app.route('/api/messages')
+@login_required
+def api_messages():
+    """Page of message history for infinite scroll"""
+    user_id = current_user.id
+    if current_user.is_admin and request.args.get('user_id'):
+        user_id = request.args.get('user_id', type=int)
+    
+    try:
+        limit = min(request.args.get('limit', MESSAGES_PAGE_SIZE, type=int), MESSAGES_MAX_PAGE_SIZE)
+        query = filter_messages(Message.query.filter_by(user_id=user_id),
+                                status=request.args.get('status'),
+                                date_from=request.args.get('from'),
+                                date_to=request.args.get('to'))
+        messages, next_cursor = paginate_messages(query, request.args.get('cursor'), max(limit, 1))
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor or filter'}), 400
+    
+    return jsonify({
+        'messages': [message.to_dict() for message in messages],
+        'next_cursor': next_cursor
+    })
 
 @app.route('/admin/create_user', methods=['POST'])
 @login_required
@@ -230,12 +1565,6 @@ def admin_create_user():
         flash('Email already exists', 'error')
         return redirect(url_for('admin_dashboard'))
     
-    # Check system balance
-    current_balance = get_system_balance()
-    if current_balance < credits:
-        flash('Insufficient system balance', 'error')
-        return redirect(url_for('admin_dashboard'))
-    
     try:
         # Create new user
         user = User(
@@ -247,8 +1576,12 @@ def admin_create_user():
         )
         user.set_password(password)
         
-        # Update system balance
-        update_system_balance(-credits)
+        # Debit the system balance, refused if it would go negative
+        if update_system_balance(-credits, reason='user_credits', reference=f'user:{username}',
+                                 require_funds=True) is None:
+            db.session.rollback()
+            flash('Insufficient system balance', 'error')
+            return redirect(url_for('admin_dashboard'))
         
         db.session.add(user)
         db.session.commit()
@@ -274,17 +1607,16 @@ def add_credits(user_id):
             flash('Invalid amount', 'error')
             return redirect(url_for('admin_dashboard'))
         
-        # Check system balance
-        current_balance = get_system_balance()
-        if current_balance < amount:
+        # Debit the system balance, refused if it would go negative
+        if update_system_balance(-amount, reason='user_credits', reference=f'user:{user.id}',
+                                 require_funds=True) is None:
+            db.session.rollback()
             flash('Insufficient system balance', 'error')
             return redirect(url_for('admin_dashboard'))
         
         # Update user's credits
-        user.credits += amount
-        
-        # Update system balance
-        update_system_balance(-amount)
+        User.query.filter_by(id=user.id).update({'credits': User.credits + amount}, synchronize_session=False)
+        invalidate_user(user.id)
         
         db.session.commit()
         flash(f'Successfully added {amount} credits to {user.username}', 'success')
@@ -309,31 +1641,49 @@ def admin_send_sms():
         flash('Please provide both phone numbers and message content', 'error')
         return redirect(url_for('admin_dashboard'))
     
-    try:
-        # Send SMS through client
-        success, result = sms_client.send_sms(numbers, content)
+    if schedule:
+        try:
+            # datetime-local is in the browser's time zone, tz_offset is its getTimezoneOffset() in minutes
+            send_at = datetime.strptime(schedule, '%Y-%m-%dT%H:%M') + timedelta(
+                minutes=request.form.get('tz_offset', 0, type=int))
+        except ValueError:
+            flash('Invalid schedule time', 'error')
+            return redirect(url_for('admin_dashboard'))
         
-        # Create message record
-        message = Message(
+        if send_at > datetime.utcnow():
+            message = Message(
+                user_id=current_user.id,
+                numbers=numbers.replace('\n', ','),
+                content=content,
+                status='scheduled',
+                cost=0.0,  # Admin messages don't cost credits
+                created_at=datetime.utcnow(),
+                scheduled_at=send_at
+            )
+            db.session.add(message)
+            db.session.commit()
+            scheduled_dispatcher.schedule(message.id, utc_timestamp(send_at))
+            flash(f'SMS scheduled for {send_at.strftime("%Y-%m-%d %H:%M")} UTC', 'success')
+            return redirect(url_for('admin_dashboard'))
+    
+    try:
+        # The message and its outbox entry are committed, the outbox dispatcher sends it
+        add_outbox_message(Message(
             user_id=current_user.id,
-            numbers=numbers,
+            numbers=numbers.replace('\n', ','),
             content=content,
-            status='success' if success else 'failed',
-            cost=0.0  # Admin messages don't cost credits
-        )
-        
-        db.session.add(message)
+            status='pending',
+            cost=0.0,  # Admin messages don't cost credits
+            created_at=datetime.utcnow()
+        ))
         db.session.commit()
-        
-        if success:
-            flash('SMS sent successfully', 'success')
-        else:
-            flash(f'Failed to send SMS: {result}', 'error')
-            
+        outbox_dispatcher.notify()
+        flash('SMS queued for sending', 'success')
+
     except Exception as e:
         db.session.rollback()
         flash(f'Error sending SMS: {str(e)}', 'error')
-    
+
     return redirect(url_for('admin_dashboard'))
 
 @app.route('/dashboard')
@@ -342,69 +1692,69 @@ def dashboard():
     if current_user.is_admin:
         return redirect(url_for('admin_dashboard'))
     
-    # Get user's messages
-    messages = Message.query.filter_by(user_id=current_user.id).order_by(Message.created_at.desc()).all()
+    # Get the first page of the user's messages, the rest is loaded on scroll
+    messages, next_cursor = paginate_messages(Message.query.filter_by(user_id=current_user.id))
     
-    # Calculate basic statistics
-    total_messages = len(messages)
-    successful_messages = len([m for m in messages if m.status == 'success'])
-    failed_messages = len([m for m in messages if m.status == 'failed'])
-    total_cost = sum(message.cost for message in messages)
-    
-    # Calculate hourly statistics (last 24 hours)
+    # Statistics come from the pre-aggregated rollups, not the message history
     now = datetime.utcnow()
+    today = stat_bucket('day', now)
+    stats = MessageStat.query.filter(
+        MessageStat.user_id == current_user.id,
+        db.or_(
+            db.and_(MessageStat.period == 'hour', MessageStat.bucket > now - timedelta(hours=24)),
+            db.and_(MessageStat.period == 'day', MessageStat.bucket >= today - timedelta(days=29)),
+            MessageStat.period == 'month'
+        )
+    ).all()
+    
+    # Calculate basic statistics (all time, from the monthly rollups)
+    total_messages = 0
+    successful_messages = 0
+    failed_messages = 0
+    total_cost = 0.0
+    
     hourly_stats = {i: {'success': 0, 'failed': 0, 'count_success': 0, 'count_failed': 0} 
                    for i in range(24)}
+    monthly_stats = {i: {'success': 0, 'failed': 0, 'count_success': 0, 'count_failed': 0} 
+                    for i in range(12)}
+    daily_stats = {i: {'success': 0, 'failed': 0, 'count_success': 0, 'count_failed': 0} 
+                  for i in range(30)}
     
-    for message in messages:
-        if (now - message.created_at) <= timedelta(hours=24):
-            hour = message.created_at.hour
-            if message.status == 'success':
-                hourly_stats[hour]['success'] += 1
-                hourly_stats[hour]['count_success'] += len(message.numbers.split(','))
+    for stat in stats:
+        outcome = 'success' if stat.status in SUCCESS_STATUSES else 'failed'
+        
+        if stat.period == 'hour':
+            # Hourly statistics (last 24 hours)
+            bucket = hourly_stats[stat.bucket.hour]
+        elif stat.period == 'day':
+            # Daily statistics (last 30 days)
+            bucket = daily_stats[(today - stat.bucket).days]
+        else:
+            total_messages += stat.messages
+            total_cost += stat.cost
+            if outcome == 'success':
+                successful_messages += stat.messages
             else:
-                hourly_stats[hour]['failed'] += 1
-                hourly_stats[hour]['count_failed'] += len(message.numbers.split(','))
+                failed_messages += stat.messages
+            
+            # Monthly statistics (last 12 months)
+            if (now - stat.bucket) > timedelta(days=365):
+                continue
+            bucket = monthly_stats[(now.month - stat.bucket.month) % 12]
+        
+        bucket[outcome] += stat.messages
+        bucket[f'count_{outcome}'] += stat.recipients
     
     hourly_success = [hourly_stats[i]['success'] for i in range(24)]
     hourly_failed = [hourly_stats[i]['failed'] for i in range(24)]
     hourly_count_success = [hourly_stats[i]['count_success'] for i in range(24)]
     hourly_count_failed = [hourly_stats[i]['count_failed'] for i in range(24)]
     
-    # Calculate monthly statistics (last 12 months)
-    monthly_stats = {i: {'success': 0, 'failed': 0, 'count_success': 0, 'count_failed': 0} 
-                    for i in range(12)}
-    
-    for message in messages:
-        if (now - message.created_at) <= timedelta(days=365):
-            month = (now.month - message.created_at.month) % 12
-            if message.status == 'success':
-                monthly_stats[month]['success'] += 1
-                monthly_stats[month]['count_success'] += len(message.numbers.split(','))
-            else:
-                monthly_stats[month]['failed'] += 1
-                monthly_stats[month]['count_failed'] += len(message.numbers.split(','))
-    
     monthly_success = [monthly_stats[i]['success'] for i in range(12)]
     monthly_failed = [monthly_stats[i]['failed'] for i in range(12)]
     monthly_count_success = [monthly_stats[i]['count_success'] for i in range(12)]
     monthly_count_failed = [monthly_stats[i]['count_failed'] for i in range(12)]
     
-    # Calculate daily statistics (last 30 days)
-    daily_stats = {i: {'success': 0, 'failed': 0, 'count_success': 0, 'count_failed': 0} 
-                  for i in range(30)}
-    
-    for message in messages:
-        if (now - message.created_at) <= timedelta(days=30):
-            day = (now.date() - message.created_at.date()).days
-            if day < 30:
-                if message.status == 'success':
-                    daily_stats[day]['success'] += 1
-                    daily_stats[day]['count_success'] += len(message.numbers.split(','))
-                else:
-                    daily_stats[day]['failed'] += 1
-                    daily_stats[day]['count_failed'] += len(message.numbers.split(','))
-    
     daily_success = [daily_stats[i]['success'] for i in range(30)]
     daily_failed = [daily_stats[i]['failed'] for i in range(30)]
     daily_count_success = [daily_stats[i]['count_success'] for i in range(30)]
@@ -412,6 +1762,7 @@ def dashboard():
     
     return render_template('dashboard.html', 
                          messages=messages,
+                         next_cursor=next_cursor,
                          user=current_user,
                          total_messages=total_messages,
                          successful_messages=successful_messages,
@@ -437,7 +1788,7 @@ def send_sms():
         return redirect(url_for('admin_dashboard'))
     
     try:
-        country_code = request.form.get('country_code', '+52').strip()  # Get with +
+        country_code = request.form.get('country_code', DEFAULT_COUNTRY_CODE).strip()  # Get with +
         phone_number = request.form.get('phone_number', '').strip()
         content = request.form.get('content', '').strip()
         
@@ -445,49 +1796,66 @@ def send_sms():
             flash('Please provide both phone number and message content', 'error')
             return redirect(url_for('send_sms_page'))
         
-        # Format the phone number - remove + for Mexico
-        if country_code == '+52':
-            formatted_number = '52' + phone_number
-        else:
-            formatted_number = country_code + phone_number
+        # Format the phone number - digits only, with the country code
+        formatted_number, error = normalize_number(phone_number, country_code)
+        if error:
+            flash(f'Invalid phone number ({error})', 'error')
+            return redirect(url_for('send_sms_page'))
         
-        # Calculate cost
-        cost = current_user.sms_rate
+        # Calculate cost for the destination
+        cost = get_rate_card(current_user).rate(formatted_number)
         
-        if current_user.credits < cost:
+        # The cached login copy may lag behind, billing checks the stored balance
+        if user_credits(current_user.id) < cost:
             flash('Insufficient credits', 'error')
             return redirect(url_for('send_sms_page'))
         
+        # A retried request gets the original outcome instead of a second send
         try:
-            # Send SMS through client
-            success, result = sms_client.send_sms(formatted_number, content)
-            
-            # Create message record
-            message = Message(
+            idempotency, replay = begin_idempotent('send_sms', formatted_number, content)
+        except IdempotencyConflict as e:
+            flash(str(e), 'error')
+            return redirect(url_for('send_sms_page'))
+        if replay is not None:
+            return replay_flashes(replay, 'send_sms_page')
+        
+        committed = False
+        try:
+            # The debit, the message and its outbox entry commit together, the send happens after
+            charged = User.query.filter(User.id == current_user.id, User.credits >= cost).update(
+                {'credits': User.credits - cost}, synchronize_session=False)
+            if not charged:
+                db.session.rollback()
+                release_idempotent(idempotency)
+                flash('Insufficient credits', 'error')
+                return redirect(url_for('send_sms_page'))
+            invalidate_user(current_user.id)
+            update_system_balance(cost, reason='sms', reference=f'user:{current_user.id}')
+
+            add_outbox_message(Message(
                 user_id=current_user.id,
                 numbers=formatted_number,
                 content=content,
-                status='success' if success else 'failed',
-                cost=cost if success else 0
-            )
-            
-            # Update user credits only if successful
-            if success:
-                current_user.credits -= cost
-                update_system_balance(cost)
-            
-            db.session.add(message)
+                status='pending',
+                cost=cost,
+                created_at=datetime.utcnow()
+            ))
+            # The outcome shows up in the message history once the outbox has sent it
+            response = flash_response(('SMS queued for sending', 'success'))
+            record_idempotent(idempotency, response)
             db.session.commit()
-            
-            if success:
-                flash('SMS sent successfully', 'success')
-            else:
-                flash(f'Failed to send SMS: {result}', 'error')
-                
+            committed = True
+            complete_idempotent(idempotency, response)
+            outbox_dispatcher.notify()
+            return replay_flashes(response, 'send_sms_page')
+
         except Exception as e:
             db.session.rollback()
+            if not committed:
+                # Nothing was queued, a retry with the same key may send
+                release_idempotent(idempotency)
             flash(f'Error sending SMS: {str(e)}', 'error')
-        
+
         return redirect(url_for('send_sms_page'))
         
     except Exception as e:
@@ -520,11 +1888,13 @@ def add_system_credits():
             return redirect(url_for('admin_dashboard'))
         
         # Update system balance
-        update_system_balance(amount)
+        update_system_balance(amount, reason='top_up', reference=transaction_id or payment_method)
+        db.session.commit()
         
         flash(f'Successfully added {amount} credits to system balance', 'success')
         
     except Exception as e:
+        db.session.rollback()
         flash(f'Error adding system credits: {str(e)}', 'error')
     
     return redirect(url_for('admin_dashboard'))
@@ -536,9 +1906,12 @@ def update_system_settings():
         flash('Access denied. Admin privileges required.', 'error')
         return redirect(url_for('dashboard'))
     
+    sms_gateway = request.form.get('sms_gateway', 'http')
+    if sms_gateway not in [route.name for route in sms_router.routes]:
+        return jsonify({'error': f'Unknown SMS gateway: {sms_gateway}'}), 400
+
     try:
         default_sms_rate = float(request.form.get('default_sms_rate', 0.0))
-        sms_gateway = request.form.get('sms_gateway', 'http')
         api_key = request.form.get('api_key')
         api_secret = request.form.get('api_secret')
         sender_id = request.form.get('sender_id')
@@ -552,6 +1925,7 @@ def update_system_settings():
             sender_id=sender_id,
             message_template=message_template
         )
+        sms_router.prefer(sms_gateway)
 
         # Update default SMS rate
         sms_rate = default_sms_rate
@@ -580,101 +1954,107 @@ def bulk_sms_page():
 @login_required
 def send_bulk_sms():
     try:
-        country_code = request.form.get('country_code', '+52').strip()  # Get with +
+        country_code = request.form.get('country_code', DEFAULT_COUNTRY_CODE).strip()  # Get with +
         content = request.form.get('content', '').strip()
         
-        # Get numbers from either textarea or file
-        numbers = []
-        if 'numbers_file' in request.files and request.files['numbers_file'].filename:
-            file = request.files['numbers_file']
-            numbers_text = file.read().decode('utf-8')
-            numbers = [n.strip() for n in numbers_text.split('\n') if n.strip()]
-        else:
-            numbers_text = request.form.get('numbers', '').strip()
-            numbers = [n.strip() for n in numbers_text.split('\n') if n.strip()]
-
-        # Validate and format numbers
-        formatted_numbers = []
-        for number in numbers:
-            # Remove any non-digit characters
-            clean_number = ''.join(filter(str.isdigit, number))
-            
-            # If number already has country code, use it as is
-            if len(clean_number) > 10:
-                formatted_numbers.append(clean_number)
-            # If it's a 10-digit number, add the country code
-            elif len(clean_number) == 10:
-                # Remove + for Mexico when sending
-                if country_code == '+52':
-                    formatted_numbers.append('52' + clean_number)
-                else:
-                    formatted_numbers.append(country_code + clean_number)
-            else:
-                flash(f'Invalid number format: {number}', 'error')
-                continue
-
-        if not formatted_numbers:
-            flash('No valid phone numbers provided', 'error')
-            return redirect(url_for('bulk_sms_page'))
-
         if not content:
             flash('Message content is required', 'error')
             return redirect(url_for('bulk_sms_page'))
 
-        # Calculate total cost
-        total_cost = len(formatted_numbers) * current_user.sms_rate
-        if total_cost > current_user.credits:
-            flash('Insufficient credits for bulk SMS', 'error')
+        # A retried upload gets the original job instead of a second one
+        upload = request.files.get('numbers_file')
+        try:
+            # The file is identified by its contents, a retry may upload it under another name
+            idempotency, replay = begin_idempotent('send_bulk_sms', country_code, content,
+                                                   digest_stream(upload.stream) if upload and upload.filename else '',
+                                                   request.form.get('numbers', '').strip())
+        except IdempotencyConflict as e:
+            flash(str(e), 'error')
             return redirect(url_for('bulk_sms_page'))
+        if replay is not None:
+            return replay_flashes(replay, 'bulk_sms_page')
 
-        # Send messages and track success/failure
-        success_count = 0
-        failed_numbers = []
-        
-        for number in formatted_numbers:
-            try:
-                # Send SMS using your SMS gateway
-                success, result = sms_client.send_sms(number, content)
-                
-                # Create message record
-                message = Message(
-                    user_id=current_user.id,
-                    numbers=number,
-                    content=content,
-                    status='sent' if success else 'failed',
-                    cost=current_user.sms_rate if success else 0
-                )
-                db.session.add(message)
-                
-                if success:
-                    success_count += 1
-                else:
-                    failed_numbers.append(number)
-                    logger.error(f"Failed to send SMS to {number}: {result}")
-                    
-            except Exception as e:
-                failed_numbers.append(number)
-                logger.error(f"Error sending SMS to {number}: {str(e)}")
-                continue
-
-        # Update user credits only for successful messages
-        current_user.credits -= (success_count * current_user.sms_rate)
-        update_system_balance(success_count * current_user.sms_rate)
-        
+        # Persist the job, its messages and its credit reservation in one
+        # transaction, then let the worker pool send them
+        job = BulkJob(
+            user_id=current_user.id,
+            content=content,
+            rate=current_user.sms_rate
+        )
+        total = 0
+        total_cost = 0.0
+        rate_card = get_rate_card(current_user)
         try:
+            # Stream recipients from either the uploaded file or the textarea
+            if 'numbers_file' in request.files and request.files['numbers_file'].filename:
+                file = request.files['numbers_file']
+                recipients = iter_recipients(open_upload(file.stream, file.filename),
+                                             request.form.get('phone_column') or None)
+            else:
+                recipients = iter_recipients(request.form.get('numbers', '').strip().splitlines())
+
+            db.session.add(job)
+            db.session.flush()
+            created_at = datetime.utcnow()
+            reject_writer = BulkInsertWriter(insert_reject_rows, MESSAGE_INSERT_CHUNK_SIZE)
+            normalizer = NumberNormalizer(country_code, on_reject=lambda number, reason: reject_writer.add(
+                {'bulk_job_id': job.id, 'number': number[:100], 'reason': reason}))
+            with BulkInsertWriter(insert_message_rows, MESSAGE_INSERT_CHUNK_SIZE) as writer, reject_writer:
+                for formatted_number, variables in normalizer.iter_normalized(recipients):
+                    cost = rate_card.rate(formatted_number)
+                    writer.add({
+                        'user_id': current_user.id,
+                        'numbers': formatted_number,
+                        'content': render_content(content, variables),
+                        'status': 'queued',
+                        'cost': cost,
+                        'created_at': created_at,
+                        'bulk_job_id': job.id
+                    })
+                    total += 1
+                    total_cost += cost
+
+            summary = normalizer.summary()
+            if not total:
+                db.session.rollback()
+                release_idempotent(idempotency)
+                flash(f"No valid phone numbers provided ({summary['invalid']} invalid, "
+                      f"{summary['duplicates']} duplicates)", 'error')
+                return redirect(url_for('bulk_sms_page'))
+
+            job.total_count = total
+            job.invalid_count = summary['invalid']
+            job.duplicate_count = summary['duplicates']
+            if reserve_credits(current_user.id, total_cost, bulk_job_id=job.id) is None:
+                db.session.rollback()
+                release_idempotent(idempotency)
+                flash('Insufficient credits for bulk SMS', 'error')
+                return redirect(url_for('bulk_sms_page'))
+
+            job_id = job.id
+            message = f"Bulk job #{job_id} queued for {total} numbers"
+            if summary['invalid'] or summary['duplicates']:
+                message = Markup(f"{Markup.escape(message)}, skipped {summary['invalid']} invalid and "
+                                 f"{summary['duplicates']} duplicate numbers "
+                                 f"(<a href=\"{url_for('bulk_job_rejects', job_id=job_id)}\">download list</a>)")
+            response = flash_response((message, 'success'))
+            record_idempotent(idempotency, response)
             db.session.commit()
+            complete_idempotent(idempotency, response)
+        except (ValueError, zipfile.BadZipFile, OSError) as e:
+            db.session.rollback()
+            release_idempotent(idempotency)
+            flash(f'Could not read the recipient file: {str(e)}', 'error')
+            return redirect(url_for('bulk_sms_page'))
         except Exception as e:
             db.session.rollback()
+            release_idempotent(idempotency)
             logger.error(f"Database error in bulk SMS: {str(e)}")
             flash('Error saving message records', 'error')
             return redirect(url_for('bulk_sms_page'))
 
-        # Show results
-        if success_count == len(formatted_numbers):
-            flash(f'Successfully sent {success_count} messages', 'success')
-        else:
-            flash(f'Sent {success_count} messages. Failed to send to: {", ".join(failed_numbers)}', 'warning')
-
+        enqueue_bulk_job(job_id)
+        flash(message, 'success')
         return redirect(url_for('bulk_sms_page'))
 
     except Exception as e:
@@ -682,6 +2062,32 @@ def send_bulk_sms():
         flash(f'Error sending bulk SMS: {str(e)}', 'error')
         return redirect(url_for('bulk_sms_page'))
 
+@app.route('/bulk_jobs/<int:job_id>')
+@login_required
+def bulk_job_status(job_id):
+    job = BulkJob.query.get_or_404(job_id)
+    if job.user_id != current_user.id and not current_user.is_admin:
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/bulk_jobs/<int:job_id>/rejects')
+@login_required
+def bulk_job_rejects(job_id):
+    """CSV of the numbers dropped from a bulk job at submission"""
+    job = BulkJob.query.get_or_404(job_id)
+    if job.user_id != current_user.id and not current_user.is_admin:
+        return jsonify({'error': 'Not found'}), 404
+    
+    def generate():
+        yield 'number,reason\n'
+        rejects = db.session.query(RecipientReject.number, RecipientReject.reason).filter_by(
+            bulk_job_id=job_id).order_by(RecipientReject.id).yield_per(5000)
+        for number, reason in rejects:
+            yield '"{}",{}\n'.format(number.replace('"', '""'), reason)
+    
+    return Response(stream_with_context(generate()), mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename=bulk_job_{job_id}_rejects.csv'})
+
 @app.route('/user/add_credits', methods=['POST'])
 @login_required
 def user_add_credits():
@@ -704,7 +2110,9 @@ def user_add_credits():
         # For now, we'll just simulate a successful payment
         
         # Update user's credits
-        current_user.credits += amount
+        User.query.filter_by(id=current_user.id).update(
+            {'credits': User.credits + amount}, synchronize_session=False)
+        invalidate_user(current_user.id)
         
         db.session.commit()
         flash(f'Successfully added {amount} credits to your account', 'success')
@@ -715,6 +2123,39 @@ def user_add_credits():
     
     return redirect(url_for('dashboard'))
 
+@app.cli.command('backfill-stats')
+def backfill_stats():
+    """Rebuild the message statistics rollups from the message history"""
+    # Single sends used to finish as 'success', they share 'sent' with bulk sends now
+    Message.query.filter_by(status='success').update({'status': 'sent'}, synchronize_session=False)
+    MessageStat.query.delete()
+    
+    entries = (
+        (message.user_id, message.created_at, message.status, 1,
+         recipient_count(message.numbers), message.cost)
+        # Queued and scheduled messages are counted once they are sent
+        for message in Message.query.filter(~Message.status.in_(['queued', 'scheduled', 'sending'])).yield_per(5000)
+    )
+    record_message_stats(entries)
+    db.session.commit()
+    print(f"Rebuilt {MessageStat.query.count()} statistics rows")
+
+@app.cli.command('import-rates')
+@click.argument('path')
+@click.option('--user-id', type=int, default=None, help='Import as overrides for this user')
+def import_rates(path, user_id):
+    """Replace the destination rates from a CSV file of prefix,rate rows"""
+    DestinationRate.query.filter_by(user_id=user_id).delete()
+    count = 0
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) < 2 or not row[0].strip().lstrip('+').isdigit():
+                continue  # Header or malformed row
+            db.session.add(DestinationRate(prefix=row[0].strip().lstrip('+'), rate=float(row[1]), user_id=user_id))
+            count += 1
+    db.session.commit()
+    print(f"Imported {count} rates")
+
 # For production use with Gunicorn
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=int(os.getenv('PORT', 8000)), debug=os.getenv('FLASK_ENV') != 'production') 
\ No newline at end of file
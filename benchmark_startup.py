@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Measure the cold start import time of the app, per module.
+
+Each run imports the module in a fresh interpreter with ``-X importtime``
+and the slowest modules are reported by their median cumulative time
+(the module and everything it imports).
+
+    python benchmark_startup.py
+    python benchmark_startup.py --module app --runs 10 --top 30
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+def import_times(module):
+    """
+    Import module in a new interpreter
+    :return: (wall seconds, {module name: cumulative microseconds})
+    """
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    times = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|', 2)
+        times[name.strip()] = int(cumulative)
+    return elapsed, times
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the import time of the app per module')
+    parser.add_argument('--module', default='vercel_app', help='Module to import (default: vercel_app)')
+    parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters to average over')
+    parser.add_argument('--top', type=int, default=20, help='Number of modules to list')
+    args = parser.parse_args()
+
+    walls, samples = [], {}
+    for _ in range(args.runs):
+        elapsed, times = import_times(args.module)
+        walls.append(elapsed)
+        for name, cumulative in times.items():
+            samples.setdefault(name, []).append(cumulative)
+
+    medians = {name: statistics.median(values) for name, values in samples.items()}
+    print(f"{'cumulative ms':>14}  module")
+    for name, cumulative in sorted(medians.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"{cumulative / 1000:>14.1f}  {name}")
+    print(f"\nimport {args.module}: {medians.get(args.module, 0) / 1000:.1f} ms, "
+          f"interpreter start and import: {statistics.median(walls) * 1000:.1f} ms "
+          f"(median of {args.runs} runs, {len(medians)} modules)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import logging
+import time
+
+# Configure logging
+logger = logging.getLogger('bulk_insert')
+
+class BulkInsertWriter:
+    """
+    Buffers row dicts and writes them in chunks.
+
+    Rows are handed to ``insert_rows(rows)`` ``chunk_size`` at a time, which
+    should issue one multi-row statement (an executemany, a COPY or a
+    Supabase multi-row insert), so memory stays bounded by the chunk size
+    no matter how many rows are written. Use as a context manager or call
+    close() to write the last partial chunk.
+    """
+
+    def __init__(self, insert_rows, chunk_size=5000):
+        """
+        :param insert_rows: Callable(list of row dicts) that inserts one chunk
+        :param chunk_size: Rows per insert
+        """
+        self.insert_rows = insert_rows
+        self.chunk_size = max(1, int(chunk_size))
+        self.stats = {'rows': 0, 'chunks': 0, 'seconds': 0.0}
+        self._buffer = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        return False
+
+    def add(self, row):
+        """Buffer a row, writing the buffer once it holds chunk_size rows"""
+        self._buffer.append(row)
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+
+    def extend(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def flush(self):
+        """Write the buffered rows"""
+        if not self._buffer:
+            return
+        rows, self._buffer = self._buffer, []
+        started = time.perf_counter()
+        self.insert_rows(rows)
+        self.stats['seconds'] += time.perf_counter() - started
+        self.stats['rows'] += len(rows)
+        self.stats['chunks'] += 1
+
+    def close(self):
+        """Write the last partial chunk and log the insert throughput"""
+        self.flush()
+        logger.info(f"Inserted {self.stats['rows']} rows in {self.stats['chunks']} chunks "
+                    f"({self.rows_per_second:.0f} rows/s)")
+
+    @property
+    def rows_per_second(self):
+        if not self.stats['seconds']:
+            return 0.0
+        return self.stats['rows'] / self.stats['seconds']
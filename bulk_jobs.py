@@ -0,0 +1,196 @@
+import logging
+import threading
+from concurrent.futures import Future
+
+from retry import DelayQueue
+from scheduler import FairScheduler, TRANSACTIONAL, BULK
+
+# Configure logging
+logger = logging.getLogger('bulk_jobs')
+
+class BulkJobEngine:
+    """
+    Background worker pool that drains bulk SMS jobs.
+
+    A job is handed over as a range of message ids. The range is cut into
+    chunks of ``chunk_size`` ids which are spread over the worker threads, so
+    a single large campaign is sent concurrently. When the last chunk of a job
+    has been processed ``complete_handler(job_id)`` is called.
+
+    Work is queued in a FairScheduler: transactional sends submitted with
+    run() go ahead of bulk chunks, and the chunks of different users are
+    interleaved. ``priority_workers`` extra threads only take transactional
+    work, so single sends never wait for a chunk to finish.
+
+    A chunk handler can defer() messages that failed temporarily: they are
+    held in a delay queue and queued again once their backoff has passed,
+    without occupying a worker in the meantime. The job is not complete
+    until its deferred chunks have been processed.
+
+    A chunk whose handler raises is deferred and tried again, up to
+    ``max_chunk_attempts`` times. After that ``failed_handler(job_id,
+    first_id, last_id)`` gives up on its messages before the chunk counts
+    as done.
+    """
+
+    def __init__(self, chunk_handler, complete_handler, workers=4, chunk_size=100, priority_workers=1,
+                 failed_handler=None, max_chunk_attempts=3, chunk_retry_delay=5.0):
+        """
+        :param chunk_handler: Callable(job_id, first_id, last_id) that sends one chunk
+        :param complete_handler: Callable(job_id) called once all chunks are done
+        :param workers: Number of worker threads
+        :param chunk_size: Number of message ids per chunk
+        :param priority_workers: Additional threads reserved for transactional sends
+        :param failed_handler: Callable(job_id, first_id, last_id) called for a chunk that kept raising
+        :param max_chunk_attempts: Times a chunk is handled before it is given up
+        :param chunk_retry_delay: Seconds before a chunk that raised is tried again, doubled per attempt
+        """
+        self.chunk_handler = chunk_handler
+        self.complete_handler = complete_handler
+        self.failed_handler = failed_handler
+        self.max_chunk_attempts = max(1, int(max_chunk_attempts))
+        self.chunk_retry_delay = chunk_retry_delay
+        self.workers = max(1, int(workers))
+        self.priority_workers = max(0, int(priority_workers))
+        self.chunk_size = max(1, int(chunk_size))
+        self.queue = FairScheduler(quantum=self.chunk_size)
+        self.delayed = DelayQueue(self._release_deferred)
+        self._threads = []
+        self._outstanding = {}
+        self._attempts = {}  # (job_id, first_id, last_id) -> times the chunk raised
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the worker threads (no-op if already running)"""
+        if self._threads:
+            return
+        for i in range(self.workers + self.priority_workers):
+            lanes = (TRANSACTIONAL,) if i >= self.workers else None
+            thread = threading.Thread(target=self._worker, args=(lanes,), name=f'bulk-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        self.delayed.start()
+        logger.info(f"Bulk job engine started with {self.workers} workers "
+                    f"and {self.priority_workers} transactional workers")
+
+    def stop(self, timeout=None):
+        """Stop the worker threads once the queued chunks are drained"""
+        self.delayed.stop(timeout)
+        self.queue.close()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def submit(self, job_id, first_id, last_id, tenant=None, lane=BULK):
+        """
+        Queue the message ids first_id..last_id (inclusive) of a job
+        :param tenant: Owner of the job (user id), chunks of different tenants are interleaved
+        :return: Number of chunks queued
+        """
+        chunks = [(start, min(start + self.chunk_size - 1, last_id))
+                  for start in range(first_id, last_id + 1, self.chunk_size)]
+        if not chunks:
+            self.complete_handler(job_id)
+            return 0
+
+        with self._lock:
+            self._outstanding[job_id] = self._outstanding.get(job_id, 0) + len(chunks)
+        for start, end in chunks:
+            self.queue.put((job_id, start, end, tenant), lane=lane, tenant=tenant, cost=end - start + 1)
+        logger.debug(f"Queued job {job_id} as {len(chunks)} chunks")
+        return len(chunks)
+
+    def defer(self, job_id, first_id, last_id, delay, tenant=None):
+        """
+        Queue the message ids first_id..last_id of a job again after delay seconds
+        :return: Number of chunks deferred
+        """
+        chunks = [(start, min(start + self.chunk_size - 1, last_id))
+                  for start in range(first_id, last_id + 1, self.chunk_size)]
+        with self._lock:
+            self._outstanding[job_id] = self._outstanding.get(job_id, 0) + len(chunks)
+        for start, end in chunks:
+            self.delayed.put((job_id, start, end, tenant), delay)
+        return len(chunks)
+
+    def _release_deferred(self, item):
+        job_id, first_id, last_id, tenant = item
+        self.queue.put(item, lane=BULK, tenant=tenant, cost=last_id - first_id + 1)
+
+    def run(self, fn, *args, tenant=None, lane=TRANSACTIONAL, cost=1):
+        """
+        Run fn(*args) on a worker in the given lane
+        :return: Future resolved with the result of fn
+        """
+        future = Future()
+        self.queue.put((future, fn, args), lane=lane, tenant=tenant, cost=cost)
+        return future
+
+    def depth(self):
+        """:return: Queued items, cost and tenants per lane"""
+        return self.queue.depth()
+
+    def _worker(self, lanes):
+        while True:
+            item = self.queue.get(lanes)
+            if item is None:
+                break
+            if len(item) == 3 and isinstance(item[0], Future):
+                self._run_call(*item)
+                continue
+            job_id, first_id, last_id, tenant = item
+            try:
+                self.chunk_handler(job_id, first_id, last_id)
+                with self._lock:
+                    self._attempts.pop((job_id, first_id, last_id), None)
+            except Exception as e:
+                logger.error(f"Error processing chunk {first_id}-{last_id} of job {job_id}: {str(e)}")
+                self._chunk_failed(job_id, first_id, last_id, tenant)
+            finally:
+                self._chunk_done(job_id)
+
+    def _chunk_failed(self, job_id, first_id, last_id, tenant):
+        """Try a chunk that raised again later, or give up on it once it is out of attempts"""
+        key = (job_id, first_id, last_id)
+        with self._lock:
+            attempts = self._attempts.get(key, 0) + 1
+            if attempts < self.max_chunk_attempts:
+                self._attempts[key] = attempts
+            else:
+                self._attempts.pop(key, None)
+
+        if attempts < self.max_chunk_attempts:
+            delay = self.chunk_retry_delay * 2 ** (attempts - 1)
+            logger.warning(f"Retrying chunk {first_id}-{last_id} of job {job_id} in {delay:.1f}s")
+            self.defer(job_id, first_id, last_id, delay, tenant=tenant)
+            return
+
+        logger.error(f"Giving up on chunk {first_id}-{last_id} of job {job_id} after {attempts} attempts")
+        if self.failed_handler is None:
+            return
+        try:
+            self.failed_handler(job_id, first_id, last_id)
+        except Exception as e:
+            logger.error(f"Error failing chunk {first_id}-{last_id} of job {job_id}: {str(e)}")
+
+    @staticmethod
+    def _run_call(future, fn, args):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _chunk_done(self, job_id):
+        with self._lock:
+            remaining = self._outstanding.get(job_id, 1) - 1
+            if remaining > 0:
+                self._outstanding[job_id] = remaining
+                return
+            self._outstanding.pop(job_id, None)
+
+        try:
+            self.complete_handler(job_id)
+        except Exception as e:
+            logger.error(f"Error completing job {job_id}: {str(e)}")
@@ -0,0 +1,192 @@
+import logging
+import queue
+import re
+import threading
+import time
+from datetime import datetime
+
+import smpplib.consts
+
+# Configure logging
+logger = logging.getLogger('delivery_receipts')
+
+# esm_class message type bits of an SMSC delivery receipt (SMPP 3.4, 5.2.12)
+ESM_CLASS_DELIVERY_RECEIPT = 0x04
+
+# DLR "stat" values mapped to Message.status
+RECEIPT_STATUS = {
+    'DELIVRD': 'delivered',
+    'EXPIRED': 'expired',
+    'DELETED': 'failed',
+    'UNDELIV': 'undelivered',
+    'ACCEPTD': 'sent',
+    'ENROUTE': 'sent',
+    'UNKNOWN': 'unknown',
+    'REJECTD': 'rejected',
+}
+
+# message_state TLV values (SMPP 3.4, 5.2.28) mapped to Message.status
+MESSAGE_STATE_STATUS = {
+    1: 'sent',         # ENROUTE
+    2: 'delivered',    # DELIVERED
+    3: 'expired',      # EXPIRED
+    4: 'failed',       # DELETED
+    5: 'undelivered',  # UNDELIVERABLE
+    6: 'sent',         # ACCEPTED
+    7: 'unknown',      # UNKNOWN
+    8: 'rejected',     # REJECTED
+}
+
+RECEIPT_FIELDS = re.compile(r'\b(id|sub|dlvrd|submit date|done date|stat|err):(\S*)', re.IGNORECASE)
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('latin-1', 'ignore')
+    return value
+
+def parse_receipt(pdu):
+    """
+    Parse a deliver_sm delivery receipt
+    :return: dict with message_id, stat, err, done_date and status, or None if
+             the PDU is not a delivery receipt
+    """
+    esm_class = getattr(pdu, 'esm_class', 0) or 0
+    receipted_id = _text(getattr(pdu, 'receipted_message_id', None))
+    if (esm_class & 0x3C) != ESM_CLASS_DELIVERY_RECEIPT and not receipted_id:
+        return None
+
+    fields = {key.lower(): value for key, value in RECEIPT_FIELDS.findall(_text(pdu.short_message) or '')}
+
+    # TLVs take precedence over the free-form short_message text
+    message_id = receipted_id or fields.get('id')
+    if not message_id:
+        return None
+
+    stat = (fields.get('stat') or '').upper()
+    message_state = getattr(pdu, 'message_state', None)
+    if message_state in MESSAGE_STATE_STATUS:
+        status = MESSAGE_STATE_STATUS[message_state]
+    else:
+        status = RECEIPT_STATUS.get(stat, 'unknown')
+
+    done_date = None
+    if fields.get('done date'):
+        # YYMMDDhhmm, some SMSCs append the seconds; strptime would read the
+        # short form as hh:m:s, so the format goes by the length
+        fmt = '%y%m%d%H%M%S' if len(fields['done date']) == 12 else '%y%m%d%H%M'
+        try:
+            done_date = datetime.strptime(fields['done date'], fmt)
+        except ValueError:
+            pass
+
+    return {
+        'message_id': message_id,
+        'stat': stat,
+        'err': fields.get('err'),
+        'done_date': done_date,
+        'status': status,
+    }
+
+class DeliveryReceiptListener:
+    """
+    Consumes deliver_sm PDUs from the SMPP reader threads.
+
+    handle_pdu() only parses and queues the receipt so the PDU is acknowledged
+    right away; a writer thread hands the queued updates to
+    ``apply_updates([(message_id, status), ...])`` in batches. apply_updates
+    returns the message ids it could not match, which happens when a receipt
+    overtakes the commit of the send; those are retried a few times.
+    """
+
+    def __init__(self, apply_updates, batch_size=500, flush_interval=0.5, fallback=None,
+                 max_attempts=5, retry_delay=2):
+        """
+        :param apply_updates: Callable receiving a list of (message_id, status),
+                              returning the unmatched message ids
+        :param batch_size: Maximum updates per write
+        :param flush_interval: Maximum seconds a receipt waits before being written
+        :param fallback: Callable(pdu) for deliver_sm PDUs that are not receipts
+        :param max_attempts: Writes attempted for a receipt before it is dropped
+        :param retry_delay: Seconds before an unmatched receipt is written again
+        """
+        self.apply_updates = apply_updates
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fallback = fallback
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.queue = queue.Queue()
+        self.stats = {'received': 0, 'applied': 0, 'unmatched': 0, 'errors': 0}
+        self._deferred = {}  # message_id -> (status, attempts, ready_at)
+        self._thread = None
+
+    def handle_pdu(self, pdu):
+        """deliver_sm handler for SMPPSessionPool.set_deliver_handler"""
+        try:
+            receipt = parse_receipt(pdu)
+        except Exception as e:
+            logger.error(f"Error parsing delivery receipt: {str(e)}")
+            receipt = None
+
+        if receipt is None:
+            if self.fallback:
+                return self.fallback(pdu)
+            return None
+
+        self.stats['received'] += 1
+        self.queue.put((receipt['message_id'], receipt['status']))
+        return smpplib.consts.SMPP_ESME_ROK
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name='dlr-writer', daemon=True)
+        self._thread.start()
+
+    def _next_batch(self):
+        timeout = self.flush_interval if self._deferred else None
+        try:
+            batch = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+
+            # Later receipts for the same message win
+            updates = {message_id: (status, 1) for message_id, status in batch}
+            now = time.monotonic()
+            for message_id, (status, attempts, ready_at) in list(self._deferred.items()):
+                if ready_at <= now and message_id not in updates:
+                    updates[message_id] = (status, attempts + 1)
+                    del self._deferred[message_id]
+            if not updates:
+                continue
+
+            try:
+                unmatched = self.apply_updates([(message_id, status) for message_id, (status, _) in updates.items()])
+            except Exception as e:
+                self.stats['errors'] += len(updates)
+                logger.error(f"Error applying {len(updates)} delivery receipts: {str(e)}")
+                continue
+
+            unmatched = set(unmatched or ())
+            self.stats['applied'] += len(updates) - len(unmatched)
+            for message_id in unmatched:
+                status, attempts = updates[message_id]
+                if attempts < self.max_attempts:
+                    self._deferred[message_id] = (status, attempts, now + self.retry_delay)
+                else:
+                    self.stats['unmatched'] += 1
+                    logger.warning(f"Dropping delivery receipt for unknown message id {message_id}")
@@ -0,0 +1,128 @@
+import logging
+import threading
+import time
+
+# Configure logging
+logger = logging.getLogger('gateway_cache')
+
+class SharedCache:
+    """
+    TTL cache with stale-while-revalidate for slow gateway lookups.
+
+    Values live in a shared store (a database table) so every worker process
+    sees the same copy, with a short-lived in-process layer in front of it so
+    the store is not read on every call. A value older than ``ttl`` is still
+    served for up to ``stale_ttl`` more seconds while a background thread
+    fetches a new one; ``claim`` lets only one process run that refresh.
+    Callers only wait for the gateway when there is no usable value at all,
+    and then for at most ``wait_timeout`` seconds.
+    """
+
+    def __init__(self, load, store, claim=None, ttl=60, stale_ttl=3600, local_ttl=5,
+                 wait_timeout=3, refresh_lease=30):
+        """
+        :param load: Callable(key) -> (value, fetched_at) or None
+        :param store: Callable(key, value, fetched_at)
+        :param claim: Callable(key, lease_seconds) -> True if this process may refresh the key
+        :param ttl: Seconds a value is fresh
+        :param stale_ttl: Seconds past ttl a value is still served while it is refreshed
+        :param local_ttl: Seconds a value is served from memory before the store is read again
+        :param wait_timeout: Longest wait for the gateway when nothing is cached
+        :param refresh_lease: Seconds a claimed refresh blocks other processes
+        """
+        self.load = load
+        self.store = store
+        self.claim = claim
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.local_ttl = local_ttl
+        self.wait_timeout = wait_timeout
+        self.refresh_lease = refresh_lease
+        self.stats = {'hits': 0, 'stale': 0, 'misses': 0, 'refreshes': 0, 'errors': 0}
+        self._local = {}  # key -> (value, fetched_at, checked_at)
+        self._refreshing = {}  # key -> refresh thread
+        self._lock = threading.Lock()
+
+    def get(self, key, fetch, default=None):
+        """
+        Get a cached value
+        :param fetch: Callable() -> new value, or None if the gateway call failed
+        :param default: Returned when nothing is cached and the gateway did not answer in time
+        """
+        now = time.time()
+        entry = self._local.get(key)
+        if entry is None or now - entry[2] >= self.local_ttl:
+            try:
+                shared = self.load(key)
+            except Exception as e:
+                self.stats['errors'] += 1
+                logger.error(f"Error reading cache entry {key}: {str(e)}")
+                shared = None
+            if shared is not None:
+                entry = (shared[0], shared[1], now)
+                self._local[key] = entry
+
+        if entry is not None:
+            value, fetched_at, _ = entry
+            age = now - fetched_at
+            if age < self.ttl:
+                self.stats['hits'] += 1
+                return value
+            if age < self.ttl + self.stale_ttl:
+                self.stats['stale'] += 1
+                self._refresh(key, fetch, exclusive=True)
+                return value
+
+        self.stats['misses'] += 1
+        thread = self._refresh(key, fetch, exclusive=False)
+        if thread is not None:
+            thread.join(self.wait_timeout)
+        entry = self._local.get(key)
+        if entry is not None and time.time() - entry[1] < self.ttl + self.stale_ttl:
+            return entry[0]
+        return default
+
+    def invalidate(self, key):
+        """Drop the in-process copy so the next get reads the store again"""
+        self._local.pop(key, None)
+
+    def _refresh(self, key, fetch, exclusive):
+        with self._lock:
+            thread = self._refreshing.get(key)
+            if thread is not None:
+                return thread
+
+        if exclusive and self.claim is not None:
+            try:
+                if not self.claim(key, self.refresh_lease):
+                    return None
+            except Exception as e:
+                self.stats['errors'] += 1
+                logger.error(f"Error claiming refresh of {key}: {str(e)}")
+                return None
+
+        with self._lock:
+            thread = self._refreshing.get(key)
+            if thread is None:
+                thread = threading.Thread(target=self._do_refresh, args=(key, fetch),
+                                          name=f'cache-refresh-{key}', daemon=True)
+                self._refreshing[key] = thread
+                thread.start()
+            return thread
+
+    def _do_refresh(self, key, fetch):
+        try:
+            value = fetch()
+            if value is None:
+                self.stats['errors'] += 1
+                return
+            fetched_at = time.time()
+            self._local[key] = (value, fetched_at, fetched_at)
+            self.stats['refreshes'] += 1
+            self.store(key, value, fetched_at)
+        except Exception as e:
+            self.stats['errors'] += 1
+            logger.error(f"Error refreshing cache entry {key}: {str(e)}")
+        finally:
+            with self._lock:
+                self._refreshing.pop(key, None)
@@ -0,0 +1,118 @@
+import collections
+import hashlib
+import logging
+import threading
+import time
+
+# Configure logging
+logger = logging.getLogger('idempotency')
+
+class IdempotencyConflict(Exception):
+    """A request reused an idempotency key that is still in progress or belongs to a different request"""
+
+    def __init__(self, message, status=409):
+        super().__init__(message)
+        self.status = status
+
+def digest(*parts):
+    """Compact fixed-size hash of the given values, used for keys and request fingerprints"""
+    return hashlib.sha256('\x1f'.join(str(part) for part in parts).encode('utf-8')).hexdigest()[:32]
+
+def digest_stream(stream, block_size=1 << 16):
+    """Hash of the contents of a seekable binary stream, which is rewound for the next reader"""
+    sha = hashlib.sha256()
+    for block in iter(lambda: stream.read(block_size), b''):
+        sha.update(block)
+    stream.seek(0)
+    return sha.hexdigest()[:32]
+
+class IdempotencyStore:
+    """
+    Remembers the outcome of requests by their client-supplied idempotency key.
+
+    begin() claims a key before the request does any work; a retry with the
+    same key gets the stored response back instead of sending again. Keys
+    are hashed with their scope (endpoint and user) to a fixed 32-character
+    digest and expire after ``ttl`` seconds.
+
+    Completed keys are kept in a bounded in-process LRU, so a retry landing
+    on the same worker is answered from memory. Otherwise ``claim`` makes
+    one conditional insert in the shared store. The caller writes the
+    response into the shared store within its own transaction. Without a
+    ``claim`` callable the store is in-process only.
+    """
+
+    def __init__(self, claim=None, release=None, ttl=86400, local_size=10000):
+        """
+        :param claim: Callable(key, fingerprint, expires_at) -> None if the key was claimed,
+                      otherwise the stored (fingerprint, response or None while in progress)
+        :param release: Callable(key) dropping an unfinished claim
+        :param ttl: Seconds a key is remembered
+        :param local_size: Keys kept in the in-process cache
+        """
+        self.claim = claim
+        self.release_key = release
+        self.ttl = ttl
+        self.local_size = local_size
+        self._local = collections.OrderedDict()  # key -> (fingerprint, response, expires_at)
+        self._lock = threading.Lock()
+        self.stats = {'claimed': 0, 'replayed': 0, 'conflicts': 0}
+
+    def _check(self, fingerprint, stored_fingerprint, response):
+        if stored_fingerprint != fingerprint:
+            self.stats['conflicts'] += 1
+            raise IdempotencyConflict('Idempotency key was already used for a different request', 422)
+        if response is None:
+            self.stats['conflicts'] += 1
+            raise IdempotencyConflict('A request with this idempotency key is still being processed')
+        self.stats['replayed'] += 1
+        return response
+
+    def _remember(self, key, fingerprint, response, expires_at):
+        self._local[key] = (fingerprint, response, expires_at)
+        self._local.move_to_end(key)
+        while len(self._local) > self.local_size:
+            self._local.popitem(last=False)
+
+    def begin(self, scope, client_key, fingerprint):
+        """
+        Claim a key for a new request
+        :param scope: Endpoint and user the key belongs to
+        :param fingerprint: digest() of the request parameters
+        :return: (key, stored response), the response is None if this request should proceed
+        :raises IdempotencyConflict: The key is in progress or was used for another request
+        """
+        key = digest(scope, client_key)
+        now = time.time()
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is not None and entry[2] > now:
+                return key, self._check(fingerprint, entry[0], entry[1])
+            if self.claim is None:
+                self._remember(key, fingerprint, None, now + self.ttl)
+                self.stats['claimed'] += 1
+                return key, None
+
+        stored = self.claim(key, fingerprint, now + self.ttl)
+        if stored is None:
+            self.stats['claimed'] += 1
+            return key, None
+        response = self._check(fingerprint, *stored)
+        with self._lock:
+            self._remember(key, stored[0], response, now + self.ttl)
+        return key, response
+
+    def complete(self, key, fingerprint, response):
+        """Cache the response of a finished request; the shared row is written by the caller"""
+        with self._lock:
+            self._remember(key, fingerprint, response, time.time() + self.ttl)
+
+    def release(self, key):
+        """Forget an unfinished claim so the request can be retried, e.g. after a validation error"""
+        with self._lock:
+            self._local.pop(key, None)
+        if self.release_key is not None:
+            try:
+                self.release_key(key)
+            except Exception as e:
+                logger.error(f"Error releasing idempotency key {key}: {str(e)}")
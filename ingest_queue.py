@@ -0,0 +1,314 @@
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+# Configure logging
+logger = logging.getLogger('ingest_queue')
+
+DEFAULT_PATH = os.path.join(tempfile.gettempdir(), 'quantum_hub_ingest.db')
+
+# Message states
+QUEUED = 0
+SENDING = 1
+SENT = 2
+FAILED = 3
+
+STATE_NAMES = {QUEUED: 'queued', SENDING: 'sending', SENT: 'sent', FAILED: 'failed'}
+
+class IngestQueue:
+    """
+    Durable queue of messages submitted through the bulk API.
+
+    Messages are appended to a SQLite file in WAL mode, one transaction per
+    batch, so a batch is either fully queued or not at all and survives a
+    restart. Workers claim messages in id order with a lease; a claim that
+    is not finished before its lease expires (the worker died) is handed
+    out again, up to ``max_attempts`` times. Batch progress is counted from
+    the (batch, state) index.
+
+    The file also holds the idempotency keys of the requests that queued the
+    batches (see claim_key()), so every process on the host shares them.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, lease=120, max_attempts=5):
+        """
+        :param path: SQLite file holding the queue
+        :param lease: Seconds a claimed message is reserved for its worker
+        :param max_attempts: Claims after which a message whose lease expired is failed
+        """
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self._local = threading.local()
+        conn = self._connection()
+        conn.execute('CREATE TABLE IF NOT EXISTS batch ('
+                     'id TEXT PRIMARY KEY, created REAL NOT NULL, total INTEGER NOT NULL, '
+                     'rejected INTEGER NOT NULL, finished REAL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS message ('
+                     'id INTEGER PRIMARY KEY, batch_id TEXT NOT NULL, number TEXT NOT NULL, '
+                     'content TEXT NOT NULL, state INTEGER NOT NULL DEFAULT 0, lease REAL, '
+                     'attempts INTEGER NOT NULL DEFAULT 0, result TEXT)')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_message_state ON message (state, id)')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_message_batch ON message (batch_id, state)')
+        conn.execute('CREATE TABLE IF NOT EXISTS idempotency_key ('
+                     'key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, response TEXT, expires_at REAL NOT NULL)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def enqueue(self, messages, rejected=0):
+        """
+        Queue a batch in one transaction
+        :param messages: Iterable of (number, content) already validated and normalized
+        :param rejected: Number of messages of the batch rejected by validation, for its status
+        :return: (batch id, number of messages queued)
+        """
+        batch_id = uuid.uuid4().hex
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            cursor = conn.executemany('INSERT INTO message (batch_id, number, content) VALUES (?, ?, ?)',
+                                      ((batch_id, number, content) for number, content in messages))
+            total = cursor.rowcount
+            conn.execute('INSERT INTO batch (id, created, total, rejected, finished) VALUES (?, ?, ?, ?, ?)',
+                         (batch_id, time.time(), total, rejected, None if total else time.time()))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return batch_id, total
+
+    def claim(self, limit=500):
+        """
+        Reserve the oldest queued messages, and those whose lease expired
+        :return: List of (id, batch id, number, content)
+        """
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            expired = conn.execute('SELECT id, batch_id, number, content, attempts FROM message '
+                                   'WHERE state = ? AND lease < ? ORDER BY id LIMIT ?',
+                                   (SENDING, now, limit)).fetchall()
+            exhausted = [(FAILED, row[0]) for row in expired if row[4] >= self.max_attempts]
+            conn.executemany("UPDATE message SET state = ?, lease = NULL, result = 'Too many attempts' WHERE id = ?",
+                             exhausted)
+            rows = [row[:4] for row in expired if row[4] < self.max_attempts]
+            if len(rows) < limit:
+                rows += conn.execute('SELECT id, batch_id, number, content FROM message '
+                                     'WHERE state = ? ORDER BY id LIMIT ?',
+                                     (QUEUED, limit - len(rows))).fetchall()
+            conn.executemany('UPDATE message SET state = ?, lease = ?, attempts = attempts + 1 WHERE id = ?',
+                             ((SENDING, now + self.lease, row[0]) for row in rows))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return rows
+
+    def finish(self, results):
+        """
+        Record the outcome of claimed messages
+        :param results: Iterable of (id, success, message id or error)
+        """
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany('UPDATE message SET state = ?, lease = NULL, result = ? WHERE id = ? AND state = ?',
+                             ((SENT if success else FAILED, None if result is None else str(result)[:500],
+                               message_id, SENDING) for message_id, success, result in results))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+    def claim_key(self, key, fingerprint, expires_at):
+        """
+        Claim an idempotency key, taking over an expired one (IdempotencyStore claim)
+        :return: None if the key was claimed, otherwise the stored (fingerprint, response or None while in progress)
+        """
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT fingerprint, response FROM idempotency_key WHERE key = ? AND expires_at >= ?',
+                               (key, time.time())).fetchone()
+            if row is None:
+                conn.execute('INSERT OR REPLACE INTO idempotency_key (key, fingerprint, response, expires_at) '
+                             'VALUES (?, ?, NULL, ?)', (key, fingerprint, expires_at))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        if row is None:
+            return None
+        return row[0], None if row[1] is None else json.loads(row[1])
+
+    def complete_key(self, key, response):
+        """Store the response of the request that claimed key"""
+        self._connection().execute('UPDATE idempotency_key SET response = ? WHERE key = ?',
+                                   (json.dumps(response), key))
+
+    def release_key(self, key):
+        """Drop an unfinished claim (IdempotencyStore release)"""
+        self._connection().execute('DELETE FROM idempotency_key WHERE key = ? AND response IS NULL', (key,))
+
+    def status(self, batch_id, errors=20):
+        """
+        Progress of a batch
+        :param errors: Number of failed messages to include
+        :return: Status dict, or None if the batch does not exist
+        """
+        conn = self._connection()
+        row = conn.execute('SELECT created, total, rejected FROM batch WHERE id = ?',
+                           (batch_id,)).fetchone()
+        if row is None:
+            return None
+        created, total, rejected = row
+        counts = {name: 0 for name in STATE_NAMES.values()}
+        for state, count in conn.execute('SELECT state, COUNT(*) FROM message WHERE batch_id = ? GROUP BY state',
+                                         (batch_id,)):
+            counts[STATE_NAMES[state]] = count
+
+        done = counts['sent'] + counts['failed']
+        failures = conn.execute('SELECT number, result FROM message WHERE batch_id = ? AND state = ? '
+                                'ORDER BY id LIMIT ?', (batch_id, FAILED, errors)).fetchall()
+        return {
+            'batch_id': batch_id,
+            'status': 'completed' if done == total else 'processing',
+            'created': created,
+            'total': total,
+            'rejected': rejected,
+            **counts,
+            'progress': round(done / total, 4) if total else 1.0,
+            'errors': [{'number': number, 'error': result} for number, result in failures]
+        }
+
+    def depth(self):
+        """:return: Messages queued and in progress"""
+        conn = self._connection()
+        return dict((STATE_NAMES[state], count) for state, count in conn.execute(
+            'SELECT state, COUNT(*) FROM message WHERE state IN (?, ?) GROUP BY state', (QUEUED, SENDING)))
+
+    def purge(self, max_age):
+        """
+        Delete batches finished more than max_age seconds ago, and expired idempotency keys
+        :return: Number of batches deleted
+        """
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            conn.execute('UPDATE batch SET finished = ? WHERE finished IS NULL AND NOT EXISTS '
+                         '(SELECT 1 FROM message WHERE message.batch_id = batch.id AND state IN (?, ?))',
+                         (now, QUEUED, SENDING))
+            batches = [row[0] for row in conn.execute(
+                'SELECT id FROM batch WHERE finished < ?', (now - max_age,))]
+            conn.executemany('DELETE FROM message WHERE batch_id = ?', ((batch_id,) for batch_id in batches))
+            conn.executemany('DELETE FROM batch WHERE id = ?', ((batch_id,) for batch_id in batches))
+            conn.execute('DELETE FROM idempotency_key WHERE expires_at < ?', (now,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return len(batches)
+
+class IngestWorker:
+    """
+    Background threads that drain an IngestQueue.
+
+    Each thread claims up to ``batch_size`` messages, groups them by content
+    and hands every group to ``send(numbers, content)``, which returns one
+    (number, success, message id or error) per number in input order.
+    Finished batches are purged after ``retention`` seconds.
+    """
+
+    def __init__(self, queue, send, workers=1, batch_size=500, idle=0.5, retention=7 * 86400):
+        """
+        :param queue: IngestQueue to drain
+        :param send: Callable(numbers, content) -> list of (number, success, message id or error)
+        :param workers: Number of threads
+        :param batch_size: Messages claimed at a time
+        :param idle: Seconds to wait when the queue is empty
+        :param retention: Seconds finished batches are kept for status queries
+        """
+        self.queue = queue
+        self.send = send
+        self.workers = max(1, int(workers))
+        self.batch_size = batch_size
+        self.idle = idle
+        self.retention = retention
+        self._threads = []
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._next_purge = 0.0
+        self.stats = {'sent': 0, 'failed': 0}
+
+    def start(self):
+        """Start the worker threads (no-op if already running)"""
+        if self._threads:
+            return
+        self._stop.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'ingest-worker-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Ingest worker started with {self.workers} threads")
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def notify(self):
+        """Wake idle threads after a batch was queued"""
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if not self._drain_once():
+                    self._wake.wait(self.idle)
+                    self._wake.clear()
+                if time.time() >= self._next_purge:
+                    self._next_purge = time.time() + 3600
+                    self.queue.purge(self.retention)
+            except Exception as e:
+                logger.error(f"Ingest worker error: {str(e)}")
+                self._stop.wait(self.idle)
+
+    def _drain_once(self):
+        """:return: Number of messages processed"""
+        rows = self.queue.claim(self.batch_size)
+        if not rows:
+            return 0
+
+        groups = {}
+        for message_id, _, number, content in rows:
+            groups.setdefault(content, []).append((message_id, number))
+
+        for content, group in groups.items():
+            try:
+                outcome = self.send([number for _, number in group], content)
+            except Exception as e:
+                logger.error(f"Error sending {len(group)} queued messages: {str(e)}")
+                # Left claimed, the messages are retried when their lease expires
+                continue
+            results = [(message_id, result[1], result[2]) for (message_id, _), result in zip(group, outcome)]
+            self.queue.finish(results)
+            sent = sum(1 for _, success, _ in results if success)
+            self.stats['sent'] += sent
+            self.stats['failed'] += len(results) - sent
+        return len(rows)
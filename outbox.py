@@ -0,0 +1,75 @@
+import logging
+import threading
+
+# Configure logging
+logger = logging.getLogger('outbox')
+
+class OutboxDispatcher:
+    """
+    Sends the messages recorded in a transactional outbox.
+
+    Request handlers write a message, its credit debit and an outbox row in
+    one transaction and do not call the gateway before it commits, so there
+    is never a send without a record. Dispatcher threads claim committed
+    rows in batches with ``claim(limit)`` and hand them to
+    ``dispatch(ids)``, which sends them and removes them from the outbox.
+    The claim skips rows held by other processes, so any number of
+    dispatcher processes can share one outbox without sending a row twice.
+    A row whose dispatcher died mid-send is claimed again once its lease
+    expires, which makes delivery at-least-once.
+    """
+
+    def __init__(self, claim, dispatch, workers=1, batch_size=100, interval=1.0):
+        """
+        :param claim: Callable(limit) returning the ids of up to limit rows claimed for this process
+        :param dispatch: Callable(ids) that sends claimed rows and records the outcome
+        :param workers: Number of dispatcher threads
+        :param batch_size: Rows claimed at a time
+        :param interval: Seconds between polls while the outbox is empty
+        """
+        self.claim = claim
+        self.dispatch = dispatch
+        self.workers = max(1, int(workers))
+        self.batch_size = batch_size
+        self.interval = interval
+        self._threads = []
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self.stats = {'claimed': 0, 'batches': 0, 'errors': 0}
+
+    def start(self):
+        """Start the dispatcher threads (no-op if already running)"""
+        if self._threads:
+            return
+        self._stop.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'outbox-dispatcher-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.info(f"Outbox dispatcher started with {self.workers} threads")
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def notify(self):
+        """Poll right away, e.g. after rows were committed"""
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                ids = self.claim(self.batch_size)
+                if ids:
+                    self.stats['claimed'] += len(ids)
+                    self.stats['batches'] += 1
+                    self.dispatch(ids)
+                    continue
+            except Exception as e:
+                self.stats['errors'] += 1
+                logger.error(f"Outbox dispatcher error: {str(e)}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
@@ -0,0 +1,124 @@
+import random
+import re
+import sys
+import time
+
+NON_DIGITS = re.compile(r'\D+')
+NATIONAL_LENGTH = 10  # Numbers of this length get the country code prepended
+MAX_LENGTH = 15  # E.164 limit including the country code
+
+def normalize_number(number, country_code='+52'):
+    """
+    Normalize one number to digits with country code (no +)
+    :param country_code: Country code prepended to national numbers, with or without +
+    :return: (normalized, None) or (None, reason)
+    """
+    digits = NON_DIGITS.sub('', number)
+    if not digits:
+        return None, 'empty'
+    if len(digits) == NATIONAL_LENGTH:
+        return NON_DIGITS.sub('', country_code) + digits, None
+    if len(digits) < NATIONAL_LENGTH:
+        return None, 'too short'
+    if len(digits) > MAX_LENGTH:
+        return None, 'too long'
+    return digits, None
+
+class NumberNormalizer:
+    """
+    Normalizes, validates and de-duplicates recipient numbers in batches.
+
+    Duplicates are detected across every batch passed to the same instance
+    with a set of the normalized numbers stored as ints. Rejected numbers
+    are counted and handed to ``on_reject(number, reason)`` instead of
+    being kept, so the caller decides where the reject list goes.
+    """
+
+    def __init__(self, country_code='+52', on_reject=None):
+        """
+        :param country_code: Country code prepended to national numbers
+        :param on_reject: Callable(number, reason) for invalid and duplicate numbers
+        """
+        self.prefix = NON_DIGITS.sub('', country_code)
+        self.on_reject = on_reject
+        self.seen = set()
+        self.valid = 0
+        self.invalid = 0
+        self.duplicates = 0
+
+    def normalize(self, numbers):
+        """
+        Normalize a batch of numbers
+        :return: List of (index in the batch, normalized number) for the valid, first-seen numbers
+        """
+        prefix = self.prefix
+        seen = self.seen
+        accepted = []
+        for index, digits in enumerate([NON_DIGITS.sub('', number) for number in numbers]):
+            length = len(digits)
+            if length == NATIONAL_LENGTH:
+                digits = prefix + digits
+            elif length < NATIONAL_LENGTH or length > MAX_LENGTH:
+                self.invalid += 1
+                if self.on_reject:
+                    self.on_reject(numbers[index], 'empty' if not length else
+                                   'too short' if length < NATIONAL_LENGTH else 'too long')
+                continue
+
+            key = int(digits)
+            if key in seen:
+                self.duplicates += 1
+                if self.on_reject:
+                    self.on_reject(numbers[index], 'duplicate')
+                continue
+            seen.add(key)
+            accepted.append((index, digits))
+
+        self.valid += len(accepted)
+        return accepted
+
+    def iter_normalized(self, recipients, batch_size=10000):
+        """
+        Normalize a stream of (number, variables) in batches
+        :return: Generator of (normalized number, variables)
+        """
+        batch = []
+        for recipient in recipients:
+            batch.append(recipient)
+            if len(batch) >= batch_size:
+                yield from self._normalize_recipients(batch)
+                batch = []
+        if batch:
+            yield from self._normalize_recipients(batch)
+
+    def _normalize_recipients(self, batch):
+        for index, number in self.normalize([number for number, _ in batch]):
+            yield number, batch[index][1]
+
+    def summary(self):
+        return {'valid': self.valid, 'invalid': self.invalid, 'duplicates': self.duplicates}
+
+def _random_number(rng):
+    digits = ''.join(rng.choice('0123456789') for _ in range(10))
+    style = rng.randrange(4)
+    if style == 0:
+        return digits
+    if style == 1:
+        return f"+52 {digits[:2]} {digits[2:6]} {digits[6:]}"
+    if style == 2:
+        return f"({digits[:3]}) {digits[3:6]}-{digits[6:]}"
+    return digits[:rng.randrange(4, 10)]
+
+if __name__ == '__main__':
+    # Benchmark: python phone_numbers.py [count]
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    rng = random.Random(0)
+    pool = [_random_number(rng) for _ in range(100000)]
+    numbers = [pool[rng.randrange(len(pool))] for _ in range(count)]
+
+    normalizer = NumberNormalizer('+52')
+    started = time.perf_counter()
+    for start in range(0, count, 10000):
+        normalizer.normalize(numbers[start:start + 10000])
+    elapsed = time.perf_counter() - started
+    print(f"Normalized {count} numbers in {elapsed:.2f}s ({count / elapsed:,.0f} numbers/s): {normalizer.summary()}")
@@ -0,0 +1,128 @@
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# Configure logging
+logger = logging.getLogger('rate_limit')
+
+DEFAULT_PATH = os.path.join(tempfile.gettempdir(), 'quantum_hub_rate_limits.db')
+
+class TokenBucketLimiter:
+    """
+    Token buckets shared by every worker process on the host.
+
+    Bucket state lives in a small SQLite file and is updated inside
+    ``BEGIN IMMEDIATE`` transactions, so concurrent processes draw from the
+    same buckets. Each bucket refills at its current rate up to ``burst``
+    tokens. throttled() halves a bucket's rate (multiplicative decrease) and
+    the rate then grows back linearly towards the configured maximum
+    (additive increase).
+    """
+
+    def __init__(self, path=DEFAULT_PATH, increase=0.05, decrease=0.5, min_fraction=0.05):
+        """
+        :param path: SQLite file holding the bucket state
+        :param increase: Fraction of the maximum rate regained per second after a throttle
+        :param decrease: Factor applied to the rate on a throttle
+        :param min_fraction: Lowest rate as a fraction of the maximum
+        """
+        self.path = path
+        self.increase = increase
+        self.decrease = decrease
+        self.min_fraction = min_fraction
+        self._local = threading.local()
+        self._connection().execute('CREATE TABLE IF NOT EXISTS bucket ('
+                                   'key TEXT PRIMARY KEY, tokens REAL NOT NULL, rate REAL NOT NULL, updated REAL NOT NULL)')
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _refill(self, row, max_rate, burst, now):
+        """:return: (tokens, rate) of a bucket row brought up to now"""
+        if row is None:
+            return float(burst), float(max_rate)
+        tokens, rate, updated = row
+        elapsed = max(now - updated, 0.0)
+        rate = min(max_rate, max(rate, max_rate * self.min_fraction) + self.increase * max_rate * elapsed)
+        return min(float(burst), tokens + rate * elapsed), rate
+
+    def try_acquire(self, buckets):
+        """
+        Take tokens from several buckets at once, all or nothing
+        :param buckets: Iterable of (key, tokens, max_rate, burst); buckets without a rate are ignored
+        :return: 0 if the tokens were taken, otherwise seconds to wait before trying again
+        """
+        buckets = [(key, tokens, rate, burst or rate) for key, tokens, rate, burst in buckets if rate]
+        if not buckets:
+            return 0
+
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            states = []
+            wait = 0
+            for key, tokens, max_rate, burst in buckets:
+                row = conn.execute('SELECT tokens, rate, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+                available, rate = self._refill(row, max_rate, burst, now)
+                # Requests larger than the burst may run the bucket into debt
+                needed = min(tokens, burst)
+                if available < needed:
+                    wait = max(wait, (needed - available) / rate)
+                states.append((key, available - tokens, rate))
+
+            if not wait:
+                conn.executemany('INSERT OR REPLACE INTO bucket (key, tokens, rate, updated) VALUES (?, ?, ?, ?)',
+                                 [(key, tokens, rate, now) for key, tokens, rate in states])
+            conn.execute('COMMIT')
+            return wait
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+    def acquire(self, buckets, timeout=None):
+        """
+        Wait until the tokens can be taken from all buckets
+        :param timeout: Longest wait in seconds, None to wait as long as needed
+        :return: True once taken, False on timeout
+        """
+        buckets = list(buckets)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire(buckets)
+            if not wait:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(min(wait, 1.0))
+
+    def throttled(self, key, max_rate):
+        """Halve the rate of a bucket after the gateway reported throttling"""
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            row = conn.execute('SELECT tokens, rate, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+            tokens, rate = self._refill(row, max_rate, max_rate, now)
+            rate = max(rate * self.decrease, max_rate * self.min_fraction)
+            conn.execute('INSERT OR REPLACE INTO bucket (key, tokens, rate, updated) VALUES (?, ?, ?, ?)',
+                         (key, min(tokens, 0.0), rate, now))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        logger.warning(f"Throttled on {key}, rate lowered to {rate:.1f}/s")
+
+    def stats(self):
+        """:return: {key: {'tokens', 'rate'}} as last written"""
+        rows = self._connection().execute('SELECT key, tokens, rate FROM bucket').fetchall()
+        return {key: {'tokens': round(tokens, 2), 'rate': round(rate, 2)} for key, tokens, rate in rows}
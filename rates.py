@@ -0,0 +1,94 @@
+class _Node:
+    __slots__ = ('children', 'rate')
+
+    def __init__(self):
+        self.children = {}
+        self.rate = None
+
+class RateTable:
+    """
+    Per-destination SMS rates keyed by E.164 prefix.
+
+    Prefixes are stored in a digit trie, so a lookup walks at most one node
+    per digit of the number and returns the rate of the longest matching
+    prefix, independent of how many prefixes the table holds.
+    """
+
+    def __init__(self, rates=None):
+        """
+        :param rates: Iterable of (prefix, rate)
+        """
+        self._root = _Node()
+        self.size = 0
+        for prefix, rate in rates or ():
+            self.add(prefix, rate)
+
+    def add(self, prefix, rate):
+        node = self._root
+        for digit in str(prefix).lstrip('+'):
+            node = node.children.setdefault(digit, _Node())
+        if node.rate is None:
+            self.size += 1
+        node.rate = float(rate)
+
+    def lookup(self, number, default=None):
+        """
+        :param number: Normalized number (digits with country code)
+        :return: Rate of the longest matching prefix, or default
+        """
+        node = self._root
+        rate = default if node.rate is None else node.rate
+        for digit in number:
+            node = node.children.get(digit)
+            if node is None:
+                break
+            if node.rate is not None:
+                rate = node.rate
+        return rate
+
+    def match(self, number):
+        """:return: (longest matching prefix, its rate), or None"""
+        node = self._root
+        best = None if node.rate is None else ('', node.rate)
+        for index, digit in enumerate(number):
+            node = node.children.get(digit)
+            if node is None:
+                break
+            if node.rate is not None:
+                best = (number[:index + 1], node.rate)
+        return best
+
+    def __len__(self):
+        return self.size
+
+class RateCard:
+    """
+    Rates for one user: their own prefix overrides first, then the shared
+    destination table, then the user's flat rate.
+    """
+
+    def __init__(self, table, overrides=None, default_rate=0.0):
+        """
+        :param table: Shared RateTable
+        :param overrides: RateTable with the user's prefix overrides
+        :param default_rate: Rate for destinations neither table covers
+        """
+        self.table = table
+        self.overrides = overrides
+        self.default_rate = default_rate
+
+    def rate(self, number):
+        if self.overrides is not None:
+            rate = self.overrides.lookup(number)
+            if rate is not None:
+                return rate
+        return self.table.lookup(number, self.default_rate)
+
+    def price(self, numbers):
+        """
+        Price a recipient list in one pass
+        :return: (total cost, list of per-number rates)
+        """
+        rate = self.rate
+        rates = [rate(number) for number in numbers]
+        return sum(rates), rates
@@ -0,0 +1,84 @@
+import csv
+import gzip
+import io
+import itertools
+import re
+import zipfile
+
+# Header names recognised as the phone number column of a CSV upload
+PHONE_COLUMNS = ('phone', 'phone_number', 'number', 'numbers', 'mobile', 'msisdn', 'telefono', 'celular', 'to')
+DELIMITERS = (',', ';', '\t', '|')
+PLACEHOLDER = re.compile(r'\{(\w+)\}')
+
+def open_upload(stream, filename=''):
+    """
+    Open an uploaded recipient file as a text stream, unpacking gzip and zip
+    archives on the fly. Nothing is read into memory beyond the I/O buffers.
+    :param stream: Seekable binary file object (e.g. FileStorage.stream)
+    :param filename: Original file name, used as a hint next to the magic bytes
+    """
+    magic = stream.read(4)
+    stream.seek(0)
+    name = (filename or '').lower()
+
+    if magic[:2] == b'\x1f\x8b' or name.endswith('.gz'):
+        binary = gzip.GzipFile(fileobj=stream)
+    elif magic == b'PK\x03\x04' or name.endswith('.zip'):
+        archive = zipfile.ZipFile(stream)
+        members = [info for info in archive.infolist()
+                   if not info.is_dir() and not info.filename.startswith('__MACOSX/')]
+        if not members:
+            raise ValueError('Zip archive contains no files')
+        binary = archive.open(members[0])
+    else:
+        binary = stream
+
+    return io.TextIOWrapper(binary, encoding='utf-8-sig', errors='replace', newline='')
+
+def iter_recipients(lines, phone_column=None):
+    """
+    Stream recipients from text lines.
+
+    Plain text is read as one number per line. CSV (comma, semicolon, tab or
+    pipe separated) with a header row uses the phone column and turns the
+    other columns into per-recipient variables; without a recognised header
+    the first column is the number.
+    :param lines: Iterable of text lines, e.g. the result of open_upload()
+    :param phone_column: Header of the phone column, detected if omitted
+    :return: Generator of (number, variables)
+    """
+    lines = iter(lines)
+    first = next(lines, '')
+    delimiter = next((d for d in DELIMITERS if d in first), None)
+    lines = itertools.chain([first], lines)
+
+    if delimiter is None:
+        for line in lines:
+            line = line.strip()
+            if line:
+                yield line, {}
+        return
+
+    reader = csv.reader(lines, delimiter=delimiter)
+    header = [name.strip().lower() for name in next(reader, [])]
+    candidates = (phone_column.lower(),) if phone_column else PHONE_COLUMNS
+    phone_index = next((header.index(name) for name in candidates if name in header), None)
+
+    if phone_index is None:
+        # No header row, the first row is a recipient as well
+        reader = itertools.chain([header], reader)
+        phone_index = 0
+        header = []
+
+    for row in reader:
+        if len(row) <= phone_index or not row[phone_index].strip():
+            continue
+        variables = {name: value.strip() for name, value in zip(header, row)
+                     if name and name != header[phone_index]} if header else {}
+        yield row[phone_index].strip(), variables
+
+def render_content(template, variables):
+    """Fill {name} placeholders from the recipient's variables, leaving unknown ones as they are"""
+    if not variables:
+        return template
+    return PLACEHOLDER.sub(lambda match: variables.get(match.group(1).lower(), match.group(0)), template)
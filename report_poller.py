@@ -0,0 +1,87 @@
+import logging
+import threading
+
+# Configure logging
+logger = logging.getLogger('report_poller')
+
+class ReportPoller:
+    """
+    Background reconciler for HTTP gateway delivery reports.
+
+    Each pass walks the messages still awaiting a report in id order using a
+    keyset cursor, asks the gateway for their reports in large batches and
+    writes the results back in bulk. Messages drop out of the scan once they
+    reach a final status. The pause between passes halves after a pass that
+    found reports and doubles after one that found none.
+    """
+
+    def __init__(self, fetch_pending, fetch_reports, apply_updates, page_size=1000,
+                 min_interval=5, max_interval=300):
+        """
+        :param fetch_pending: Callable(after_id, limit) -> [(row_id, message_id), ...] ordered by row_id
+        :param fetch_reports: Callable(message_ids) -> {message_id: status}
+        :param apply_updates: Callable([(message_id, status), ...])
+        :param page_size: Pending messages read per page
+        :param min_interval: Shortest pause between passes in seconds
+        :param max_interval: Longest pause between passes in seconds
+        """
+        self.fetch_pending = fetch_pending
+        self.fetch_reports = fetch_reports
+        self.apply_updates = apply_updates
+        self.page_size = page_size
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+        self.stats = {'passes': 0, 'polled': 0, 'updated': 0}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._thread = threading.Thread(target=self._run, name='report-poller', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def poll_once(self):
+        """
+        Run one pass over all pending messages
+        :return: Number of messages whose status changed
+        """
+        updated = 0
+        cursor = 0
+        while not self._stop.is_set():
+            page = self.fetch_pending(cursor, self.page_size)
+            if not page:
+                break
+            cursor = page[-1][0]
+
+            statuses = self.fetch_reports([message_id for _, message_id in page])
+            self.stats['polled'] += len(page)
+            if statuses:
+                self.apply_updates(list(statuses.items()))
+                updated += len(statuses)
+
+            if len(page) < self.page_size:
+                break
+
+        self.stats['passes'] += 1
+        self.stats['updated'] += updated
+        return updated
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                updated = self.poll_once()
+            except Exception as e:
+                logger.error(f"Error polling delivery reports: {str(e)}")
+                updated = 0
+
+            if updated:
+                self.interval = max(self.min_interval, self.interval / 2)
+            else:
+                self.interval = min(self.max_interval, self.interval * 2)
+            logger.debug(f"Report pass updated {updated} messages, next pass in {self.interval}s")
+            self._stop.wait(self.interval)
@@ -0,0 +1,167 @@
+import logging
+import random
+import re
+import threading
+import time
+
+from timer_wheel import TimerWheel
+
+# Configure logging
+logger = logging.getLogger('retry')
+
+# SMPP command_status values worth retrying: the SMSC is busy or failed
+# internally, the message itself is fine. Anything else is permanent.
+SMPP_RETRYABLE_STATUSES = {
+    0x08,  # ESME_RSYSERR
+    0x14,  # ESME_RMSGQFUL
+    0x45,  # ESME_RSUBMITFAIL
+    0x58,  # ESME_RTHROTTLED
+    0x64,  # ESME_RX_T_APPN
+}
+HTTP_RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+# Send errors are reported as strings by the gateway clients and backends
+HTTP_STATUS = re.compile(r'^(?:HTTP (\d{3})\b|(\d{3}) (?:Client|Server) Error)')
+SMPP_STATUS = re.compile(r'Message send failed with status: (\d+)')
+GATEWAY_STATUS = re.compile(r'^Failed to send SMS: .*\(status: (-?\d+)\)$')
+TRANSPORT_ERRORS = ('Max retries exceeded', 'timed out', 'Connection aborted', 'Connection refused',
+                    'Connection reset', 'is not bound', 'No bound SMPP session', 'No submit_sm_resp',
+                    'submit window is full', 'rate limit reached')
+NO_ROUTE = 'No healthy route for destination'
+
+def classify_error(error, gateway_retryable=()):
+    """
+    Classify a send error
+    :param error: Error string of a failed send, or the exception raised
+    :param gateway_retryable: HTTP gateway status values that are temporary
+    :return: (error class, retryable)
+    """
+    if isinstance(error, BaseException):
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+        if status is not None:
+            return f'http_{status}', status in HTTP_RETRYABLE_STATUSES
+        if isinstance(error, (OSError, TimeoutError)):
+            return 'transport', True
+    text = str(error)
+
+    match = HTTP_STATUS.match(text)
+    if match:
+        status = int(match.group(1) or match.group(2))
+        return f'http_{status}', status in HTTP_RETRYABLE_STATUSES
+    match = SMPP_STATUS.search(text)
+    if match:
+        status = int(match.group(1))
+        return f'smpp_0x{status:02x}', status in SMPP_RETRYABLE_STATUSES
+    match = GATEWAY_STATUS.match(text)
+    if match:
+        status = int(match.group(1))
+        return f'gateway_{status}', status in gateway_retryable
+    if text == NO_ROUTE:
+        return 'no_route', True
+    if any(marker in text for marker in TRANSPORT_ERRORS):
+        return 'transport', True
+    return 'other', False
+
+class RetryPolicy:
+    """
+    Decides whether and when a failed send is tried again.
+
+    Errors are classified with classify_error(). Retryable ones are delayed
+    with full-jitter exponential backoff, a uniform random delay between 0
+    and min(cap, base * 2 ** attempt), so retries of a failed batch do not
+    hit the gateway again at the same moment. Outcomes are counted per
+    error class.
+    """
+
+    def __init__(self, max_attempts=5, base=1.0, cap=60.0, gateway_retryable=()):
+        """
+        :param max_attempts: Sends of a message, the first one included
+        :param base: Seconds of the first backoff step
+        :param cap: Longest delay in seconds
+        :param gateway_retryable: HTTP gateway status values that are temporary
+        """
+        self.max_attempts = max_attempts
+        self.base = base
+        self.cap = cap
+        self.gateway_retryable = set(gateway_retryable)
+        self._counters = {}  # error class -> {'retried': n, 'exhausted': n, 'permanent': n}
+        self._lock = threading.Lock()
+
+    def backoff(self, attempts):
+        """:return: Seconds to wait after the given number of failed sends"""
+        return random.uniform(0, min(self.cap, self.base * 2 ** max(attempts - 1, 0)))
+
+    def decide(self, error, attempts):
+        """
+        :param attempts: Sends of the message so far, including the failed one
+        :return: Seconds until the next attempt, or None if the failure is final
+        """
+        error_class, retryable = classify_error(error, self.gateway_retryable)
+        if not retryable:
+            outcome = 'permanent'
+        elif attempts >= self.max_attempts:
+            outcome = 'exhausted'
+        else:
+            outcome = 'retried'
+        with self._lock:
+            counters = self._counters.setdefault(error_class, {'retried': 0, 'exhausted': 0, 'permanent': 0})
+            counters[outcome] += 1
+        return self.backoff(attempts) if outcome == 'retried' else None
+
+    def stats(self):
+        with self._lock:
+            return {error_class: dict(counters) for error_class, counters in self._counters.items()}
+
+class DelayQueue:
+    """
+    Holds items until their delay has passed, then hands them to ``release``.
+
+    Items wait in a timer wheel advanced by one background thread, so
+    worker threads never sleep on a retry. ``release(item)`` runs on that
+    thread and must not block; it typically puts the item back on a work
+    queue.
+    """
+
+    def __init__(self, release, tick=0.25):
+        """
+        :param release: Callable(item) called once the item is due
+        :param tick: Timer resolution in seconds
+        """
+        self.release = release
+        self.tick = tick
+        self.wheel = TimerWheel(tick)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='delay-queue', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def put(self, item, delay):
+        """Release item after delay seconds"""
+        with self._lock:
+            self.wheel.add(time.time() + delay, item)
+
+    def __len__(self):
+        with self._lock:
+            return len(self.wheel)
+
+    def _run(self):
+        while not self._stop.wait(self.tick):
+            with self._lock:
+                due = self.wheel.advance()
+            for item in due:
+                try:
+                    self.release(item)
+                except Exception as e:
+                    logger.error(f"Error releasing delayed item: {str(e)}")
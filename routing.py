@@ -0,0 +1,343 @@
+import logging
+import threading
+import time
+
+import requests
+
+from rates import RateTable
+from retry import HTTP_STATUS, SMPP_STATUS, GATEWAY_STATUS
+
+# Configure logging
+logger = logging.getLogger('routing')
+
+ESME_RTHROTTLED = 0x58
+HTTP_TOO_MANY_REQUESTS = 429
+HTTP_SERVICE_UNAVAILABLE = 503
+
+# Errors raised before a request reached the gateway
+NOT_SENT_ERRORS = ('Failed to establish a new connection', 'ConnectTimeoutError', 'Connection refused',
+                   'is not bound', 'No bound SMPP session', 'submit window is full', 'rate limit reached')
+
+def is_throttled(error):
+    """Whether a send error means the gateway asked us to slow down (SMPP ESME_RTHROTTLED or HTTP 429)"""
+    text = str(error)
+    match = SMPP_STATUS.search(text)
+    if match:
+        return int(match.group(1)) == ESME_RTHROTTLED
+    match = HTTP_STATUS.match(text)
+    return bool(match) and int(match.group(1) or match.group(2)) == HTTP_TOO_MANY_REQUESTS
+
+def is_not_sent(error):
+    """
+    Whether a send error guarantees the message did not go out: the gateway
+    could not be reached or explicitly rejected it. After a read timeout or a
+    dropped connection the gateway may have accepted it.
+    """
+    text = str(error)
+    match = HTTP_STATUS.match(text)
+    if match:
+        # Other server errors may come after the gateway processed the request
+        status = int(match.group(1) or match.group(2))
+        return status < 500 or status == HTTP_SERVICE_UNAVAILABLE
+    if SMPP_STATUS.search(text) or GATEWAY_STATUS.match(text) or text == 'Number rejected by gateway':
+        return True
+    return any(marker in text for marker in NOT_SENT_ERRORS)
+
+class CircuitBreaker:
+    """
+    Skips a route after repeated failures.
+
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    allow() returns False without touching the route. Once ``reset_timeout``
+    seconds have passed a single trial request is let through (half-open);
+    its outcome closes or re-opens the breaker.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            # Let one trial through per reset_timeout while open or half-open
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+class HTTPGatewayBackend:
+    """Route backend for the HTTP gateway (sms_client.SMSClient)"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def available(self):
+        return True
+
+    def send_batch(self, numbers, content):
+        return self.client.send_sms_batch(numbers, content)
+
+class SMPPBackend:
+    """Route backend for the pooled SMPP binds (smpp_client.SMPPClient)"""
+
+    def __init__(self, client, source_addr='SMSHub', timeout=None):
+        """
+        :param source_addr: Sender id of submitted messages
+        :param timeout: Seconds to wait for a submit_sm_resp
+        """
+        self.client = client
+        self.source_addr = source_addr
+        self.timeout = timeout
+        # Binds happen in the background; the route is skipped until one is up
+        client.pool.start()
+
+    def available(self):
+        return self.client.pool.bound
+
+    def send_batch(self, numbers, content):
+        return self.client.pool.send_messages(self.source_addr, numbers, content, self.timeout)
+
+class SendAPIBackend:
+    """Route backend for the gateway's JSON /send API, one request per number"""
+
+    def __init__(self, url, username, password, sender='SMSHub', connect_timeout=5, read_timeout=30):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.sender = sender
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+
+    def available(self):
+        return True
+
+    def send_batch(self, numbers, content):
+        results = []
+        for number in numbers:
+            try:
+                response = self.session.post(self.url, timeout=self.timeout, json={
+                    'username': self.username,
+                    'password': self.password,
+                    'to': number,
+                    'text': content,
+                    'from': self.sender
+                })
+                try:
+                    result = response.json()
+                except ValueError:
+                    result = {}
+                if response.status_code == 200:
+                    results.append((number, True, result.get('message_id')))
+                else:
+                    results.append((number, False, f"HTTP {response.status_code}: {response.text[:200]}"))
+            except requests.RequestException as e:
+                results.append((number, False, str(e) or type(e).__name__))
+        return results
+
+class Route:
+    """A gateway backend with its per-destination costs, circuit breaker and live latency"""
+
+    def __init__(self, name, backend, costs, breaker=None, rate=None, burst=None):
+        """
+        :param backend: Object with available() and send_batch(numbers, content)
+        :param costs: {prefix: cost}; the route only carries numbers matching a prefix,
+                      use '' to carry every destination
+        :param rate: Messages per second the gateway accepts, None for no limit
+        :param burst: Messages that may be sent at once, defaults to rate
+        """
+        self.name = name
+        self.backend = backend
+        self.costs = RateTable(costs.items())
+        self.breaker = breaker or CircuitBreaker()
+        self.rate = rate
+        self.burst = burst
+        self.latency = 0.0  # Moving average of seconds per request
+        self.stats = {'sent': 0, 'failed': 0, 'requests': 0}
+
+    def cost(self, number):
+        return self.costs.lookup(number)
+
+    def healthy(self):
+        return self.backend.available() and self.breaker.allow()
+
+    def record(self, success, seconds):
+        self.latency = seconds if not self.stats['requests'] else 0.8 * self.latency + 0.2 * seconds
+        self.stats['requests'] += 1
+        if success:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+
+    def status(self):
+        return {
+            'name': self.name,
+            'state': self.breaker.state,
+            'rate': self.rate,
+            'available': self.backend.available(),
+            'latency': round(self.latency, 3),
+            **self.stats
+        }
+
+class Router:
+    """
+    Picks a gateway route per destination and fails over between routes.
+
+    Routes that carry a number are ranked by the preferred route first, then
+    by cost plus ``latency_weight`` times their recent latency. Routes whose
+    breaker is open or whose backend is down are skipped without a request,
+    so a dead gateway costs nothing per message. A route's health is only
+    checked when it is next in line, so the trial request of a half-open
+    breaker is not used up by a route that then goes unused. When a batch
+    fails as a whole on one route, the numbers that were certainly not sent
+    (unreachable gateway, explicit reject) are retried on the next; after a
+    timeout a number may have gone out and is not sent again elsewhere.
+
+    With a limiter, every request first takes tokens from the route's bucket,
+    the bucket of each destination prefix in ``prefix_limits`` and any extra
+    buckets passed by the caller (e.g. per user). Numbers the gateway
+    throttles lower the route's rate and are retried on the same route.
+    """
+
+    def __init__(self, routes, latency_weight=0.01, preferred=None, limiter=None,
+                 prefix_limits=None, throttle_retries=3):
+        """
+        :param routes: List of Route
+        :param latency_weight: Cost units one second of latency is worth
+        :param preferred: Name of the route tried first when it is healthy
+        :param limiter: rate_limit.TokenBucketLimiter shared by all workers
+        :param prefix_limits: RateTable of messages per second by destination prefix
+        :param throttle_retries: Times throttled numbers are resent on the same route
+        """
+        self.routes = routes
+        self.latency_weight = latency_weight
+        self.preferred = preferred
+        self.limiter = limiter
+        self.prefix_limits = prefix_limits
+        self.throttle_retries = throttle_retries
+
+    def prefer(self, name):
+        self.preferred = name
+
+    def status(self):
+        return [route.status() for route in self.routes]
+
+    def _candidates(self, number):
+        ranked = []
+        for route in self.routes:
+            cost = route.cost(number)
+            if cost is not None:
+                ranked.append((route.name != self.preferred, cost + self.latency_weight * route.latency, route))
+        ranked.sort(key=lambda item: item[:2])
+        return tuple(route for _, _, route in ranked)
+
+    def _buckets(self, route, numbers, limits):
+        buckets = [(f'route:{route.name}', len(numbers), route.rate, route.burst)]
+        if self.prefix_limits is not None:
+            counts = {}
+            for number in numbers:
+                match = self.prefix_limits.match(number)
+                if match is not None:
+                    counts[match] = counts.get(match, 0) + 1
+            buckets.extend((f'prefix:{prefix}', count, rate, None) for (prefix, rate), count in counts.items())
+        buckets.extend((key, len(numbers), rate, burst) for key, rate, burst in limits)
+        return buckets
+
+    def _send_route(self, route, numbers, content, limits):
+        """Send on one route, resending throttled numbers once the route has slowed down"""
+        results = {}
+        pending = numbers
+        for attempt in range(self.throttle_retries + 1):
+            if self.limiter is not None:
+                self.limiter.acquire(self._buckets(route, pending, limits))
+            started = time.monotonic()
+            try:
+                outcome = route.backend.send_batch(pending, content)
+            except Exception as e:
+                outcome = [(number, False, str(e) or type(e).__name__) for number in pending]
+
+            throttled = []
+            for number, success, result in outcome:
+                results[number] = (number, success, result)
+                if not success and is_throttled(result):
+                    throttled.append(number)
+            # Being throttled says the gateway is up, it must not trip the breaker
+            route.record(bool(throttled) or any(success for _, success, _ in outcome),
+                         time.monotonic() - started)
+
+            if not throttled or self.limiter is None or not route.rate:
+                break
+            self.limiter.throttled(f'route:{route.name}', route.rate)
+            logger.warning(f"Route {route.name} throttled {len(throttled)} numbers, resending")
+            pending = throttled
+        return [results[number] for number in numbers]
+
+    def send_batch(self, numbers, content, limits=()):
+        """
+        Send the same content to many numbers
+        :param limits: Extra token buckets as (key, rate, burst), charged one token per number
+        :return: List of (number, success, message_id or error, route name) in input order
+        """
+        groups = {}
+        for number in numbers:
+            groups.setdefault(self._candidates(number), []).append(number)
+
+        results = {}
+        for candidates, group in groups.items():
+            error = 'No healthy route for destination'
+            for route in candidates:
+                if not route.healthy():
+                    continue
+                outcome = self._send_route(route, group, content, limits)
+                accepted = sum(1 for _, success, _ in outcome if success)
+
+                if accepted:
+                    route.stats['sent'] += accepted
+                    route.stats['failed'] += len(outcome) - accepted
+                    for number, success, result in outcome:
+                        results[number] = (number, success, result, route.name)
+                    break
+                error = outcome[0][2] if outcome else error
+                logger.warning(f"Route {route.name} failed for {len(group)} numbers: {error}")
+
+                # Numbers that may have reached the gateway are not sent on another route
+                group = []
+                for number, _, result in outcome:
+                    if is_not_sent(result):
+                        group.append(number)
+                    else:
+                        results[number] = (number, False, result, route.name)
+                if not group:
+                    break
+            else:
+                for number in group:
+                    results[number] = (number, False, error, None)
+
+        return [results[number] for number in numbers]
+
+    def send(self, number, content, limits=()):
+        """:return: (success, message_id or error, route name)"""
+        _, success, result, route = self.send_batch([number], content, limits)[0]
+        return success, result, route
@@ -0,0 +1,102 @@
+import collections
+import threading
+
+TRANSACTIONAL = 'transactional'
+BULK = 'bulk'
+
+class _Lane:
+    __slots__ = ('queues', 'active', 'deficit', 'items', 'cost')
+
+    def __init__(self):
+        self.queues = {}  # tenant -> deque of (item, cost)
+        self.active = collections.deque()  # tenants with queued items, in round-robin order
+        self.deficit = {}
+        self.items = 0
+        self.cost = 0
+
+class FairScheduler:
+    """
+    Thread-safe queue with priority lanes and fair sharing between tenants.
+
+    Lanes are served in strict priority order: an item is only taken from a
+    lane when every lane before it is empty. Within a lane, tenants (user
+    accounts) take turns by deficit round robin: each turn a tenant may take
+    items worth ``quantum * weight`` cost units, so a tenant with a 100k
+    campaign queued gets the same share as one with a single chunk instead
+    of everything it queued first.
+    """
+
+    def __init__(self, lanes=(TRANSACTIONAL, BULK), quantum=100, weights=None):
+        """
+        :param lanes: Lane names, highest priority first
+        :param quantum: Cost units a tenant of weight 1 may take per turn
+        :param weights: {tenant: weight} for tenants with a larger or smaller share
+        """
+        self.lanes = collections.OrderedDict((lane, _Lane()) for lane in lanes)
+        self.quantum = quantum
+        self.weights = weights or {}
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def put(self, item, lane=BULK, tenant=None, cost=1):
+        """Queue an item for a tenant; cost is the work it represents, e.g. messages"""
+        with self._condition:
+            state = self.lanes[lane]
+            pending = state.queues.get(tenant)
+            if pending is None:
+                pending = state.queues[tenant] = collections.deque()
+                state.active.append(tenant)
+                state.deficit[tenant] = 0
+            pending.append((item, cost))
+            state.items += 1
+            state.cost += cost
+            # Waiters may be restricted to other lanes, wake them all so one that serves this lane takes it
+            self._condition.notify_all()
+
+    def get(self, lanes=None, timeout=None):
+        """
+        Take the next item, waiting until one is queued
+        :param lanes: Only take from these lanes (e.g. workers reserved for transactional traffic)
+        :return: The item, or None once closed or after the timeout
+        """
+        with self._condition:
+            while True:
+                for name, state in self.lanes.items():
+                    if state.items and (lanes is None or name in lanes):
+                        return self._take(state)
+                if self._closed or not self._condition.wait(timeout):
+                    return None
+
+    def _take(self, state):
+        while True:
+            tenant = state.active[0]
+            pending = state.queues[tenant]
+            item, cost = pending[0]
+            if state.deficit[tenant] >= cost:
+                break
+            # The tenant's turn is over, the next one gets its quantum
+            state.active.rotate(-1)
+            head = state.active[0]
+            state.deficit[head] += self.quantum * self.weights.get(head, 1)
+
+        pending.popleft()
+        state.deficit[tenant] -= cost
+        state.items -= 1
+        state.cost -= cost
+        if not pending:
+            state.active.popleft()
+            del state.queues[tenant]
+            del state.deficit[tenant]
+        return item
+
+    def close(self):
+        """Wake all waiting consumers; get() returns None once the lanes are empty"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def depth(self):
+        """:return: {lane: {'items', 'cost', 'tenants'}} of what is queued"""
+        with self._condition:
+            return {name: {'items': state.items, 'cost': state.cost, 'tenants': len(state.queues)}
+                    for name, state in self.lanes.items()}
@@ -1,22 +1,413 @@
 import smpplib.client
 import smpplib.gsm
 import smpplib.consts
+import smpplib.exceptions
+import smpplib.smpp
 import logging
+import os
+import select
+import threading
 import time
 import socket
+from concurrent.futures import Future
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger('smpp_client')
 
+# System types tried in order when binding
+SYSTEM_TYPES = ['', 'SMPP', 'WWW']
+
+def bind_transceiver(client, system_id, password):
+    """
+    Bind an SMPP client as a transceiver, trying each known system type
+    :return: The system type that was accepted
+    """
+    logger.debug(f"Attempting to bind with system_id: '{system_id}'")
+    for system_type in SYSTEM_TYPES:
+        try:
+            logger.debug(f"Trying bind with system_type: '{system_type}'")
+            bind_response = client.bind_transceiver(
+                system_id=system_id,
+                password=password,
+                system_type=system_type,
+                interface_version=0x34,  # SMPP version 3.4
+                addr_ton=0,
+                addr_npi=0,
+                address_range=''
+            )
+
+            if bind_response.status == smpplib.consts.SMPP_ESME_ROK:
+                return system_type
+        except smpplib.exceptions.ConnectionError:
+            raise
+        except Exception as e:
+            logger.debug(f"Bind attempt with system_type '{system_type}' failed: {str(e)}")
+            continue
+
+    raise Exception("All bind attempts failed")
+
+class _Client(smpplib.client.Client):
+    """smpplib client whose PDU writes are safe to call from several threads"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.send_lock = threading.RLock()
+
+    def send_pdu(self, p):
+        with self.send_lock:
+            return super().send_pdu(p)
+
+class SMPPSession:
+    """
+    A long-lived transceiver bind with a window of in-flight submit_sm PDUs.
+
+    submit() writes the PDU and returns a Future right away; a reader thread
+    resolves it when the submit_sm_resp with the same sequence number arrives.
+    The reader also sends enquire_link when the link is idle and rebinds
+    after the connection drops.
+    """
+
+    def __init__(self, host, port, system_id, password, window=10, enquire_link_interval=30,
+                 response_timeout=30, on_deliver=None, name='smpp'):
+        """
+        :param window: Maximum number of unacknowledged submit_sm PDUs
+        :param enquire_link_interval: Idle seconds before sending enquire_link
+        :param response_timeout: Seconds to wait for a submit_sm_resp
+        :param on_deliver: Callable(pdu) for deliver_sm PDUs, may return a command_status
+        """
+        self.host = host
+        self.port = port
+        self.system_id = system_id
+        self.password = password
+        self.window = window
+        self.enquire_link_interval = enquire_link_interval
+        self.response_timeout = response_timeout
+        self.on_deliver = on_deliver
+        self.name = name
+        self.limiter = None  # rate_limit.TokenBucketLimiter shaping this bind
+        self.rate = None
+        self.burst = None
+
+        self.client = None
+        self.bound = False
+        self._window = threading.BoundedSemaphore(window)
+        self._pending = {}  # sequence -> (future, sent_at)
+        self._pending_lock = threading.Lock()
+        self._bound_event = threading.Event()
+        self._running = False
+        self._thread = None
+        self._last_activity = 0
+
+    @property
+    def in_flight(self):
+        return len(self._pending)
+
+    def start(self):
+        """Start the reader thread, which connects and binds in the background"""
+        if self._thread:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=f'{self.name}-reader', daemon=True)
+        self._thread.start()
+
+    def wait_bound(self, timeout=None):
+        return self._bound_event.wait(timeout)
+
+    @property
+    def limit_key(self):
+        return f'bind:{self.system_id}@{self.host}:{self.port}/{self.name}'
+
+    def set_limiter(self, limiter, rate, burst=None):
+        """
+        Shape submits on this bind with a shared token bucket
+        :param rate: Maximum submit_sm per second, lowered while the SMSC answers ESME_RTHROTTLED
+        """
+        self.limiter = limiter
+        self.rate = rate
+        self.burst = burst
+
+    def close(self):
+        """Unbind and stop the reader thread"""
+        self._running = False
+        client = self.client
+        if client and self.bound:
+            try:
+                client.send_pdu(smpplib.smpp.make_pdu('unbind', client=client))
+            except Exception as e:
+                logger.debug(f"Error sending unbind on {self.name}: {str(e)}")
+        if self._thread:
+            self._thread.join(5)
+            self._thread = None
+        self._drop_connection("Session closed")
+
+    def submit(self, timeout=None, **kwargs):
+        """
+        Send a submit_sm PDU without waiting for the response
+        :param timeout: Seconds to wait for a free window slot
+        :return: Future resolved with the submit_sm_resp PDU
+        """
+        if not self.bound:
+            raise smpplib.exceptions.ConnectionError(f"{self.name} is not bound")
+        if self.limiter is not None and not self.limiter.acquire(
+                [(self.limit_key, 1, self.rate, self.burst)], timeout=timeout):
+            raise TimeoutError(f"{self.name} submit rate limit reached")
+        if not self._window.acquire(timeout=timeout):
+            raise TimeoutError(f"{self.name} submit window is full")
+
+        future = Future()
+        future.add_done_callback(lambda f: self._window.release())
+        client = self.client
+        sequence = None
+        try:
+            with client.send_lock:
+                pdu = smpplib.smpp.make_pdu('submit_sm', client=client, **kwargs)
+                sequence = pdu.sequence
+                with self._pending_lock:
+                    self._pending[sequence] = (future, time.monotonic())
+                client.send_pdu(pdu)
+            self._last_activity = time.monotonic()
+        except Exception as e:
+            self._resolve(sequence, exception=e, future=future)
+        return future
+
+    def _resolve(self, sequence, result=None, exception=None, future=None):
+        with self._pending_lock:
+            entry = self._pending.pop(sequence, None)
+        future = future or (entry[0] if entry else None)
+        if future is None or future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def _on_submit_resp(self, pdu, **kwargs):
+        if pdu.status == smpplib.consts.SMPP_ESME_RTHROTTLED and self.limiter is not None:
+            try:
+                self.limiter.throttled(self.limit_key, self.rate)
+            except Exception as e:
+                logger.error(f"{self.name} could not lower its submit rate: {str(e)}")
+        self._resolve(pdu.sequence, result=pdu)
+
+    def _on_error_pdu(self, pdu):
+        # submit_sm_resp errors are resolved through _on_submit_resp with their status
+        if pdu.command != 'submit_sm_resp':
+            logger.warning(f"{self.name} received error PDU {pdu.command} with status {pdu.status}")
+
+    def _on_deliver(self, pdu, **kwargs):
+        if self.on_deliver:
+            return self.on_deliver(pdu)
+        return None
+
+    def _connect(self):
+        client = _Client(self.host, self.port, timeout=self.response_timeout,
+                         allow_unknown_opt_params=True)
+        client.set_message_sent_handler(self._on_submit_resp)
+        client.set_message_received_handler(self._on_deliver)
+        client.set_error_pdu_handler(self._on_error_pdu)
+        client.connect()
+        system_type = bind_transceiver(client, self.system_id, self.password)
+        self.client = client
+        self.bound = True
+        self._last_activity = time.monotonic()
+        self._bound_event.set()
+        logger.info(f"{self.name} bound to {self.host}:{self.port} with system_type: '{system_type}'")
+
+    def _drop_connection(self, reason):
+        self.bound = False
+        self._bound_event.clear()
+        if self.client:
+            try:
+                self.client.disconnect()
+            except Exception:
+                pass
+            self.client = None
+        with self._pending_lock:
+            pending = list(self._pending.items())
+            self._pending.clear()
+        for sequence, (future, sent_at) in pending:
+            if not future.done():
+                future.set_exception(smpplib.exceptions.ConnectionError(reason))
+
+    def _expire_pending(self):
+        deadline = time.monotonic() - self.response_timeout
+        with self._pending_lock:
+            expired = [seq for seq, (future, sent_at) in self._pending.items() if sent_at < deadline]
+        for sequence in expired:
+            self._resolve(sequence, exception=TimeoutError("No submit_sm_resp received"))
+
+    def _run(self):
+        backoff = 1
+        while self._running:
+            if not self.bound:
+                try:
+                    self._connect()
+                    backoff = 1
+                except Exception as e:
+                    logger.error(f"{self.name} failed to bind: {str(e)}, retrying in {backoff}s")
+                    self._drop_connection(str(e))
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, 30)
+                    continue
+
+            try:
+                readable, _, _ = select.select([self.client._socket], [], [], 1)
+                if readable:
+                    self.client.read_once(auto_send_enquire_link=False)
+                    self._last_activity = time.monotonic()
+                elif time.monotonic() - self._last_activity > self.enquire_link_interval:
+                    self.client.send_pdu(smpplib.smpp.make_pdu('enquire_link', client=self.client))
+                    self._last_activity = time.monotonic()
+                self._expire_pending()
+            except Exception as e:
+                reason = str(e) or type(e).__name__
+                if self._running:
+                    logger.error(f"{self.name} connection lost: {reason}, rebinding")
+                self._drop_connection(f"Connection lost: {reason}")
+
+class SMPPSessionPool:
+    """Pool of bound SMPP sessions; submits go to the least busy bound session"""
+
+    def __init__(self, host, port, system_id, password, size=1, window=10, enquire_link_interval=30,
+                 response_timeout=30, on_deliver=None):
+        self.sessions = [
+            SMPPSession(host, port, system_id, password, window=window,
+                        enquire_link_interval=enquire_link_interval,
+                        response_timeout=response_timeout, on_deliver=on_deliver,
+                        name=f'smpp-{i}')
+            for i in range(max(1, size))
+        ]
+
+    def start(self):
+        for session in self.sessions:
+            session.start()
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
+
+    def wait_bound(self, timeout=None):
+        """Wait until at least one session is bound"""
+        deadline = time.monotonic() + (timeout or 0)
+        while True:
+            if any(session.bound for session in self.sessions):
+                return True
+            if timeout is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+
+    @property
+    def bound(self):
+        return any(session.bound for session in self.sessions)
+
+    def set_deliver_handler(self, handler):
+        for session in self.sessions:
+            session.on_deliver = handler
+
+    def set_limiter(self, limiter, rate, burst=None):
+        """Give every bind its own token bucket of rate submit_sm per second"""
+        for session in self.sessions:
+            session.set_limiter(limiter, rate, burst)
+
+    def submit(self, timeout=None, **kwargs):
+        """Submit a PDU on the bound session with the fewest in-flight requests"""
+        bound = [session for session in self.sessions if session.bound]
+        if not bound:
+            raise smpplib.exceptions.ConnectionError("No bound SMPP session available")
+        session = min(bound, key=lambda s: s.in_flight)
+        return session.submit(timeout=timeout, **kwargs)
+
+    def _submit_parts(self, source_addr, destination_addr, parts, encoding_flag, msg_type_flag, timeout):
+        return [
+            self.submit(
+                timeout=timeout,
+                source_addr_ton=smpplib.consts.SMPP_TON_ALNUM,
+                source_addr_npi=smpplib.consts.SMPP_NPI_UNK,
+                source_addr=source_addr,
+                dest_addr_ton=smpplib.consts.SMPP_TON_INTL,
+                dest_addr_npi=smpplib.consts.SMPP_NPI_ISDN,
+                destination_addr=destination_addr,
+                short_message=part,
+                data_coding=encoding_flag,
+                esm_class=msg_type_flag,
+                registered_delivery=True
+            )
+            for part in parts
+        ]
+
+    def _collect(self, futures, timeout):
+        """Wait for the submit_sm_resp of every part :return: SMSC message ids"""
+        message_ids = []
+        for future in futures:
+            response = future.result(timeout)
+            if response.status != smpplib.consts.SMPP_ESME_ROK:
+                raise Exception(f"Message send failed with status: {response.status}")
+            message_id = response.message_id
+            if isinstance(message_id, bytes):
+                message_id = message_id.decode('ascii', 'ignore')
+            message_ids.append(message_id)
+        return message_ids
+
+    def send_message(self, source_addr, destination_addr, message, timeout=None):
+        """
+        Send a (possibly multipart) message, keeping all parts in flight at once
+        :return: (success, result) with the SMSC message ids on success
+        """
+        try:
+            parts, encoding_flag, msg_type_flag = smpplib.gsm.make_parts(message)
+            logger.debug(f"Message split into {len(parts)} parts")
+
+            futures = self._submit_parts(source_addr, destination_addr, parts, encoding_flag, msg_type_flag, timeout)
+            message_ids = self._collect(futures, timeout)
+
+            logger.info(f"Successfully sent message to {destination_addr}")
+            return True, {'message_id': message_ids[0] if message_ids else None, 'message_ids': message_ids}
+        except Exception as e:
+            logger.error(f"Error sending message: {str(e)}")
+            return False, str(e)
+
+    def send_messages(self, source_addr, destination_addrs, message, timeout=None):
+        """
+        Send the same message to many destinations, all submits sharing the
+        pool's windows instead of waiting for each destination in turn
+        :return: List of (destination, success, message_id or error)
+        """
+        parts, encoding_flag, msg_type_flag = smpplib.gsm.make_parts(message)
+        submitted = []
+        for destination_addr in destination_addrs:
+            try:
+                submitted.append((destination_addr, self._submit_parts(
+                    source_addr, destination_addr, parts, encoding_flag, msg_type_flag, timeout)))
+            except Exception as e:
+                submitted.append((destination_addr, str(e) or type(e).__name__))
+
+        results = []
+        for destination_addr, futures in submitted:
+            if isinstance(futures, str):
+                results.append((destination_addr, False, futures))
+                continue
+            try:
+                results.append((destination_addr, True, self._collect(futures, timeout)[0]))
+            except Exception as e:
+                results.append((destination_addr, False, str(e) or type(e).__name__))
+        return results
+
 class SMPPClient:
-    def __init__(self, host, port, system_id, password):
+    def __init__(self, host, port, system_id, password, pool_size=1, window=10, enquire_link_interval=30):
+        """
+        :param pool_size: Number of transceiver binds kept open
+        :param window: Maximum in-flight submit_sm PDUs per bind
+        :param enquire_link_interval: Idle seconds before a keepalive enquire_link
+        """
         self.host = host
         self.port = port
         # Try to normalize the credentials
         self.system_id = system_id.strip().encode('ascii').decode('ascii')
         self.password = password.strip().encode('ascii').decode('ascii')
-        self.client = None
+        self.pool = SMPPSessionPool(host, port, self.system_id, self.password, size=pool_size,
+                                    window=window, enquire_link_interval=enquire_link_interval,
+                                    on_deliver=self.handle_message)
         self.connected = False
 
     def test_connection(self):
@@ -31,64 +422,32 @@ class SMPPClient:
             logger.error(f"TCP connection test failed: {str(e)}")
             return False
 
-    def connect(self):
+    def connect(self, timeout=10):
         try:
             logger.debug(f"Attempting to connect to SMPP server at {self.host}:{self.port}")
-            
+
             # First test TCP connection
             if not self.test_connection():
                 raise Exception("Cannot establish TCP connection to server")
-            
-            # Create SMPP client
-            self.client = smpplib.client.Client(self.host, self.port)
-            self.client.set_message_received_handler(self.handle_message)
-            
-            # Connect and bind
-            logger.debug("Attempting to connect...")
-            self.client.connect()
-            
-            logger.debug(f"Attempting to bind with system_id: '{self.system_id}' and password: '{self.password}'")
-            # Try binding with different system types
-            system_types = ['', 'SMPP', 'WWW']
-            
-            for system_type in system_types:
-                try:
-                    logger.debug(f"Trying bind with system_type: '{system_type}'")
-                    bind_response = self.client.bind_transceiver(
-                        system_id=self.system_id,
-                        password=self.password,
-                        system_type=system_type,
-                        interface_version=0x34,  # SMPP version 3.4
-                        addr_ton=0,
-                        addr_npi=0,
-                        address_range=''
-                    )
-                    
-                    if bind_response.status == smpplib.consts.SMPP_ESME_ROK:
-                        self.connected = True
-                        logger.info(f"Successfully connected and bound to SMPP server with system_type: {system_type}")
-                        return True
-                except Exception as e:
-                    logger.debug(f"Bind attempt with system_type '{system_type}' failed: {str(e)}")
-                    continue
-            
-            raise Exception("All bind attempts failed")
-            
+
+            # Bound sessions are kept open and rebound by the pool
+            self.pool.start()
+            if not self.pool.wait_bound(timeout):
+                raise Exception("All bind attempts failed")
+
+            self.connected = True
+            logger.info("Successfully connected and bound to SMPP server")
+            return True
+
         except Exception as e:
             logger.error(f"Failed to connect to SMPP server: {str(e)}")
-            if self.client:
-                try:
-                    self.client.disconnect()
-                except:
-                    pass
             return False
 
     def disconnect(self):
-        if self.client and self.connected:
+        if self.connected:
             try:
                 logger.debug("Attempting to unbind and disconnect from SMPP server")
-                self.client.unbind()
-                self.client.disconnect()
+                self.pool.close()
                 self.connected = False
                 logger.info("Successfully disconnected from SMPP server")
             except Exception as e:
@@ -100,38 +459,8 @@ class SMPPClient:
             if not self.connect():
                 return False, "Failed to connect to SMPP server"
 
-        try:
-            logger.debug(f"Preparing to send message to {destination_addr}")
-            # Encode message parts if needed
-            parts, encoding_flag, msg_type_flag = smpplib.gsm.make_parts(message)
-            logger.debug(f"Message split into {len(parts)} parts")
-            
-            for i, part in enumerate(parts, 1):
-                logger.debug(f"Sending part {i}/{len(parts)}")
-                response = self.client.send_message(
-                    source_addr_ton=smpplib.consts.SMPP_TON_ALNUM,
-                    source_addr_npi=smpplib.consts.SMPP_NPI_UNK,
-                    source_addr=source_addr,
-                    dest_addr_ton=smpplib.consts.SMPP_TON_INTL,
-                    dest_addr_npi=smpplib.consts.SMPP_NPI_ISDN,
-                    destination_addr=destination_addr,
-                    short_message=part,
-                    data_coding=encoding_flag,
-                    esm_class=msg_type_flag,
-                    registered_delivery=True
-                )
-                
-                if response.status != smpplib.consts.SMPP_ESME_ROK:
-                    raise Exception(f"Message send failed with status: {response.status}")
-                
-                # Add a small delay between parts
-                time.sleep(0.1)
-            
-            logger.info(f"Successfully sent message to {destination_addr}")
-            return True, "Message sent successfully"
-        except Exception as e:
-            logger.error(f"Error sending message: {str(e)}")
-            return False, str(e)
+        logger.debug(f"Preparing to send message to {destination_addr}")
+        return self.pool.send_message(source_addr, destination_addr, message)
 
     def handle_message(self, pdu):
         logger.info(f"Received message PDU: {pdu}")
@@ -145,5 +474,8 @@ smpp_client = SMPPClient(
     host='85.239.241.134',
     port=20002,
     system_id='MX-Route',  # Exact username
-    password='MX-Route'    # Exact password
-) 
\ No newline at end of file
+    password='MX-Route',   # Exact password
+    pool_size=int(os.getenv('SMPP_POOL_SIZE', 1)),
+    window=int(os.getenv('SMPP_WINDOW', 10)),
+    enquire_link_interval=int(os.getenv('SMPP_ENQUIRE_LINK_INTERVAL', 30))
+)
@@ -1,6 +1,9 @@
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import logging
+import os
+import threading
 import urllib.parse
 from datetime import datetime
 
@@ -8,11 +11,89 @@ from datetime import datetime
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger('sms_client')
 
+# getreport status codes mapped to Message.status; ids the gateway has no
+# report for yet are left out of the response and stay pending
+REPORT_STATUS = {
+    0: 'delivered',
+    1: 'undelivered',
+    2: 'expired',
+}
+
 class SMSClient:
-    def __init__(self, host, port, account, password):
+    def __init__(self, host, port, account, password, pool_maxsize=10, connect_timeout=5, read_timeout=30,
+                 batch_size=100, report_batch_size=200, number_error_statuses=None, max_split_depth=2):
+        """
+        :param pool_maxsize: Maximum number of keep-alive connections to the gateway host
+        :param connect_timeout: Seconds to wait for the TCP connection
+        :param read_timeout: Seconds to wait for the gateway response
+        :param batch_size: Default number of recipients per batched send request
+        :param report_batch_size: Default number of message ids per getreport request
+        :param number_error_statuses: Gateway status values caused by a single bad number;
+            only these split a rejected batch, any other status fails the whole batch.
+            None when the codes are unknown, then rejects split up to max_split_depth times
+        :param max_split_depth: Halvings of a rejected batch when number_error_statuses is None
+        """
         self.base_url = f"http://{host}:{port}"
         self.account = account
         self.password = password
+        self.pool_maxsize = pool_maxsize
+        self.timeout = (connect_timeout, read_timeout)
+        self.batch_size = batch_size
+        self.report_batch_size = report_batch_size
+        self.number_error_statuses = None if number_error_statuses is None else set(number_error_statuses)
+        self.max_split_depth = max_split_depth
+
+        # Reuse keep-alive connections instead of opening one per request.
+        # pool_block makes callers wait for a free connection once the
+        # per-host limit is reached rather than opening extra sockets.
+        self.session = requests.Session()
+        self._adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, pool_block=True)
+        self.session.mount('http://', self._adapter)
+        self.session.mount('https://', self._adapter)
+
+        self._stats_lock = threading.Lock()
+        self._in_flight = 0
+        self._requests = 0
+
+    def _get(self, url):
+        """Issue a GET request through the pooled session"""
+        with self._stats_lock:
+            self._in_flight += 1
+        try:
+            return self.session.get(url, timeout=self.timeout)
+        finally:
+            with self._stats_lock:
+                self._in_flight -= 1
+                self._requests += 1
+
+    def get_pool_stats(self):
+        """
+        Get connection pool statistics
+        :return: dict with requests, hits (reused connections), misses (new connections),
+                 in-flight requests and idle connections
+        """
+        misses = 0
+        pool_requests = 0
+        idle = 0
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            misses += pool.num_connections
+            pool_requests += pool.num_requests
+            if pool.pool is not None:
+                idle += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+
+        with self._stats_lock:
+            return {
+                'requests': self._requests,
+                'hits': max(pool_requests - misses, 0),
+                'misses': misses,
+                'in_flight': self._in_flight,
+                'idle': idle,
+                'max_connections': self.pool_maxsize
+            }
 
     def get_balance(self):
         """
@@ -34,7 +115,7 @@ class SMSClient:
             # 
             # logger.debug(f"Getting balance from {url}")
             # 
-            # response = requests.get(url)
+            # response = self._get(url)
             # response.raise_for_status()
             # 
             # result = response.json()
@@ -80,7 +161,7 @@ class SMSClient:
             
             logger.debug(f"Getting daily stats from {url}")
             
-            response = requests.get(url)
+            response = self._get(url)
             response.raise_for_status()
             
             result = response.json()
@@ -96,6 +177,44 @@ class SMSClient:
             logger.error(f"Error getting daily stats: {str(e)}")
             return False, str(e)
 
+    def _request_send(self, numbers, content, mmstitle="mmstitle_text", sender=None, sendtime=None):
+        """
+        Call the /sendsms endpoint
+        :return: Parsed gateway response (raises on transport or HTTP errors)
+        """
+        # Convert single number to list if needed
+        if isinstance(numbers, str):
+            numbers = [numbers]
+        
+        # URL encode parameters
+        params = {
+            "account": self.account,
+            "password": self.password,
+            "smstype": "0",
+            "numbers": ",".join(numbers),
+            "content": urllib.parse.quote(content),
+            "mmstitle": urllib.parse.quote(mmstitle)
+        }
+        
+        if sender:
+            params["sender"] = urllib.parse.quote(sender)
+        if sendtime:
+            params["sendtime"] = sendtime
+        
+        # Build the URL with parameters
+        param_string = "&".join([f"{k}={v}" for k, v in params.items()])
+        url = f"{self.base_url}/sendsms?{param_string}"
+        
+        logger.debug(f"Sending SMS request to {url}")
+        
+        # Send GET request
+        response = self._get(url)
+        
+        response.raise_for_status()
+        result = response.json()
+        logger.debug(f"Response: {result}")
+        return result
+
     def send_sms(self, numbers, content, mmstitle="mmstitle_text", sender=None, sendtime=None):
         """
         Send SMS to one or more numbers
@@ -107,37 +226,7 @@ class SMSClient:
         :return: (success, result)
         """
         try:
-            # Convert single number to list if needed
-            if isinstance(numbers, str):
-                numbers = [numbers]
-            
-            # URL encode parameters
-            params = {
-                "account": self.account,
-                "password": self.password,
-                "smstype": "0",
-                "numbers": ",".join(numbers),
-                "content": urllib.parse.quote(content),
-                "mmstitle": urllib.parse.quote(mmstitle)
-            }
-            
-            if sender:
-                params["sender"] = urllib.parse.quote(sender)
-            if sendtime:
-                params["sendtime"] = sendtime
-            
-            # Build the URL with parameters
-            param_string = "&".join([f"{k}={v}" for k, v in params.items()])
-            url = f"{self.base_url}/sendsms?{param_string}"
-            
-            logger.debug(f"Sending SMS request to {url}")
-            
-            # Send GET request
-            response = requests.get(url)
-            
-            response.raise_for_status()
-            result = response.json()
-            logger.debug(f"Response: {result}")
+            result = self._request_send(numbers, content, mmstitle, sender, sendtime)
             
             if result.get("status") == 0:
                 return True, result
@@ -149,6 +238,80 @@ class SMSClient:
             logger.error(f"Error sending SMS: {str(e)}")
             return False, str(e)
 
+    def send_sms_batch(self, numbers, content, batch_size=None, mmstitle="mmstitle_text", sender=None, sendtime=None):
+        """
+        Send the same SMS to many numbers, packing up to batch_size recipients per request.
+        A batch rejected for a bad number is split in half and retried until the
+        offending numbers are isolated; account-level rejects (balance, credentials,
+        sender) fail the whole batch without further requests.
+        :param numbers: List of phone numbers
+        :param batch_size: Recipients per request (defaults to self.batch_size)
+        :return: List of (number, success, message_id or error) in the order of numbers
+        """
+        batch_size = batch_size or self.batch_size
+        options = {'mmstitle': mmstitle, 'sender': sender, 'sendtime': sendtime}
+        results = []
+        for start in range(0, len(numbers), batch_size):
+            results.extend(self._send_batch(list(numbers[start:start + batch_size]), content, options))
+        return results
+
+    def _send_batch(self, numbers, content, options, depth=0):
+        try:
+            result = self._request_send(numbers, content, **options)
+        except Exception as e:
+            # Transport errors affect the whole batch, splitting would not help
+            logger.error(f"Error sending SMS batch of {len(numbers)} numbers: {str(e)}")
+            return [(number, False, str(e)) for number in numbers]
+
+        if result.get("status") == 0:
+            return self.map_send_result(numbers, result)
+
+        error = f"Failed to send SMS: {result.get('desc', 'Unknown error')} (status: {result.get('status')})"
+        if len(numbers) == 1 or not self._should_split(result.get("status"), depth):
+            if len(numbers) > 1:
+                logger.warning(f"Gateway rejected batch of {len(numbers)} numbers: {error}")
+            return [(number, False, error) for number in numbers]
+
+        logger.warning(f"Gateway rejected batch of {len(numbers)} numbers, splitting: {error}")
+        middle = len(numbers) // 2
+        return (self._send_batch(numbers[:middle], content, options, depth + 1) +
+                self._send_batch(numbers[middle:], content, options, depth + 1))
+
+    def _should_split(self, status, depth):
+        """Whether a rejected batch may be blamed on some of its numbers"""
+        if self.number_error_statuses is None:
+            return depth < self.max_split_depth
+        try:
+            return int(status) in self.number_error_statuses
+        except (TypeError, ValueError):
+            return False
+
+    @staticmethod
+    def map_send_result(numbers, result):
+        """
+        Map the per-number "array" of a /sendsms response ([[number, msgid], ...])
+        back to the requested numbers
+        """
+        entries = result.get("array")
+        if entries is None:
+            # No per-number detail, the whole batch was accepted
+            return [(number, True, None) for number in numbers]
+
+        ids = {}
+        for entry in entries:
+            if isinstance(entry, (list, tuple)) and len(entry) >= 2:
+                digits = ''.join(filter(str.isdigit, str(entry[0])))
+                ids.setdefault(digits, []).append(str(entry[1]))
+
+        mapped = []
+        for number in numbers:
+            pending = ids.get(''.join(filter(str.isdigit, number)))
+            if pending:
+                mapped.append((number, True, pending.pop(0)))
+            else:
+                mapped.append((number, False, "Number rejected by gateway"))
+        return mapped
+
     def get_report(self, ids):
         """
         Get SMS delivery reports
@@ -174,7 +337,7 @@ class SMSClient:
             
             logger.debug(f"Getting report from {url}")
             
-            response = requests.get(url)
+            response = self._get(url)
             response.raise_for_status()
             
             result = response.json()
@@ -190,6 +353,35 @@ class SMSClient:
             logger.error(f"Error getting report: {str(e)}")
             return False, str(e)
 
+    def get_report_batch(self, ids, batch_size=None):
+        """
+        Get delivery reports for many message ids, batch_size ids per request
+        :param ids: List of message IDs
+        :param batch_size: IDs per request (defaults to self.report_batch_size)
+        :return: dict of message_id -> status for the ids that have a final report
+        """
+        batch_size = batch_size or self.report_batch_size
+        ids = [str(message_id) for message_id in ids]
+        statuses = {}
+        for start in range(0, len(ids), batch_size):
+            success, result = self.get_report(ids[start:start + batch_size])
+            if not success:
+                logger.error(f"Failed to get report batch: {result}")
+                continue
+
+            # Each entry is [msgid, number, report time, status code]
+            for entry in result.get("array") or []:
+                if not isinstance(entry, (list, tuple)) or len(entry) < 2:
+                    continue
+                try:
+                    code = int(entry[-1])
+                except (TypeError, ValueError):
+                    continue
+                # Unknown codes (e.g. still pending) leave the message to the next poll
+                if code in REPORT_STATUS:
+                    statuses[str(entry[0])] = REPORT_STATUS[code]
+        return statuses
+
     def add_credits(self, amount):
         """
         Add or subtract credits from the system balance
@@ -217,7 +409,7 @@ class SMSClient:
             # 
             # logger.debug(f"Adding credits via {url}")
             # 
-            # response = requests.get(url)
+            # response = self._get(url)
             # response.raise_for_status()
             # 
             # result = response.json()
@@ -260,5 +452,15 @@ sms_client = SMSClient(
     host='45.61.157.94',  # Updated SMPP server IP
     port=20003,  # HTTP Port
     account='XQB250213A',  # Updated username
-    password='ABD55DBB'  # Updated auth password
+    password='ABD55DBB',  # Updated auth password
+    pool_maxsize=int(os.getenv('SMS_HTTP_POOL_SIZE', 10)),
+    connect_timeout=float(os.getenv('SMS_HTTP_CONNECT_TIMEOUT', 5)),
+    read_timeout=float(os.getenv('SMS_HTTP_READ_TIMEOUT', 30)),
+    batch_size=int(os.getenv('SMS_BATCH_SIZE', 100)),
+    report_batch_size=int(os.getenv('SMS_REPORT_BATCH_SIZE', 200)),
+    # Gateway status values that blame a single number, e.g. "-3,-4"; unset splits
+    # any rejected batch up to SMS_MAX_SPLIT_DEPTH times
+    number_error_statuses=[int(status) for status in os.getenv('SMS_NUMBER_ERROR_STATUSES', '').split(',')
+                           if status.strip()] or None,
+    max_split_depth=int(os.getenv('SMS_MAX_SPLIT_DEPTH', 2))
 ) 
\ No newline at end of file
@@ -42,10 +42,105 @@ INSERT INTO system_settings (key, value)
 VALUES ('system_balance', '1000.0')
 ON CONFLICT (key) DO NOTHING;
 
+-- Per-destination rates by E.164 prefix; rows with a user_id override the shared rates for that user
+CREATE TABLE IF NOT EXISTS destination_rates (
+    id SERIAL PRIMARY KEY,
+    prefix TEXT NOT NULL,
+    rate FLOAT NOT NULL,
+    user_id INTEGER REFERENCES users(id),
+    UNIQUE (user_id, prefix)
+);
+
+-- Append-only history of system balance changes
+CREATE TABLE IF NOT EXISTS system_ledger (
+    id BIGSERIAL PRIMARY KEY,
+    amount NUMERIC NOT NULL,
+    balance NUMERIC,
+    reason TEXT NOT NULL,
+    reference TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Outcome of send requests by idempotency key, so client retries are not sent twice
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key TEXT PRIMARY KEY,          -- digest of endpoint, user and client key
+    fingerprint TEXT NOT NULL,     -- digest of the request parameters
+    response JSONB,                -- NULL while the request is in progress
+    expires_at DOUBLE PRECISION NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires_at ON idempotency_keys(expires_at);
+
+-- Claim an idempotency key, taking over an expired one. Returns no row if
+-- the key was claimed, otherwise the stored fingerprint and response.
+CREATE OR REPLACE FUNCTION claim_idempotency_key(p_key TEXT, p_fingerprint TEXT, p_expires_at DOUBLE PRECISION)
+RETURNS TABLE (fingerprint TEXT, response JSONB) AS $$
+BEGIN
+    INSERT INTO idempotency_keys AS k (key, fingerprint, response, expires_at)
+    VALUES (p_key, p_fingerprint, NULL, p_expires_at)
+    ON CONFLICT (key) DO UPDATE SET fingerprint = EXCLUDED.fingerprint, response = NULL,
+                                    expires_at = EXCLUDED.expires_at
+    WHERE k.expires_at < EXTRACT(EPOCH FROM now());
+    IF NOT FOUND THEN
+        RETURN QUERY SELECT k.fingerprint, k.response FROM idempotency_keys k WHERE k.key = p_key;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Atomic increment of the system balance, returns the new balance.
+-- Replaces the read-modify-write of system_settings from the application.
+CREATE OR REPLACE FUNCTION increment_system_balance(p_amount NUMERIC, p_reason TEXT DEFAULT 'adjustment',
+                                                    p_reference TEXT DEFAULT NULL)
+RETURNS NUMERIC AS $$
+DECLARE
+    new_balance NUMERIC;
+BEGIN
+    INSERT INTO system_settings (key, value)
+    VALUES ('system_balance', (1000.0 + p_amount)::TEXT)
+    ON CONFLICT (key) DO UPDATE SET value = (system_settings.value::NUMERIC + p_amount)::TEXT
+    RETURNING value::NUMERIC INTO new_balance;
+
+    INSERT INTO system_ledger (amount, balance, reason, reference)
+    VALUES (p_amount, new_balance, p_reason, p_reference);
+
+    RETURN new_balance;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Atomic debit of a user's credits, returns the new balance or NULL if the
+-- user has insufficient credits. A negative amount gives credits back.
+-- Replaces the read-modify-write of users.credits from the application.
+CREATE OR REPLACE FUNCTION debit_user_credits(p_user_id INTEGER, p_amount FLOAT)
+RETURNS FLOAT AS $$
+    UPDATE users SET credits = COALESCE(credits, 0) - p_amount
+    WHERE id = p_user_id AND COALESCE(credits, 0) >= p_amount
+    RETURNING credits;
+$$ LANGUAGE sql;
+
 -- Create indexes for better performance with high volume
 CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages(user_id);
 CREATE INDEX IF NOT EXISTS idx_messages_status ON messages(status);
 CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages(created_at);
+-- Keyset pagination of a user's history on (created_at, id)
+CREATE INDEX IF NOT EXISTS idx_messages_user_created_id ON messages(user_id, created_at DESC, id DESC);
+
+-- Single sends used to finish as 'success', every accepted send is 'sent' now
+UPDATE messages SET status = 'sent' WHERE status = 'success';
+
+-- Dashboard totals aggregated in the database instead of over the full history
+CREATE OR REPLACE FUNCTION user_message_totals(p_user_id INTEGER)
+RETURNS TABLE (
+    total_messages BIGINT,
+    successful_messages BIGINT,
+    failed_messages BIGINT,
+    total_cost FLOAT
+) AS $$
+    SELECT COUNT(*),
+           COUNT(*) FILTER (WHERE status IN ('sent', 'delivered')),
+           COUNT(*) FILTER (WHERE status = 'failed'),
+           COALESCE(SUM(cost), 0)
+    FROM messages
+    WHERE user_id = p_user_id;
+$$ LANGUAGE sql STABLE;
 
 -- Create a function to check if a user is an admin
 CREATE OR REPLACE FUNCTION is_admin()
@@ -62,9 +157,15 @@ $$ LANGUAGE plpgsql SECURITY DEFINER;
 ALTER TABLE users ENABLE ROW LEVEL SECURITY;
 ALTER TABLE messages ENABLE ROW LEVEL SECURITY;
 ALTER TABLE system_settings ENABLE ROW LEVEL SECURITY;
+ALTER TABLE system_ledger ENABLE ROW LEVEL SECURITY;
+ALTER TABLE destination_rates ENABLE ROW LEVEL SECURITY;
+ALTER TABLE idempotency_keys ENABLE ROW LEVEL SECURITY;
 
 -- Create simplified policies that will actually work
 -- These allow public access initially since we're handling authentication in our application
 CREATE POLICY "Allow full access to all tables" ON users FOR ALL USING (true);
 CREATE POLICY "Allow full access to all tables" ON messages FOR ALL USING (true);
-CREATE POLICY "Allow full access to all tables" ON system_settings FOR ALL USING (true); 
\ No newline at end of file
+CREATE POLICY "Allow full access to all tables" ON system_settings FOR ALL USING (true);
+CREATE POLICY "Allow full access to all tables" ON system_ledger FOR ALL USING (true);
+CREATE POLICY "Allow full access to all tables" ON destination_rates FOR ALL USING (true);
+CREATE POLICY "Allow full access to all tables" ON idempotency_keys FOR ALL USING (true); 
\ No newline at end of file
@@ -0,0 +1,105 @@
+import threading
+
+import pytest
+
+from bulk_jobs import BulkJobEngine
+from scheduler import TRANSACTIONAL
+
+class Recorder:
+    """Chunk, completion and failure callbacks that record their calls"""
+
+    def __init__(self, fail=None):
+        self.fail = fail or (lambda job_id, first_id, last_id, attempt: False)
+        self.chunks = []
+        self.completed = []
+        self.failed = []
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def chunk(self, job_id, first_id, last_id):
+        with self._lock:
+            attempt = sum(1 for chunk in self.chunks if chunk == (job_id, first_id, last_id))
+            self.chunks.append((job_id, first_id, last_id))
+        if self.fail(job_id, first_id, last_id, attempt):
+            raise RuntimeError('database is locked')
+
+    def complete(self, job_id):
+        self.completed.append(job_id)
+        self.done.set()
+
+    def give_up(self, job_id, first_id, last_id):
+        self.failed.append((job_id, first_id, last_id))
+
+@pytest.fixture
+def make_engine():
+    engines = []
+
+    def make(recorder, **kwargs):
+        settings = dict(workers=2, chunk_size=10, priority_workers=1, failed_handler=recorder.give_up,
+                        max_chunk_attempts=3, chunk_retry_delay=0.01)
+        settings.update(kwargs)
+        engine = BulkJobEngine(recorder.chunk, recorder.complete, **settings)
+        engine.delayed.tick = 0.01
+        engine.start()
+        engines.append(engine)
+        return engine
+
+    yield make
+    for engine in engines:
+        engine.stop(timeout=2)
+
+def test_job_completes_once_after_every_chunk(make_engine):
+    recorder = Recorder()
+    engine = make_engine(recorder)
+    assert engine.submit(1, 1, 25, tenant='u') == 3
+    assert recorder.done.wait(2)
+    assert sorted(recorder.chunks) == [(1, 1, 10), (1, 11, 20), (1, 21, 25)]
+    assert recorder.completed == [1]
+    assert recorder.failed == []
+
+def test_empty_job_completes_right_away(make_engine):
+    recorder = Recorder()
+    engine = make_engine(recorder)
+    assert engine.submit(1, 5, 4) == 0
+    assert recorder.completed == [1]
+
+def test_chunk_that_raises_is_retried(make_engine):
+    recorder = Recorder(fail=lambda job_id, first_id, last_id, attempt: first_id == 1 and attempt == 0)
+    engine = make_engine(recorder)
+    engine.submit(1, 1, 20)
+    assert recorder.done.wait(2)
+    assert recorder.chunks.count((1, 1, 10)) == 2
+    assert recorder.failed == []
+    assert recorder.completed == [1]
+
+def test_chunk_out_of_attempts_is_failed_before_the_job_completes(make_engine):
+    recorder = Recorder(fail=lambda job_id, first_id, last_id, attempt: first_id == 1)
+    engine = make_engine(recorder)
+    engine.submit(1, 1, 20)
+    assert recorder.done.wait(2)
+    assert recorder.chunks.count((1, 1, 10)) == 3
+    assert recorder.failed == [(1, 1, 10)]
+    assert recorder.completed == [1]
+
+def test_deferred_chunk_holds_back_completion(make_engine):
+    recorder = Recorder()
+    deferred = []
+
+    def chunk(job_id, first_id, last_id):
+        recorder.chunk(job_id, first_id, last_id)
+        if not deferred:
+            deferred.append((first_id, last_id))
+            engine.defer(job_id, first_id, last_id, 0.05)
+
+    engine = make_engine(recorder)
+    engine.chunk_handler = chunk
+    engine.submit(1, 1, 10)
+    assert recorder.done.wait(2)
+    assert recorder.chunks == [(1, 1, 10), (1, 1, 10)]
+    assert recorder.completed == [1]
+
+def test_run_returns_the_result_in_the_transactional_lane(make_engine):
+    engine = make_engine(Recorder())
+    assert engine.run(lambda a, b: a + b, 2, 3).result(2) == 5
+    with pytest.raises(ZeroDivisionError):
+        engine.run(lambda: 1 / 0, lane=TRANSACTIONAL).result(2)
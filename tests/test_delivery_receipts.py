@@ -0,0 +1,36 @@
+from datetime import datetime
+from types import SimpleNamespace
+
+from delivery_receipts import parse_receipt
+
+def pdu(short_message=b'', esm_class=0x04, **tlvs):
+    return SimpleNamespace(short_message=short_message, esm_class=esm_class, **tlvs)
+
+def test_parses_the_receipt_text():
+    receipt = parse_receipt(pdu(b'id:abc123 sub:001 dlvrd:001 submit date:2401011200 '
+                                b'done date:240101120530 stat:DELIVRD err:000 text:hello'))
+    assert receipt == {
+        'message_id': 'abc123',
+        'stat': 'DELIVRD',
+        'err': '000',
+        'done_date': datetime(2024, 1, 1, 12, 5, 30),
+        'status': 'delivered',
+    }
+
+def test_tlvs_take_precedence_over_the_text():
+    receipt = parse_receipt(pdu(b'id:abc123 stat:DELIVRD', receipted_message_id=b'xyz', message_state=5))
+    assert receipt['message_id'] == 'xyz'
+    assert receipt['status'] == 'undelivered'
+
+def test_receipted_message_id_marks_a_receipt_without_the_esm_class():
+    receipt = parse_receipt(pdu(b'stat:EXPIRED', esm_class=0, receipted_message_id='xyz'))
+    assert (receipt['message_id'], receipt['status']) == ('xyz', 'expired')
+
+def test_unknown_stat_and_short_done_date():
+    receipt = parse_receipt(pdu(b'id:1 done date:2401011205 stat:WHAT'))
+    assert receipt['status'] == 'unknown'
+    assert receipt['done_date'] == datetime(2024, 1, 1, 12, 5)
+
+def test_mobile_originated_messages_are_not_receipts():
+    assert parse_receipt(pdu(b'hello there', esm_class=0)) is None
+    assert parse_receipt(pdu(b'stat:DELIVRD')) is None
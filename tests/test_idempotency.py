@@ -0,0 +1,74 @@
+import io
+
+import pytest
+
+from idempotency import IdempotencyStore, IdempotencyConflict, digest, digest_stream
+
+def test_retry_replays_the_completed_response():
+    store = IdempotencyStore()
+    fingerprint = digest('525512345601', 'hello')
+    key, response = store.begin('send_sms:1', 'k1', fingerprint)
+    assert response is None
+    store.complete(key, fingerprint, {'flash': [['sent', 'success']]})
+    assert store.begin('send_sms:1', 'k1', fingerprint) == (key, {'flash': [['sent', 'success']]})
+    assert store.stats == {'claimed': 1, 'replayed': 1, 'conflicts': 0}
+
+def test_key_in_progress_conflicts():
+    store = IdempotencyStore()
+    store.begin('send_sms:1', 'k1', 'f')
+    with pytest.raises(IdempotencyConflict) as e:
+        store.begin('send_sms:1', 'k1', 'f')
+    assert e.value.status == 409
+
+def test_key_reused_for_another_request_conflicts():
+    store = IdempotencyStore()
+    key, _ = store.begin('send_sms:1', 'k1', 'f1')
+    store.complete(key, 'f1', {'flash': []})
+    with pytest.raises(IdempotencyConflict) as e:
+        store.begin('send_sms:1', 'k1', 'f2')
+    assert e.value.status == 422
+
+def test_keys_are_scoped():
+    store = IdempotencyStore()
+    first, _ = store.begin('send_sms:1', 'k1', 'f')
+    second, _ = store.begin('send_sms:2', 'k1', 'f')
+    assert first != second and len(first) == 32
+
+def test_release_lets_the_request_be_retried():
+    released = []
+    store = IdempotencyStore(claim=lambda key, fingerprint, expires_at: None, release=released.append)
+    key, _ = store.begin('send_sms:1', 'k1', 'f')
+    store.release(key)
+    assert released == [key]
+    assert store.begin('send_sms:1', 'k1', 'f') == (key, None)
+
+def test_shared_store_answers_other_workers():
+    rows = {}
+
+    def claim(key, fingerprint, expires_at):
+        if key in rows:
+            return rows[key]
+        rows[key] = (fingerprint, None)
+        return None
+
+    worker, other = IdempotencyStore(claim), IdempotencyStore(claim)
+    key, _ = worker.begin('send_sms:1', 'k1', 'f')
+    with pytest.raises(IdempotencyConflict):
+        other.begin('send_sms:1', 'k1', 'f')
+    rows[key] = ('f', {'flash': [['sent', 'success']]})
+    assert other.begin('send_sms:1', 'k1', 'f') == (key, {'flash': [['sent', 'success']]})
+
+def test_local_cache_is_bounded():
+    store = IdempotencyStore(local_size=2)
+    for client_key in ('a', 'b', 'c'):
+        key, _ = store.begin('scope', client_key, 'f')
+        store.complete(key, 'f', {})
+    assert len(store._local) == 2
+
+def test_digest_stream_hashes_contents_and_rewinds():
+    stream = io.BytesIO(b'5512345601\n' * 10000)
+    first = digest_stream(stream, block_size=1000)
+    assert stream.read(10) == b'5512345601'
+    stream.seek(0)
+    assert digest_stream(stream) == first
+    assert digest_stream(io.BytesIO(b'5512345602\n')) != first
@@ -0,0 +1,73 @@
+from types import SimpleNamespace
+
+import pytest
+
+import ingest_queue
+from ingest_queue import IngestQueue
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ingest_queue, 'time', SimpleNamespace(time=lambda: now[0]))
+    return now
+
+@pytest.fixture
+def queue(tmp_path, clock):
+    return IngestQueue(str(tmp_path / 'ingest.db'), lease=60, max_attempts=2)
+
+def test_batch_progress_follows_the_claimed_messages(queue):
+    batch_id, total = queue.enqueue([('525512345601', 'a'), ('525512345602', 'b'), ('525512345603', 'c')],
+                                    rejected=1)
+    assert total == 3
+    claimed = queue.claim(limit=2)
+    assert [row[2] for row in claimed] == ['525512345601', '525512345602']
+    assert queue.depth() == {'queued': 1, 'sending': 2}
+    queue.finish([(claimed[0][0], True, 'id1'), (claimed[1][0], False, 'bad number')])
+    status = queue.status(batch_id)
+    assert (status['status'], status['sent'], status['failed'], status['queued']) == ('processing', 1, 1, 1)
+    assert status['rejected'] == 1
+    assert status['errors'] == [{'number': '525512345602', 'error': 'bad number'}]
+    queue.finish([(queue.claim()[0][0], True, 'id3')])
+    assert queue.status(batch_id)['status'] == 'completed'
+    assert queue.status('missing') is None
+
+def test_expired_lease_is_claimed_again_until_out_of_attempts(queue, clock):
+    batch_id, _ = queue.enqueue([('525512345601', 'a')])
+    message_id = queue.claim()[0][0]
+    assert queue.claim() == []
+    clock[0] += 61
+    assert [row[0] for row in queue.claim()] == [message_id]
+    clock[0] += 61
+    assert queue.claim() == []
+    assert queue.status(batch_id)['errors'] == [{'number': '525512345601', 'error': 'Too many attempts'}]
+
+def test_finish_ignores_messages_that_are_not_claimed(queue):
+    batch_id, _ = queue.enqueue([('525512345601', 'a')])
+    queue.finish([(1, True, 'id1')])
+    assert queue.status(batch_id)['queued'] == 1
+
+def test_purge_drops_finished_batches_and_expired_keys(queue, clock):
+    done, _ = queue.enqueue([('525512345601', 'a')])
+    queue.finish([(queue.claim()[0][0], True, 'id1')])
+    pending, _ = queue.enqueue([('525512345602', 'b')])
+    queue.claim_key('old', 'f', clock[0] + 10)
+    assert queue.purge(60) == 0
+    clock[0] += 61
+    assert queue.purge(60) == 1
+    assert queue.status(done) is None
+    assert queue.status(pending) is not None
+    assert queue.claim_key('old', 'g', clock[0] + 10) is None
+
+def test_idempotency_keys_are_shared_by_every_connection(queue, tmp_path, clock):
+    other = IngestQueue(str(tmp_path / 'ingest.db'))
+    assert queue.claim_key('k', 'f', clock[0] + 10) is None
+    assert other.claim_key('k', 'f', clock[0] + 10) == ('f', None)
+    queue.complete_key('k', {'batch_id': 'b'})
+    assert other.claim_key('k', 'f', clock[0] + 10) == ('f', {'batch_id': 'b'})
+    other.release_key('k')
+    assert queue.claim_key('k', 'f', clock[0] + 10) == ('f', {'batch_id': 'b'})
+
+def test_released_key_can_be_claimed_again(queue, clock):
+    queue.claim_key('k', 'f', clock[0] + 10)
+    queue.release_key('k')
+    assert queue.claim_key('k', 'f', clock[0] + 10) is None
@@ -0,0 +1,111 @@
+import importlib
+import itertools
+import os
+from datetime import datetime, timedelta
+
+import pytest
+
+user_names = (f'user{n}' for n in itertools.count())
+
+@pytest.fixture(scope='module')
+def app_module(tmp_path_factory):
+    """app.py on a scratch SQLite database, with its outbox dispatcher stopped"""
+    path = tmp_path_factory.mktemp('outbox')
+    settings = {'DATABASE_URL': f"sqlite:///{path / 'app.db'}", 'REPORT_POLLER_ENABLED': 'false',
+                'RATE_LIMIT_DB': str(path / 'rate_limits.db'), 'GATEWAY_RETRYABLE_STATUSES': '-9'}
+    saved = {name: os.environ.get(name) for name in settings}
+    os.environ.update(settings)
+    try:
+        module = importlib.import_module('app')
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+    module.outbox_dispatcher.stop(timeout=5)
+    return module
+
+@pytest.fixture
+def outbox(app_module):
+    with app_module.app.app_context():
+        app_module.OutboxEntry.query.delete()
+        app_module.db.session.commit()
+    yield app_module
+    with app_module.app.app_context():
+        app_module.db.session.remove()
+
+def add_message(app_module, numbers, cost=0.0, user_id=None):
+    with app_module.app.app_context():
+        if user_id is None:
+            name = next(user_names)
+            user = app_module.User(username=name, email=f'{name}@example.com', credits=1.0)
+            user.set_password('secret')
+            app_module.db.session.add(user)
+            app_module.db.session.flush()
+            user_id = user.id
+        entry_id = app_module.add_outbox_message(app_module.Message(
+            user_id=user_id, numbers=numbers, content='hello', status='pending', cost=cost,
+            created_at=datetime.utcnow()))
+        app_module.db.session.commit()
+        return entry_id, user_id
+
+def claim(app_module, limit=10, ids=None):
+    with app_module.app.app_context():
+        return app_module.claim_outbox_entries(limit, ids)
+
+def test_claimed_entries_are_not_claimed_twice(outbox):
+    first, _ = add_message(outbox, '525512345601')
+    second, _ = add_message(outbox, '525512345602')
+    assert claim(outbox, limit=1) == [first]
+    assert claim(outbox) == [second]
+    assert claim(outbox) == []
+
+def test_claim_can_be_limited_to_given_entries(outbox):
+    first, _ = add_message(outbox, '525512345601')
+    second, _ = add_message(outbox, '525512345602')
+    assert claim(outbox, ids=[second]) == [second]
+    assert claim(outbox) == [first]
+
+def test_entry_is_claimed_again_once_its_lease_expires(outbox):
+    entry_id, _ = add_message(outbox, '525512345601')
+    assert claim(outbox) == [entry_id]
+    with outbox.app.app_context():
+        entry = outbox.OutboxEntry.query.get(entry_id)
+        entry.locked_at = datetime.utcnow() - outbox.OUTBOX_LEASE - timedelta(seconds=1)
+        outbox.db.session.commit()
+    assert claim(outbox) == [entry_id]
+    with outbox.app.app_context():
+        assert outbox.OutboxEntry.query.get(entry_id).attempts == 2
+
+def test_entry_waiting_for_a_retry_is_not_claimed_early(outbox):
+    entry_id, _ = add_message(outbox, '525512345601')
+    with outbox.app.app_context():
+        outbox.OutboxEntry.query.get(entry_id).available_at = datetime.utcnow() + timedelta(minutes=1)
+        outbox.db.session.commit()
+    assert claim(outbox) == []
+
+def test_numbers_a_send_did_not_reach_are_split_off(outbox, monkeypatch):
+    errors = {'525512345602': 'Failed to send SMS: bad number (status: -5)',
+              '525512345603': 'Failed to send SMS: busy (status: -9)'}
+    monkeypatch.setattr(outbox.sms_router, 'send_batch', lambda numbers, content, limits=(): [
+        (number, False, errors[number], 'http') if number in errors else (number, True, f'id{number}', 'http')
+        for number in numbers])
+    entry_id, user_id = add_message(outbox, '525512345601,525512345602,525512345603,525512345604', cost=0.4)
+    with outbox.app.app_context():
+        outbox.User.query.filter_by(id=user_id).update({'credits': 0.6})
+        outbox.db.session.commit()
+    ids = claim(outbox)
+    assert ids == [entry_id]
+    outbox.send_outbox_entries(ids)
+
+    with outbox.app.app_context():
+        messages = {message.numbers: message for message in outbox.Message.query.filter_by(user_id=user_id)}
+        assert messages['525512345601,525512345604'].status == 'sent'
+        assert messages['525512345601,525512345604'].cost == pytest.approx(0.2)
+        assert messages['525512345602'].status == 'failed'
+        assert messages['525512345603'].status == 'pending'
+        assert messages['525512345603'].cost == pytest.approx(0.1)
+        retry = outbox.OutboxEntry.query.filter_by(message_id=messages['525512345603'].id).one()
+        assert retry.available_at > datetime.utcnow()
+        assert outbox.User.query.get(user_id).credits == pytest.approx(0.7)
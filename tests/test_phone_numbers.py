@@ -0,0 +1,37 @@
+import pytest
+
+from phone_numbers import NumberNormalizer, normalize_number
+
+@pytest.mark.parametrize('number, country_code, expected', [
+    ('5512345601', '+52', ('525512345601', None)),
+    ('(55) 1234-5601', '+52', ('525512345601', None)),
+    ('+52 55 1234 5601', '+52', ('525512345601', None)),
+    ('2025550123', '+1', ('12025550123', None)),
+    ('', '+52', (None, 'empty')),
+    ('12345', '+52', (None, 'too short')),
+    ('1234567890123456', '+52', (None, 'too long')),
+])
+def test_normalize_number(number, country_code, expected):
+    assert normalize_number(number, country_code) == expected
+
+def test_normalizer_rejects_invalid_and_duplicate_numbers():
+    rejects = []
+    normalizer = NumberNormalizer('+52', on_reject=lambda number, reason: rejects.append((number, reason)))
+    accepted = normalizer.normalize(['5512345601', '123', '+52 55 1234 5601', '5512345602'])
+    assert accepted == [(0, '525512345601'), (3, '525512345602')]
+    assert rejects == [('123', 'too short'), ('+52 55 1234 5601', 'duplicate')]
+    assert normalizer.summary() == {'valid': 2, 'invalid': 1, 'duplicates': 1}
+
+def test_duplicates_are_detected_across_batches():
+    normalizer = NumberNormalizer('+52')
+    normalizer.normalize(['5512345601'])
+    assert normalizer.normalize(['525512345601', '5512345603']) == [(1, '525512345603')]
+    assert normalizer.summary()['duplicates'] == 1
+
+def test_iter_normalized_keeps_recipient_variables():
+    normalizer = NumberNormalizer('+52')
+    recipients = [('5512345601', {'name': 'Ana'}), ('bad', {'name': 'x'}), ('5512345602', {'name': 'Luis'})]
+    assert list(normalizer.iter_normalized(recipients, batch_size=2)) == [
+        ('525512345601', {'name': 'Ana'}),
+        ('525512345602', {'name': 'Luis'}),
+    ]
@@ -0,0 +1,53 @@
+from types import SimpleNamespace
+
+import pytest
+
+import rate_limit
+from rate_limit import TokenBucketLimiter
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(rate_limit, 'time', SimpleNamespace(time=lambda: now[0], monotonic=lambda: now[0],
+                                                            sleep=lambda seconds: None))
+    return now
+
+@pytest.fixture
+def limiter(tmp_path, clock):
+    return TokenBucketLimiter(str(tmp_path / 'buckets.db'))
+
+def test_bucket_starts_full_and_refills_at_its_rate(limiter, clock):
+    assert limiter.try_acquire([('route', 10, 10, 10)]) == 0
+    assert limiter.try_acquire([('route', 5, 10, 10)]) == pytest.approx(0.5)
+    clock[0] += 0.5
+    assert limiter.try_acquire([('route', 5, 10, 10)]) == 0
+
+def test_tokens_are_taken_from_every_bucket_or_none(limiter):
+    assert limiter.try_acquire([('user', 10, 10, 10)]) == 0
+    assert limiter.try_acquire([('route', 5, 10, 10), ('user', 5, 10, 10)]) > 0
+    assert 'route' not in limiter.stats()
+    assert limiter.try_acquire([('route', 10, 10, 10)]) == 0
+
+def test_buckets_without_a_rate_are_ignored(limiter):
+    assert limiter.try_acquire([('route', 1000, 0, None)]) == 0
+    assert limiter.stats() == {}
+
+def test_request_larger_than_the_burst_runs_into_debt(limiter):
+    assert limiter.try_acquire([('route', 25, 10, 10)]) == 0
+    assert limiter.stats()['route']['tokens'] == -15
+
+def test_throttle_halves_the_rate_and_it_grows_back(limiter, clock):
+    limiter.throttled('route', 100)
+    assert limiter.stats()['route']['rate'] == 50
+    clock[0] += 5
+    limiter.try_acquire([('route', 1, 100, 100)])
+    assert limiter.stats()['route']['rate'] == 75
+
+def test_acquire_times_out(limiter):
+    assert limiter.acquire([('route', 10, 10, 10)])
+    assert not limiter.acquire([('route', 10, 10, 10)], timeout=0.5)
+
+def test_processes_share_the_bucket_file(limiter, tmp_path):
+    other = TokenBucketLimiter(str(tmp_path / 'buckets.db'))
+    assert limiter.try_acquire([('route', 10, 10, 10)]) == 0
+    assert other.try_acquire([('route', 10, 10, 10)]) > 0
@@ -0,0 +1,35 @@
+import pytest
+
+from rates import RateTable, RateCard
+
+def test_lookup_returns_the_longest_matching_prefix():
+    table = RateTable([('52', 0.05), ('5255', 0.04), ('+1', 0.01)])
+    assert table.lookup('525512345601') == 0.04
+    assert table.lookup('523312345601') == 0.05
+    assert table.lookup('12025550123') == 0.01
+    assert table.lookup('447700900123') is None
+    assert table.lookup('447700900123', default=0.2) == 0.2
+
+def test_empty_prefix_carries_every_destination():
+    table = RateTable([('', 0.1), ('52', 0.05)])
+    assert table.lookup('447700900123') == 0.1
+    assert table.match('447700900123') == ('', 0.1)
+    assert table.match('525512345601') == ('52', 0.05)
+
+def test_match_without_a_prefix():
+    assert RateTable([('52', 0.05)]).match('447700900123') is None
+
+def test_readding_a_prefix_replaces_its_rate():
+    table = RateTable([('52', 0.05)])
+    table.add('52', '0.06')
+    assert len(table) == 1
+    assert table.lookup('525512345601') == 0.06
+
+def test_rate_card_prefers_user_overrides_then_table_then_flat_rate():
+    card = RateCard(RateTable([('52', 0.05)]), RateTable([('5255', 0.03)]), default_rate=0.2)
+    assert card.rate('525512345601') == 0.03
+    assert card.rate('523312345601') == 0.05
+    assert card.rate('447700900123') == 0.2
+    total, rates = card.price(['525512345601', '447700900123'])
+    assert total == pytest.approx(0.23)
+    assert rates == [0.03, 0.2]
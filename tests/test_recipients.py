@@ -0,0 +1,45 @@
+import gzip
+import io
+import zipfile
+
+import pytest
+
+from recipients import open_upload, iter_recipients, render_content
+
+CSV = 'Phone;Name\n5512345601;Ana\n;nobody\n5512345602;Luis\n'
+
+def zipped(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, data in files:
+            archive.writestr(name, data)
+    buffer.seek(0)
+    return buffer
+
+@pytest.mark.parametrize('stream, filename', [
+    (io.BytesIO(b'\xef\xbb\xbf' + CSV.encode()), 'numbers.csv'),
+    (io.BytesIO(gzip.compress(CSV.encode())), 'upload'),
+    (zipped([('__MACOSX/._numbers.csv', b'x'), ('numbers.csv', CSV.encode())]), 'numbers.zip'),
+])
+def test_open_upload_unpacks_archives(stream, filename):
+    assert list(iter_recipients(open_upload(stream, filename))) == [
+        ('5512345601', {'name': 'Ana'}),
+        ('5512345602', {'name': 'Luis'}),
+    ]
+
+def test_empty_zip_is_rejected():
+    with pytest.raises(ValueError):
+        open_upload(zipped([]), 'numbers.zip')
+
+def test_plain_text_is_one_number_per_line():
+    assert list(iter_recipients(['5512345601\n', '\n', ' 5512345602 \n'])) == [
+        ('5512345601', {}), ('5512345602', {}),
+    ]
+
+def test_csv_without_a_header_uses_the_first_column():
+    assert list(iter_recipients(['5512345601,Ana\n', '5512345602,Luis\n'])) == [
+        ('5512345601', {}), ('5512345602', {}),
+    ]
+
+def test_render_content_leaves_unknown_placeholders():
+    assert render_content('Hola {Name}, {code}', {'name': 'Ana'}) == 'Hola Ana, {code}'
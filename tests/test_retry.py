@@ -0,0 +1,39 @@
+import pytest
+
+from retry import classify_error, RetryPolicy
+
+@pytest.mark.parametrize('error, expected', [
+    ('HTTP 503: busy', ('http_503', True)),
+    ('404 Client Error: Not Found for url: x', ('http_404', False)),
+    ('Message send failed with status: 88', ('smpp_0x58', True)),
+    ('Message send failed with status: 11', ('smpp_0x0b', False)),
+    ('Failed to send SMS: bad number (status: -9)', ('gateway_-9', False)),
+    ("HTTPConnectionPool(host='x', port=1): Max retries exceeded", ('transport', True)),
+    ('No healthy route for destination', ('no_route', True)),
+    ('Number rejected by gateway', ('other', False)),
+    (TimeoutError('No submit_sm_resp received'), ('transport', True)),
+])
+def test_classify_error(error, expected):
+    assert classify_error(error) == expected
+
+def test_gateway_statuses_are_retryable_when_configured():
+    assert classify_error('Failed to send SMS: busy (status: 7)', gateway_retryable={7}) == ('gateway_7', True)
+
+def test_backoff_is_full_jitter_up_to_the_cap():
+    policy = RetryPolicy(base=1.0, cap=5.0)
+    for attempts, ceiling in [(1, 1.0), (2, 2.0), (3, 4.0), (4, 5.0), (10, 5.0)]:
+        delays = [policy.backoff(attempts) for _ in range(200)]
+        assert all(0 <= delay <= ceiling for delay in delays)
+        assert max(delays) > ceiling / 2
+
+def test_decide_retries_until_attempts_are_exhausted():
+    policy = RetryPolicy(max_attempts=3, base=0.1, cap=1.0)
+    assert policy.decide('HTTP 503: busy', 1) is not None
+    assert policy.decide('HTTP 503: busy', 2) is not None
+    assert policy.decide('HTTP 503: busy', 3) is None
+    assert policy.stats() == {'http_503': {'retried': 2, 'exhausted': 1, 'permanent': 0}}
+
+def test_decide_does_not_retry_permanent_errors():
+    policy = RetryPolicy()
+    assert policy.decide('Number rejected by gateway', 1) is None
+    assert policy.stats() == {'other': {'retried': 0, 'exhausted': 0, 'permanent': 1}}
@@ -0,0 +1,72 @@
+import time
+
+import pytest
+
+from routing import Router, Route, CircuitBreaker, is_throttled, is_not_sent
+
+class Backend:
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = 0
+
+    def available(self):
+        return True
+
+    def send_batch(self, numbers, content):
+        self.calls += 1
+        return [(number, False, self.error) if self.error else (number, True, f'id{number}') for number in numbers]
+
+@pytest.mark.parametrize('error, throttled', [
+    ('Message send failed with status: 88', True),
+    ('Message send failed with status: 880', False),
+    ('Failed to send SMS: busy (status: 88)', False),
+    ('HTTP 429: slow down', True),
+    ('429 Client Error: Too Many Requests for url: x', True),
+    ('HTTP 503: busy', False),
+])
+def test_is_throttled(error, throttled):
+    assert is_throttled(error) == throttled
+
+@pytest.mark.parametrize('error, not_sent', [
+    ("HTTPConnectionPool(host='x', port=1): Max retries exceeded with url: /send "
+     "(Caused by NewConnectionError('Failed to establish a new connection: [Errno 111] Connection refused'))", True),
+    ('smpp-0 is not bound', True),
+    ('Message send failed with status: 69', True),
+    ('Failed to send SMS: bad number (status: -9)', True),
+    ('HTTP 400: bad request', True),
+    ('HTTP 503: busy', True),
+    ('504 Server Error: Gateway Timeout for url: x', False),
+    ("HTTPConnectionPool(host='x', port=1): Read timed out. (read timeout=30)", False),
+    ('No submit_sm_resp received', False),
+])
+def test_is_not_sent(error, not_sent):
+    assert is_not_sent(error) == not_sent
+
+def test_fails_over_when_nothing_was_sent():
+    down, backup = Backend('Connection refused'), Backend()
+    router = Router([Route('a', down, {'': 0.001}), Route('b', backup, {'': 0.01})])
+    assert router.send_batch(['1', '2'], 'x') == [('1', True, 'id1', 'b'), ('2', True, 'id2', 'b')]
+
+def test_does_not_fail_over_after_a_timeout():
+    slow, backup = Backend('Read timed out.'), Backend()
+    router = Router([Route('a', slow, {'': 0.001}), Route('b', backup, {'': 0.01})])
+    assert router.send_batch(['1'], 'x') == [('1', False, 'Read timed out.', 'a')]
+    assert backup.calls == 0
+
+def test_unused_route_keeps_its_half_open_trial():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+    router = Router([Route('a', Backend(), {'': 0.001}), Route('b', Backend(), {'': 0.01}, breaker)])
+    router.send_batch(['1'], 'x')
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.allow()
+
+def test_unavailable_backend_keeps_its_half_open_trial():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+    time.sleep(0.02)
+    backend = Backend()
+    backend.available = lambda: False
+    assert not Route('a', backend, {'': 0.001}, breaker).healthy()
+    assert breaker.allow()
@@ -0,0 +1,72 @@
+import threading
+import time
+
+from scheduler import FairScheduler, TRANSACTIONAL, BULK
+
+def test_transactional_lane_is_served_first():
+    queue = FairScheduler()
+    queue.put('chunk', lane=BULK)
+    queue.put('send', lane=TRANSACTIONAL)
+    assert queue.get(timeout=0) == 'send'
+    assert queue.get(timeout=0) == 'chunk'
+
+def test_tenants_take_turns_within_a_lane():
+    queue = FairScheduler(quantum=100)
+    for i in range(5):
+        queue.put(('a', i), tenant='a', cost=100)
+    queue.put(('b', 0), tenant='b', cost=100)
+    order = [queue.get(timeout=0) for _ in range(6)]
+    # b's single chunk does not wait behind a's whole campaign
+    assert order.index(('b', 0)) <= 1
+    assert [item for item in order if item[0] == 'a'] == [('a', i) for i in range(5)]
+
+def test_weights_give_a_larger_share():
+    queue = FairScheduler(quantum=1, weights={'a': 3})
+    for i in range(6):
+        queue.put(('a', i), tenant='a')
+        queue.put(('b', i), tenant='b')
+    first = [queue.get(timeout=0)[0] for _ in range(8)]
+    assert first.count('a') >= 5
+
+def test_get_restricted_to_lanes():
+    queue = FairScheduler()
+    queue.put('chunk', lane=BULK)
+    assert queue.get(lanes=(TRANSACTIONAL,), timeout=0.01) is None
+    assert queue.get(timeout=0) == 'chunk'
+
+def test_put_wakes_a_worker_of_the_item_lane():
+    queue = FairScheduler()
+    taken = []
+    # The transactional-only worker waits first, so it is first in line for a wakeup
+    priority = threading.Thread(target=lambda: taken.append(('priority', queue.get(lanes=(TRANSACTIONAL,), timeout=2))))
+    priority.start()
+    time.sleep(0.05)
+    bulk = threading.Thread(target=lambda: taken.append(('bulk', queue.get(timeout=2))))
+    bulk.start()
+    time.sleep(0.05)
+
+    queue.put('chunk', lane=BULK)
+    bulk.join(1)
+    assert ('bulk', 'chunk') in taken
+    assert queue.depth()['bulk']['items'] == 0
+
+    queue.close()
+    priority.join(1)
+    assert not priority.is_alive()
+
+def test_depth_counts_items_cost_and_tenants():
+    queue = FairScheduler()
+    queue.put('a', tenant=1, cost=10)
+    queue.put('b', tenant=2, cost=5)
+    queue.put('c', lane=TRANSACTIONAL)
+    assert queue.depth() == {
+        'transactional': {'items': 1, 'cost': 1, 'tenants': 1},
+        'bulk': {'items': 2, 'cost': 15, 'tenants': 2},
+    }
+
+def test_close_releases_waiters_once_drained():
+    queue = FairScheduler()
+    queue.put('last')
+    queue.close()
+    assert queue.get() == 'last'
+    assert queue.get() is None
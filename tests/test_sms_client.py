@@ -0,0 +1,57 @@
+from sms_client import SMSClient
+
+class Gateway:
+    """Stands in for /sendsms, rejecting any request that contains a bad number"""
+
+    def __init__(self, bad=(), status=-3):
+        self.bad = set(bad)
+        self.status = status
+        self.requests = []
+
+    def __call__(self, numbers, content, **options):
+        self.requests.append(list(numbers))
+        if self.bad.intersection(numbers):
+            return {'status': self.status, 'desc': 'rejected'}
+        return {'status': 0, 'array': [[number, f'id{number}'] for number in numbers]}
+
+def make_client(gateway, **kwargs):
+    client = SMSClient('localhost', 1, 'account', 'password', **kwargs)
+    client._request_send = gateway
+    return client
+
+def test_map_send_result_matches_numbers_by_digits():
+    result = {'status': 0, 'array': [['525512345601', 7], ['+52 55 1234 5601', 8]]}
+    assert SMSClient.map_send_result(['525512345601', '525512345601', '525512345602'], result) == [
+        ('525512345601', True, '7'),
+        ('525512345601', True, '8'),
+        ('525512345602', False, 'Number rejected by gateway'),
+    ]
+
+def test_map_send_result_without_array_accepts_the_batch():
+    assert SMSClient.map_send_result(['1', '2'], {'status': 0}) == [('1', True, None), ('2', True, None)]
+
+def test_number_level_reject_is_split_until_isolated():
+    gateway = Gateway(bad={'3'})
+    client = make_client(gateway, number_error_statuses=[-3])
+    results = client.send_sms_batch(['1', '2', '3', '4'], 'x')
+    assert [result[:2] for result in results] == [('1', True), ('2', True), ('3', False), ('4', True)]
+    assert results[2][2] == 'Failed to send SMS: rejected (status: -3)'
+    assert ['3'] in gateway.requests
+
+def test_account_level_reject_fails_the_batch_at_once():
+    gateway = Gateway(bad={'1', '2', '3', '4'}, status=-1)
+    client = make_client(gateway, number_error_statuses=[-3])
+    assert [result[1] for result in client.send_sms_batch(['1', '2', '3', '4'], 'x')] == [False] * 4
+    assert len(gateway.requests) == 1
+
+def test_unknown_status_codes_split_up_to_the_depth_cap():
+    gateway = Gateway(bad={'1', '2', '3', '4', '5', '6', '7', '8'}, status=-1)
+    client = make_client(gateway, max_split_depth=1)
+    assert not any(result[1] for result in client.send_sms_batch([str(n) for n in range(1, 9)], 'x'))
+    assert len(gateway.requests) == 3
+
+def test_batches_are_sent_in_batch_size_requests():
+    gateway = Gateway()
+    client = make_client(gateway, batch_size=2)
+    assert all(result[1] for result in client.send_sms_batch(['1', '2', '3'], 'x'))
+    assert gateway.requests == [['1', '2'], ['3']]
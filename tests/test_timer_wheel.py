@@ -0,0 +1,44 @@
+import pytest
+
+from timer_wheel import TimerWheel
+
+def test_timers_fire_in_order_and_never_early():
+    wheel = TimerWheel(tick=1.0, levels=(8, 8), start=0)
+    for when in (3.5, 1.0, 2.0, 30.0):
+        wheel.add(when, when)
+    assert wheel.advance(0.9) == []
+    assert wheel.advance(2.0) == [1.0, 2.0]
+    assert wheel.advance(3.9) == []
+    assert wheel.advance(4.0) == [3.5]
+    assert len(wheel) == 1
+    assert wheel.advance(30.0) == [30.0]
+    assert len(wheel) == 0
+
+def test_timers_cascade_down_from_higher_levels():
+    wheel = TimerWheel(tick=1.0, levels=(4, 4, 4), start=0)
+    due = [5, 17, 40, 63]
+    for when in due:
+        wheel.add(when, when)
+    fired = []
+    for now in range(64):
+        fired.extend((now, item) for item in wheel.advance(now))
+    assert fired == [(when, when) for when in due]
+
+def test_timers_beyond_the_range_wait_in_the_top_level():
+    wheel = TimerWheel(tick=1.0, levels=(4, 4), start=0)
+    wheel.add(100, 'far')
+    assert wheel.advance(99) == []
+    assert wheel.advance(100) == ['far']
+
+def test_overdue_timer_fires_on_the_next_advance():
+    wheel = TimerWheel(tick=1.0, levels=(8,), start=0)
+    wheel.advance(5)
+    wheel.add(2, 'late')
+    assert wheel.advance(5) == ['late']
+
+@pytest.mark.parametrize('tick', [0.25, 2.0])
+def test_tick_sets_the_resolution(tick):
+    wheel = TimerWheel(tick=tick, levels=(16, 16), start=0)
+    wheel.add(3 * tick, 'x')
+    assert wheel.advance(2.99 * tick) == []
+    assert wheel.advance(3 * tick) == ['x']
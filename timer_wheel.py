@@ -0,0 +1,222 @@
+import logging
+import math
+import threading
+import time
+
+# Configure logging
+logger = logging.getLogger('timer_wheel')
+
+class TimerWheel:
+    """
+    Hierarchical timer wheel.
+
+    Timers are kept in slot lists by how far in the future they fire: the
+    first level holds one slot per tick, each further level covers the whole
+    range of the level below in every slot. When a lower level wraps around,
+    the next slot of the level above is cascaded down. Inserting and expiring
+    a timer is O(1) however many timers are pending.
+    """
+
+    def __init__(self, tick=1.0, levels=(256, 64, 64, 64), start=None):
+        """
+        :param tick: Seconds per slot of the first level (the timer resolution)
+        :param levels: Slots per level, lowest first
+        :param start: Time of tick 0, defaults to now
+        """
+        self.tick = tick
+        self.levels = levels
+        self.origin = time.time() if start is None else start
+        self.current = 0
+        self.size = 0
+        self._wheels = [[[] for _ in range(slots)] for slots in levels]
+        self._spans = []  # Ticks covered by one slot of each level
+        span = 1
+        for slots in levels:
+            self._spans.append(span)
+            span *= slots
+        self._range = span
+        self._ready = []
+
+    def _ticks(self, when):
+        return math.ceil((when - self.origin) / self.tick)
+
+    def add(self, when, item):
+        """Schedule item to expire at time when (seconds since the epoch)"""
+        self._place(self._ticks(when), item)
+        self.size += 1
+
+    def _place(self, due, item):
+        delta = due - self.current
+        if delta <= 0:
+            self._ready.append(item)
+            return
+        # Timers beyond the top level wait in its farthest slot and are placed again on cascade
+        slot_due = self.current + min(delta, self._range - 1)
+        for level, slots in enumerate(self.levels):
+            span = self._spans[level]
+            if slot_due - self.current < span * slots:
+                self._wheels[level][(slot_due // span) % slots].append((due, item))
+                return
+
+    def advance(self, now=None):
+        """
+        Move the wheel up to now
+        :return: Items that expired, in expiry order
+        """
+        # Only whole ticks that have passed, a timer never fires early
+        target = math.floor(((time.time() if now is None else now) - self.origin) / self.tick)
+        expired = self._ready
+        self._ready = []
+        while self.current < target:
+            self.current += 1
+            self._cascade()
+            expired.extend(self._ready)
+            self._ready = []
+            slot = self._wheels[0][self.current % self.levels[0]]
+            if slot:
+                expired.extend(item for _, item in slot)
+                slot.clear()
+        self.size -= len(expired)
+        return expired
+
+    def _cascade(self):
+        for level in range(1, len(self.levels)):
+            span = self._spans[level]
+            if self.current % span:
+                return
+            slot = self._wheels[level][(self.current // span) % self.levels[level]]
+            entries = list(slot)
+            slot.clear()
+            for due, item in entries:
+                self._place(due, item)
+
+    def __len__(self):
+        return self.size
+
+class ScheduledDispatcher:
+    """
+    Releases persisted scheduled sends on time.
+
+    Only sends due within ``horizon`` seconds are held in memory: a
+    background thread pages them in from an indexed (due, key) range and
+    extends the window every ``reload_interval`` seconds, so a million
+    pending sends do not have to be loaded, and a restart resumes from the
+    oldest unsent row instead of scanning the table. A timer wheel releases
+    the loaded keys in batches each tick. Overdue rows left behind (sends
+    scheduled by another process into a window already loaded here, or
+    failed releases) are picked up by a sweep every ``sweep_interval``.
+    """
+
+    def __init__(self, load, release, tick=1.0, horizon=300, reload_interval=30,
+                 sweep_interval=60, batch_size=1000):
+        """
+        :param load: Callable(start, end, cursor, limit) -> (rows, cursor) returning up to limit
+                     (key, due) rows with start <= due < end (start None for no lower bound),
+                     ordered by due and key and following cursor
+        :param release: Callable(keys) that hands due sends to the send pipeline
+        :param tick: Timer resolution in seconds
+        :param horizon: Seconds ahead of now that are held in memory
+        :param reload_interval: Seconds between extending the loaded window
+        :param sweep_interval: Seconds between sweeps for overdue rows
+        :param batch_size: Rows per load page and keys per release call
+        """
+        self.load = load
+        self.release = release
+        self.tick = tick
+        self.horizon = horizon
+        self.reload_interval = reload_interval
+        self.sweep_interval = sweep_interval
+        self.batch_size = batch_size
+        self.wheel = TimerWheel(tick)
+        self.loaded_until = None
+        self._keys = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {'loaded': 0, 'released': 0, 'swept': 0, 'max_lag': 0.0}
+
+    def start(self):
+        if self._thread:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='scheduled-dispatcher', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def schedule(self, key, due):
+        """Register a send persisted by this process; later ones are loaded with their window"""
+        with self._lock:
+            if self.loaded_until is not None and due < self.loaded_until and key not in self._keys:
+                self._keys.add(key)
+                self.wheel.add(due, (key, due))
+
+    def pending(self):
+        with self._lock:
+            return len(self.wheel)
+
+    def _load_window(self, now):
+        start, end = self.loaded_until, now + self.horizon
+        cursor = None
+        while True:
+            rows, cursor = self.load(start, end, cursor, self.batch_size)
+            with self._lock:
+                for key, due in rows:
+                    if key not in self._keys:
+                        self._keys.add(key)
+                        self.wheel.add(due, (key, due))
+                        self.stats['loaded'] += 1
+            if len(rows) < self.batch_size:
+                break
+        with self._lock:
+            self.loaded_until = end
+
+    def _sweep(self, now):
+        # Rows still unsent a few ticks after they fell due were missed by this process
+        cursor = None
+        while True:
+            rows, cursor = self.load(None, now - 2 * self.tick, cursor, self.batch_size)
+            keys = [key for key, _ in rows if key not in self._keys]
+            if keys:
+                self.stats['swept'] += len(keys)
+                self.release(keys)
+            if len(rows) < self.batch_size:
+                break
+
+    def _release_due(self, now):
+        with self._lock:
+            due = self.wheel.advance(now)
+            for key, _ in due:
+                self._keys.discard(key)
+        if not due:
+            return
+        self.stats['max_lag'] = max(self.stats['max_lag'], now - due[0][1])
+        for start in range(0, len(due), self.batch_size):
+            keys = [key for key, _ in due[start:start + self.batch_size]]
+            try:
+                self.release(keys)
+                self.stats['released'] += len(keys)
+            except Exception as e:
+                # The rows stay unsent and are picked up by the next sweep
+                logger.error(f"Error releasing {len(keys)} scheduled sends: {str(e)}")
+
+    def _run(self):
+        next_load = next_sweep = 0.0
+        while not self._stop.is_set():
+            now = time.time()
+            try:
+                if now >= next_load:
+                    self._load_window(now)
+                    next_load = now + self.reload_interval
+                self._release_due(time.time())
+                if now >= next_sweep:
+                    self._sweep(now)
+                    next_sweep = now + self.sweep_interval
+            except Exception as e:
+                logger.error(f"Scheduled dispatcher error: {str(e)}")
+                next_load = now + self.tick
+            self._stop.wait(self.tick - (time.time() - self.wheel.origin) % self.tick)
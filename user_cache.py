@@ -0,0 +1,60 @@
+import collections
+import threading
+import time
+
+class UserCache:
+    """
+    Per-process cache of the users behind authenticated requests.
+
+    Flask-Login resolves the session's user id on every request; this keeps
+    the loaded identity for ``ttl`` seconds so hot routes do not query the
+    database each time. Writes to a user's credits or settings call
+    invalidate(), which takes effect at once in this process and within
+    ``ttl`` in the others. Balances used for billing must still be read
+    fresh, the cached credits are for display only.
+    """
+
+    def __init__(self, load, ttl=10, max_size=10000):
+        """
+        :param load: Callable(user_id) returning the user's identity, or None if there is none
+        :param ttl: Seconds a loaded user is reused
+        :param max_size: Users kept, least recently used first out
+        """
+        self.load = load
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()  # user_id -> (value, expires_at)
+        self._lock = threading.Lock()
+        self._generation = 0  # Bumped by invalidate() so a load racing with it is not kept
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def get(self, user_id):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(user_id)
+                self.stats['hits'] += 1
+                return entry[0]
+            generation = self._generation
+
+        self.stats['misses'] += 1
+        value = self.load(user_id)
+        if value is not None:
+            with self._lock:
+                if generation != self._generation:
+                    return value
+                self._entries[user_id] = (value, now + self.ttl)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, user_id=None):
+        """Drop one user, or everyone when user_id is None"""
+        with self._lock:
+            self._generation += 1
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
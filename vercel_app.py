@@ -1,12 +1,17 @@
 from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from markupsafe import Markup
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 import os
+import base64
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 import logging
 import json
 import sys
+import threading
+import time
+import uuid
 
 # Configure logging first thing to capture any startup errors
 logging.basicConfig(
@@ -16,95 +21,112 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Log important environment information
-logger.info(f"Python version: {sys.version}")
-logger.info(f"Starting Vercel serverless function")
-
 # Load environment variables
 load_dotenv()
-logger.info("Environment variables loaded")
 
+# Only lightweight local modules are imported here. supabase, smpplib and
+# requests (via routing) are imported by the accessors below on first use,
+# so a cold start does not pay for clients the request never touches.
+# Run benchmark_startup.py to see the import cost per module.
 try:
-    from supabase import create_client, Client
-    import requests
-    import smpplib.gsm
-    import smpplib.client
-    import smpplib.consts
-    logger.info("All libraries imported successfully")
+    from phone_numbers import normalize_number
+    from rates import RateTable, RateCard
+    from idempotency import IdempotencyStore, IdempotencyConflict, digest
+    from user_cache import UserCache
 except Exception as e:
     logger.error(f"Error importing libraries: {str(e)}")
     raise
 
-# Log important environment variables (without sensitive values)
-logger.info(f"SUPABASE_URL set: {'SUPABASE_URL' in os.environ}")
-logger.info(f"SMPP_HOST set: {'SMPP_HOST' in os.environ}")
-logger.info(f"SMS_GATEWAY_TYPE: {os.getenv('SMS_GATEWAY_TYPE', 'not set')}")
-logger.info(f"SMS_SENDER_ID: {os.getenv('SMS_SENDER_ID', 'not set')}")
+# Supabase client, created on first use
+_supabase = None
+_supabase_lock = threading.Lock()
 
-# Initialize Supabase client
-try:
-    supabase_url = os.getenv('SUPABASE_URL')
-    supabase_key = os.getenv('SUPABASE_KEY')
-    logger.info(f"Initializing Supabase client with URL: {supabase_url[:20]}...")
-    
-    if not supabase_url or not supabase_key:
-        logger.error("Supabase URL or key is missing")
-        raise ValueError("Supabase URL or key is missing")
-        
-    supabase: Client = create_client(supabase_url, supabase_key)
-    logger.info("Supabase client initialized successfully")
-except Exception as e:
-    logger.error(f"Error initializing Supabase client: {str(e)}")
-    # Don't raise here, allow app to initialize even with Supabase error
+def get_supabase():
+    """Shared Supabase client, imported and created on first use"""
+    global _supabase
+    if _supabase is None:
+        with _supabase_lock:
+            if _supabase is None:
+                from supabase import create_client
+                supabase_url = os.getenv('SUPABASE_URL')
+                supabase_key = os.getenv('SUPABASE_KEY')
+                if not supabase_url or not supabase_key:
+                    raise ValueError("Supabase URL or key is missing")
+                _supabase = create_client(supabase_url, supabase_key)
+                logger.info("Supabase client initialized")
+    return _supabase
 
 # Initialize Flask
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your-secret-key')
-logger.info("Flask app initialized")
 
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
-# Add a global variable to track system balance
-system_balance = 1000.0  # Initial balance in euros
+BALANCE_CACHE_TTL = float(os.getenv('BALANCE_CACHE_TTL', 2))  # Seconds a balance read is reused
 DEFAULT_SMS_RATE = float(os.getenv('DEFAULT_SMS_RATE', 0.05))  # Default cost per SMS in euros
+DEFAULT_COUNTRY_CODE = os.getenv('DEFAULT_COUNTRY_CODE', '+52')  # Prepended to 10-digit numbers
+RATE_TABLE_TTL = float(os.getenv('RATE_TABLE_TTL', 60))  # Seconds before the rate table is reloaded
+MESSAGES_PAGE_SIZE = int(os.getenv('MESSAGES_PAGE_SIZE', 50))  # Messages per history page
+MESSAGES_MAX_PAGE_SIZE = 200
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', 10))  # Seconds a logged-in user is reused between requests
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', 86400))  # Seconds an idempotency key is remembered
 
-# Initialize SMPP client
-def get_smpp_client():
-    """Get a configured SMPP client"""
-    try:
+# Long-lived SMPP session pool, bound on first use and reused across requests
+smpp_client = None
+
+def create_smpp_client():
+    """Create the shared SMPP client without waiting for it to bind"""
+    global smpp_client
+    if smpp_client is None:
+        from smpp_client import SMPPClient
         # Log the SMPP connection details
         logger.info(f"Connecting to SMPP server: {os.getenv('SMPP_HOST')}:{os.getenv('SMPP_PORT')}")
-        
-        # Create client instance
-        client = smpplib.client.Client(
-            os.getenv('SMPP_HOST', '45.61.157.94'), 
-            int(os.getenv('SMPP_PORT', '20002'))
+        smpp_client = SMPPClient(
+            host=os.getenv('SMPP_HOST', '45.61.157.94'),
+            port=int(os.getenv('SMPP_PORT', '20002')),
+            system_id=os.getenv('SMPP_USERNAME', 'XQB250213A'),
+            password=os.getenv('SMPP_PASSWORD', 'ABD55DBB'),
+            pool_size=int(os.getenv('SMPP_POOL_SIZE', 1)),
+            window=int(os.getenv('SMPP_WINDOW', 10)),
+            enquire_link_interval=int(os.getenv('SMPP_ENQUIRE_LINK_INTERVAL', 30))
         )
-        
-        # Set timeouts
-        client.set_message_sent_handler(
-            lambda pdu: logger.info(f"SMS message sent with PDU sequence {pdu.sequence}")
-        )
-        
-        # Connect to the server
-        logger.info("Attempting SMPP connection...")
-        client.connect()
-        logger.info("SMPP connection successful, binding...")
-        
-        # Bind to the server
-        client.bind_transceiver(
-            system_id=os.getenv('SMPP_USERNAME', 'XQB250213A'), 
-            password=os.getenv('SMPP_PASSWORD', 'ABD55DBB')
-        )
-        logger.info("SMPP bind successful")
-        
+    return smpp_client
+
+def get_smpp_client():
+    """Get the shared, bound SMPP client (None if it cannot bind)"""
+    try:
+        client = create_smpp_client()
+        if not client.connected and not client.connect():
+            return None
         return client
     except Exception as e:
         logger.error(f"SMPP connection error: {str(e)}")
         return None
 
+# Gateway router: SMPP first when enabled, the JSON /send API as failover
+sms_router = None
+
+def get_sms_router():
+    global sms_router
+    if sms_router is None:
+        from routing import Router, Route, CircuitBreaker, SMPPBackend, SendAPIBackend
+        sender = os.getenv('SMS_SENDER_ID', 'SMSHub')
+        breaker_settings = (int(os.getenv('ROUTE_FAILURE_THRESHOLD', 5)), float(os.getenv('ROUTE_RESET_TIMEOUT', 30)))
+        routes = []
+        if os.getenv('SMS_GATEWAY_TYPE', 'smpp').lower() == 'smpp':
+            routes.append(Route('smpp', SMPPBackend(create_smpp_client(), sender),
+                                {'': float(os.getenv('SMPP_ROUTE_COST', 0))}, CircuitBreaker(*breaker_settings)))
+        routes.append(Route('http', SendAPIBackend(os.getenv('SMS_API_URL', 'http://45.61.157.94:20003/send'),
+                                                   os.getenv('SMPP_USERNAME', 'XQB250213A'),
+                                                   os.getenv('SMPP_PASSWORD', 'ABD55DBB'),
+                                                   sender),
+                            {'': float(os.getenv('HTTP_ROUTE_COST', 0))}, CircuitBreaker(*breaker_settings)))
+        sms_router = Router(routes, latency_weight=float(os.getenv('ROUTE_LATENCY_WEIGHT', 0.01)),
+                            preferred=routes[0].name)
+    return sms_router
+
 # User class definition - uses Supabase instead of SQLAlchemy
 class User(UserMixin):
     def __init__(self, id, username, email, password, credits, is_admin, sms_rate, role):
@@ -119,14 +141,16 @@ class User(UserMixin):
 
     @staticmethod
     def get(user_id):
-        response = supabase.table('users').select('*').eq('id', user_id).execute()
+        """Load a user for the session, without the password hash"""
+        response = get_supabase().table('users').select(
+            'id, username, email, credits, is_admin, sms_rate, role').eq('id', user_id).execute()
         if response.data and len(response.data) > 0:
             user_data = response.data[0]
             return User(
                 id=user_data['id'],
                 username=user_data['username'],
                 email=user_data['email'],
-                password=user_data['password'],
+                password=None,
                 credits=user_data['credits'],
                 is_admin=user_data['is_admin'],
                 sms_rate=user_data['sms_rate'],
@@ -134,6 +158,21 @@ class User(UserMixin):
             )
         return None
 
+    @staticmethod
+    def get_credits(user_id):
+        """Current credits of a user, bypassing the login cache"""
+        response = get_supabase().table('users').select('credits').eq('id', user_id).execute()
+        return float(response.data[0]['credits'] or 0.0) if response.data else 0.0
+
+    @staticmethod
+    def debit_credits(user_id, amount):
+        """
+        Take amount credits in one conditional update, a negative amount gives them back
+        :return: New balance, or None if the user has insufficient credits
+        """
+        response = get_supabase().rpc('debit_user_credits', {'p_user_id': user_id, 'p_amount': amount}).execute()
+        return None if response.data is None else float(response.data)
+
     def check_password(self, password):
         return check_password_hash(self.password, password)
 
@@ -154,175 +193,165 @@ class Message:
             'created_at': datetime.utcnow().isoformat(),
             'cost': cost
         }
-        response = supabase.table('messages').insert(data).execute()
+        response = get_supabase().table('messages').insert(data).execute()
         return response.data[0] if response.data else None
 
     @staticmethod
-    def get_user_messages(user_id):
-        response = supabase.table('messages').select('*').eq('user_id', user_id).order('created_at', desc=True).execute()
-        return response.data if response.data else []
+    def get_user_messages(user_id, cursor=None, limit=MESSAGES_PAGE_SIZE, status=None, date_from=None, date_to=None):
+        """
+        One page of a user's messages, newest first
+        :param cursor: Value returned as next_cursor by the previous page
+        :return: (messages, next_cursor)
+        """
+        query = get_supabase().table('messages').select('*').eq('user_id', user_id)
+        if status:
+            query = query.in_('status', [s.strip() for s in status.split(',') if s.strip()])
+        if date_from:
+            query = query.gte('created_at', date_from)
+        if date_to:
+            query = query.lt('created_at', (datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1)).isoformat())
+        if cursor:
+            created_at, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+            int(message_id)
+            query = query.or_(f'created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt.{message_id})')
+        response = query.order('created_at', desc=True).order('id', desc=True).limit(limit + 1).execute()
+        messages = response.data if response.data else []
+        if len(messages) > limit:
+            messages = messages[:limit]
+            last = messages[-1]
+            raw = f"{last['created_at']}|{last['id']}"
+            return messages, base64.urlsafe_b64encode(raw.encode()).decode()
+        return messages, None
+
+    @staticmethod
+    def get_user_totals(user_id):
+        """Message count, successful/failed counts and cost of a user, aggregated in the database"""
+        response = get_supabase().rpc('user_message_totals', {'p_user_id': user_id}).execute()
+        row = response.data[0] if response.data else {}
+        return {
+            'total_messages': row.get('total_messages') or 0,
+            'successful_messages': row.get('successful_messages') or 0,
+            'failed_messages': row.get('failed_messages') or 0,
+            'total_cost': float(row.get('total_cost') or 0.0),
+        }
 
     @staticmethod
     def get_recent_messages(limit=10):
-        response = supabase.table('messages').select('*').order('created_at', desc=True).limit(limit).execute()
+        response = get_supabase().table('messages').select('*').order('created_at', desc=True).limit(limit).execute()
         return response.data if response.data else []
 
+# Users behind authenticated requests, reused for USER_CACHE_TTL seconds per instance
+user_cache = UserCache(User.get, ttl=USER_CACHE_TTL)
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.get(user_id)
+    return user_cache.get(int(user_id))
+
+# Destination rates, loaded from Supabase into prefix tries
+_rate_tables = {'table': RateTable(), 'overrides': {}, 'loaded_at': None}
+
+def get_rate_card(user):
+    """Rates of a user, reloading the destination_rates table every RATE_TABLE_TTL seconds"""
+    if _rate_tables['loaded_at'] is None or time.time() - _rate_tables['loaded_at'] >= RATE_TABLE_TTL:
+        table = RateTable()
+        overrides = {}
+        try:
+            response = get_supabase().table('destination_rates').select('prefix, rate, user_id').execute()
+            for row in response.data or []:
+                if row['user_id'] is None:
+                    table.add(row['prefix'], row['rate'])
+                else:
+                    overrides.setdefault(row['user_id'], RateTable()).add(row['prefix'], row['rate'])
+            _rate_tables.update(table=table, overrides=overrides)
+        except Exception as e:
+            logger.error(f"Error loading destination rates: {str(e)}")
+        _rate_tables['loaded_at'] = time.time()
+    return RateCard(_rate_tables['table'], _rate_tables['overrides'].get(user.id), user.get_sms_rate())
 
 # Helper functions for system balance
+_balance_cache = {'value': None, 'read_at': 0.0}
+
 def get_system_balance():
-    """Get the system balance from Supabase"""
-    response = supabase.table('system_settings').select('value').eq('key', 'system_balance').execute()
-    if response.data and len(response.data) > 0:
-        return float(response.data[0]['value'])
-    return 1000.0  # Default value
-
-def update_system_balance(amount):
-    """Update the system balance in Supabase"""
-    current_balance = get_system_balance()
-    new_balance = current_balance + amount
-    
-    # Check if record exists
-    response = supabase.table('system_settings').select('*').eq('key', 'system_balance').execute()
-    
-    if response.data and len(response.data) > 0:
-        # Update existing record
-        supabase.table('system_settings').update({'value': str(new_balance)}).eq('key', 'system_balance').execute()
-    else:
-        # Create new record
-        supabase.table('system_settings').insert({'key': 'system_balance', 'value': str(new_balance)}).execute()
-    
-    return new_balance
+    """Get the system balance from Supabase (reused for BALANCE_CACHE_TTL seconds)"""
+    now = time.time()
+    if _balance_cache['value'] is not None and now - _balance_cache['read_at'] < BALANCE_CACHE_TTL:
+        return _balance_cache['value']
+    response = get_supabase().table('system_settings').select('value').eq('key', 'system_balance').execute()
+    balance = float(response.data[0]['value']) if response.data else 1000.0  # Default value
+    _balance_cache.update(value=balance, read_at=now)
+    return balance
 
-# SMS sending function
-def send_sms(numbers, content):
-    """Send SMS using SMPP"""
+def update_system_balance(amount, reason='adjustment', reference=None):
+    """
+    Atomically add amount euros to the system balance in Supabase.
+    increment_system_balance() does the increment and the ledger entry in one statement.
+    :return: New balance
+    """
+    response = get_supabase().rpc('increment_system_balance', {
+        'p_amount': amount,
+        'p_reason': reason,
+        'p_reference': reference
+    }).execute()
+    balance = float(response.data)
+    _balance_cache.update(value=balance, read_at=time.time())
+    return balance
+
+def claim_idempotency_key(key, fingerprint, expires_at):
+    """:return: None if claimed, else the stored (fingerprint, response)"""
+    response = get_supabase().rpc('claim_idempotency_key', {
+        'p_key': key,
+        'p_fingerprint': fingerprint,
+        'p_expires_at': expires_at
+    }).execute()
+    if not response.data:
+        return None
+    return response.data[0]['fingerprint'], response.data[0]['response']
+
+def release_idempotency_key(key):
+    get_supabase().table('idempotency_keys').delete().eq('key', key).is_('response', 'null').execute()
+
+idempotency_store = IdempotencyStore(claim_idempotency_key, release_idempotency_key, ttl=IDEMPOTENCY_TTL)
+app.jinja_env.globals['new_idempotency_key'] = lambda: uuid.uuid4().hex
+
+def complete_idempotent(idempotency, message, category):
+    """Store the flash message of a finished send under its idempotency key"""
+    if idempotency is None:
+        return
+    response = {'flash': [[str(Markup.escape(message)), category]]}
     try:
-        gateway_type = os.getenv('SMS_GATEWAY_TYPE', 'smpp')
-        logger.info(f"Using SMS gateway type: {gateway_type}")
-        
-        if gateway_type.lower() == 'smpp':
-            # Log attempt to send SMS
-            logger.info(f"Attempting to send SMS to {numbers} via SMPP")
-            
-            # Get SMPP client
-            client = get_smpp_client()
-            if not client:
-                logger.error("Failed to connect to SMPP server")
-                # Try HTTP fallback
-                logger.info("Trying HTTP fallback for SMS delivery")
-                return send_sms_http(numbers, content)
-            
-            # Format the destination number
-            if numbers.startswith('+'):
-                numbers = numbers[1:]  # Remove + if present
-            
-            # Ensure number is in international format
-            if not numbers.startswith('52') and len(numbers) < 10:
-                numbers = '52' + numbers
-                
-            logger.info(f"Formatted destination number: {numbers}")
-            
-            # Format the SMS content for GSM encoding
-            try:
-                parts, encoding_flag, msg_type_flag = smpplib.gsm.make_parts(content)
-                logger.info(f"Message split into {len(parts)} parts")
-            except Exception as e:
-                logger.error(f"Error encoding message: {str(e)}")
-                # If encoding fails, send as unicode
-                parts = [content.encode('utf-16-be')]
-                encoding_flag = smpplib.consts.SMPP_ENCODING_ISO10646
-                msg_type_flag = 0
-                logger.info("Using unicode encoding for message")
-            
-            # Generate a unique message ID
-            message_id = f'msg_{datetime.now().timestamp()}'
-            
-            # Send the message
-            success = True
-            for part in parts:
-                try:
-                    pdu = client.send_message(
-                        source_addr_ton=smpplib.consts.SMPP_TON_ALNUM,
-                        source_addr=os.getenv('SMS_SENDER_ID', 'SMSHub'),
-                        dest_addr_ton=smpplib.consts.SMPP_TON_INTL,
-                        destination_addr=numbers,
-                        short_message=part,
-                        data_coding=encoding_flag,
-                        esm_class=msg_type_flag,
-                        registered_delivery=True,
-                    )
-                    logger.info(f"SMS part sent with PDU ID: {pdu.sequence}")
-                except Exception as e:
-                    logger.error(f"Error sending message part: {str(e)}")
-                    success = False
-            
-            # Unbind and disconnect
-            try:
-                client.unbind()
-                client.disconnect()
-                logger.info("SMPP connection closed")
-            except Exception as e:
-                logger.error(f"Error closing SMPP connection: {str(e)}")
-            
-            if success:
-                return True, {'message_id': message_id, 'status': 'sent'}
-            else:
-                # Try HTTP fallback
-                logger.info("SMPP delivery failed, trying HTTP fallback")
-                return send_sms_http(numbers, content)
-        else:
-            # Use HTTP API directly
-            return send_sms_http(numbers, content)
-            
+        get_supabase().table('idempotency_keys').update({'response': response}).eq('key', idempotency[0]).execute()
+        idempotency_store.complete(idempotency[0], idempotency[1], response)
     except Exception as e:
-        logger.error(f"SMS sending error: {str(e)}")
-        # Try HTTP fallback as last resort
-        try:
-            return send_sms_http(numbers, content)
-        except Exception as e2:
-            logger.error(f"HTTP fallback also failed: {str(e2)}")
-            return False, {'error': f"Both SMPP and HTTP delivery failed: {str(e2)}"}
+        logger.error(f"Error storing idempotent response: {str(e)}")
 
-def send_sms_http(numbers, content):
-    """Send SMS using HTTP API as fallback"""
+def release_idempotent(idempotency):
+    """Drop the claim of a request that did not send, so a retry with the key can"""
+    if idempotency is not None:
+        idempotency_store.release(idempotency[0])
+
+def refund_credits(user_id, amount):
+    """Give back the credits taken for a send that failed"""
     try:
-        logger.info(f"Sending SMS via HTTP API to {numbers}")
-        api_url = os.getenv('SMS_API_URL', 'http://45.61.157.94:20003/send')
-        
-        # Format the number if needed
+        User.debit_credits(user_id, -amount)
+        user_cache.invalidate(user_id)
+    except Exception as e:
+        logger.error(f"Error refunding {amount} credits to user {user_id}: {str(e)}")
+
+# SMS sending function
+def send_sms(numbers, content):
+    """Send SMS over the best healthy route, failing over between SMPP and HTTP"""
+    try:
+        # Format the destination number
         if numbers.startswith('+'):
-            numbers = numbers[1:]
-            
-        payload = {
-            'username': os.getenv('SMPP_USERNAME', 'XQB250213A'),
-            'password': os.getenv('SMPP_PASSWORD', 'ABD55DBB'),
-            'to': numbers,
-            'text': content,
-            'from': os.getenv('SMS_SENDER_ID', 'SMSHub')
-        }
-        
-        logger.info(f"Sending HTTP request to {api_url}")
-        response = requests.post(api_url, json=payload)
-        success = response.status_code == 200
+            numbers = numbers[1:]  # Remove + if present
         
+        success, result, route = get_sms_router().send(numbers, content)
         if success:
-            logger.info(f"HTTP SMS delivery successful: {response.status_code}")
-        else:
-            logger.error(f"HTTP SMS delivery failed: {response.status_code} - {response.text}")
-        
-        try:
-            result = response.json()
-            logger.info(f"API response: {result}")
-        except:
-            result = {'status': 'sent' if success else 'failed'}
-            
-        return success, result
-        
+            logger.info(f"SMS to {numbers} sent via {route}")
+            return True, {'message_id': result, 'status': 'sent', 'route': route}
+        return False, {'error': result}
     except Exception as e:
-        logger.error(f"HTTP SMS sending error: {str(e)}")
+        logger.error(f"SMS sending error: {str(e)}")
         return False, {'error': str(e)}
 
 # Routes
@@ -353,7 +382,7 @@ def login():
             logger.info(f"Login attempt for user: {username}")
             
             try:
-                response = supabase.table('users').select('*').eq('username', username).execute()
+                response = get_supabase().table('users').select('*').eq('username', username).execute()
                 logger.info(f"Supabase query for user complete, got {len(response.data) if response.data else 0} results")
                 
                 if response.data and len(response.data) > 0:
@@ -396,22 +425,39 @@ def dashboard():
     if current_user.is_admin:
         return redirect(url_for('admin_dashboard'))
     
-    # Get user's messages
-    messages = Message.get_user_messages(current_user.id)
+    # Get the first page of the user's messages
+    messages, next_cursor = Message.get_user_messages(current_user.id)
     
-    # Calculate statistics (simplified for Vercel deployment)
-    total_messages = len(messages)
-    successful_messages = len([m for m in messages if m['status'] == 'success'])
-    failed_messages = len([m for m in messages if m['status'] == 'failed'])
-    total_cost = sum(message['cost'] for message in messages)
+    # Statistics are aggregated by the database instead of over the full history
+    totals = Message.get_user_totals(current_user.id)
     
     return render_template('dashboard.html', 
                          messages=messages,
+                         next_cursor=next_cursor,
                          user=current_user,
-                         total_messages=total_messages,
-                         successful_messages=successful_messages,
-                         failed_messages=failed_messages,
-                         total_cost=total_cost)
+                         **totals)
+
+@app.route('/api/messages')
+@login_required
+def api_messages():
+    """Keyset paginated message history for infinite scroll"""
+    user_id = current_user.id
+    if current_user.is_admin and request.args.get('user_id'):
+        user_id = request.args.get('user_id', type=int)
+    limit = min(request.args.get('limit', MESSAGES_PAGE_SIZE, type=int), MESSAGES_MAX_PAGE_SIZE)
+    
+    try:
+        messages, next_cursor = Message.get_user_messages(
+            user_id,
+            cursor=request.args.get('cursor'),
+            limit=max(1, limit),
+            status=request.args.get('status'),
+            date_from=request.args.get('from'),
+            date_to=request.args.get('to'))
+    except ValueError:
+        return jsonify({'error': 'Invalid cursor or date'}), 400
+    
+    return jsonify({'messages': messages, 'next_cursor': next_cursor})
 
 @app.route('/send_sms', methods=['POST'])
 @login_required
@@ -420,7 +466,7 @@ def send_sms_route():
         if current_user.is_admin:
             return redirect(url_for('admin_dashboard'))
         
-        country_code = request.form.get('country_code', '+52').strip()
+        country_code = request.form.get('country_code', DEFAULT_COUNTRY_CODE).strip()
         phone_number = request.form.get('phone_number', '').strip()
         content = request.form.get('content', '').strip()
         
@@ -431,22 +477,50 @@ def send_sms_route():
             flash('Please provide both phone number and message content', 'error')
             return redirect(url_for('send_sms_page'))
         
-        # Format the phone number
-        if country_code == '+52':
-            formatted_number = '52' + phone_number
-        else:
-            formatted_number = country_code.replace('+', '') + phone_number
+        # Format the phone number - digits only, with the country code
+        formatted_number, error = normalize_number(phone_number, country_code)
+        if error:
+            logger.warning(f"Invalid phone number {phone_number}: {error}")
+            flash(f'Invalid phone number ({error})', 'error')
+            return redirect(url_for('send_sms_page'))
             
         logger.info(f"Formatted number: {formatted_number}")
         
-        # Calculate cost
-        cost = current_user.sms_rate
-        logger.info(f"SMS cost: {cost}, user credits: {current_user.credits}")
+        # Calculate cost for the destination
+        cost = get_rate_card(current_user).rate(formatted_number)
+        logger.info(f"SMS cost: {cost}")
+        
+        # A retried request gets the original outcome instead of a second send
+        idempotency = None
+        client_key = request.headers.get('Idempotency-Key') or request.form.get('idempotency_key')
+        if client_key:
+            fingerprint = digest(formatted_number, content)
+            try:
+                key, replay = idempotency_store.begin(f'send_sms:{current_user.id}', client_key, fingerprint)
+            except IdempotencyConflict as e:
+                flash(str(e), 'error')
+                return redirect(url_for('send_sms_page'))
+            if replay is not None:
+                for message, category in replay['flash']:
+                    flash(Markup(message), category)
+                return redirect(url_for('send_sms_page'))
+            idempotency = (key, fingerprint)
         
-        if current_user.credits < cost:
-            logger.warning(f"User {current_user.username} has insufficient credits: {current_user.credits} < {cost}")
+        # The credits are taken before sending with a conditional update, so
+        # concurrent sends cannot overdraw the account, and returned on failure
+        try:
+            credits = User.debit_credits(current_user.id, cost)
+        except Exception as e:
+            logger.error(f"Error debiting credits: {str(e)}")
+            release_idempotent(idempotency)
+            flash(f'Error sending SMS: {str(e)}', 'error')
+            return redirect(url_for('send_sms_page'))
+        if credits is None:
+            logger.warning(f"User {current_user.username} has insufficient credits for {cost}")
+            release_idempotent(idempotency)
             flash('Insufficient credits', 'error')
             return redirect(url_for('send_sms_page'))
+        user_cache.invalidate(current_user.id)
         
         # Send SMS
         logger.info(f"Attempting to send SMS via gateway")
@@ -455,43 +529,47 @@ def send_sms_route():
             logger.info(f"SMS send result: success={success}, result={result}")
         except Exception as e:
             logger.error(f"Exception during SMS sending: {str(e)}")
+            refund_credits(current_user.id, cost)
+            release_idempotent(idempotency)
             flash(f'Error sending SMS: {str(e)}', 'error')
             return redirect(url_for('send_sms_page'))
         
-        # Create message record
-        try:
-            message = Message.create(
-                user_id=current_user.id,
-                numbers=formatted_number,
-                content=content,
-                status='success' if success else 'failed',
-                message_id=result.get('message_id'),
-                cost=cost if success else 0
-            )
-            logger.info(f"Message record created: {message}")
-        except Exception as e:
-            logger.error(f"Error creating message record: {str(e)}")
-            flash('SMS was sent but there was an error recording it', 'warning')
-            return redirect(url_for('send_sms_page'))
+        if not success:
+            refund_credits(current_user.id, cost)
         
-        # Update user credits only if successful
+        # The SMS went out or definitely failed, so a retry replays this outcome even if recording it fails
         if success:
+            outcome = ('SMS sent successfully', 'success')
+        else:
+            outcome = (f'Failed to send SMS: {result.get("error", "Unknown error")}', 'error')
+        try:
+            # Create message record
             try:
-                # Update user credits in Supabase
-                logger.info(f"Updating user credits: {current_user.credits} - {cost}")
-                supabase.table('users').update({
-                    'credits': current_user.credits - cost
-                }).eq('id', current_user.id).execute()
-                
-                # Update system balance
-                update_system_balance(cost)
-                
-                flash('SMS sent successfully', 'success')
+                message = Message.create(
+                    user_id=current_user.id,
+                    numbers=formatted_number,
+                    content=content,
+                    status='sent' if success else 'failed',
+                    message_id=result.get('message_id'),
+                    cost=cost if success else 0
+                )
+                logger.info(f"Message record created: {message}")
             except Exception as e:
-                logger.error(f"Error updating credits: {str(e)}")
-                flash('SMS sent, but there was an error updating your credits', 'warning')
-        else:
-            flash(f'Failed to send SMS: {result.get("error", "Unknown error")}', 'error')
+                logger.error(f"Error creating message record: {str(e)}")
+                flash('SMS was sent but there was an error recording it', 'warning')
+                return redirect(url_for('send_sms_page'))
+            
+            # The user was charged before sending, the system balance only for sent messages
+            if success:
+                try:
+                    update_system_balance(cost, reason='sms', reference=f'user:{current_user.id}')
+                except Exception as e:
+                    logger.error(f"Error updating system balance: {str(e)}")
+                    flash('SMS sent, but there was an error updating the system balance', 'warning')
+                    return redirect(url_for('send_sms_page'))
+            flash(*outcome)
+        finally:
+            complete_idempotent(idempotency, *outcome)
             
         return redirect(url_for('send_sms_page'))
         
@@ -513,45 +591,62 @@ def logout():
     logout_user()
     return redirect(url_for('login'))
 
-# Improved health check with diagnostics
-@app.route('/api/health')
-def health_check():
+# Health probe results are cached: concurrent and repeated calls reuse the
+# last result instead of each querying Supabase
+HEALTH_CACHE_TTL = float(os.getenv('HEALTH_CACHE_TTL', 30))
+_health = {'result': None, 'checked_at': 0.0}
+_health_lock = threading.Lock()
+
+def probe_health():
+    """Check Supabase and report the SMPP pool state, without opening new SMPP sessions"""
+    supabase_ok = False
     try:
-        # Check if Supabase is working
-        supabase_ok = False
-        try:
-            # Try a simple query to verify Supabase connection
-            test_response = supabase.table('system_settings').select('*').limit(1).execute()
-            supabase_ok = True
-        except Exception as e:
-            logger.error(f"Supabase health check failed: {str(e)}")
-        
-        # Check SMPP connection
-        smpp_ok = False
-        try:
-            client = get_smpp_client()
-            if client:
-                client.unbind()
-                client.disconnect()
-                smpp_ok = True
-        except Exception as e:
-            logger.error(f"SMPP health check failed: {str(e)}")
-            
-        # Check environment
-        env_vars = {
+        get_supabase().table('system_settings').select('*').limit(1).execute()
+        supabase_ok = True
+    except Exception as e:
+        logger.error(f"Supabase health check failed: {str(e)}")
+
+    # The pool is bound by the send path; a probe only reports on it
+    if smpp_client is None:
+        smpp_state = 'not started'
+    else:
+        smpp_state = 'ok' if smpp_client.pool.bound else 'not bound'
+
+    return {
+        'status': 'ok',
+        'timestamp': datetime.now().isoformat(),
+        'supabase_connection': 'ok' if supabase_ok else 'failed',
+        'smpp_connection': smpp_state,
+        'environment': {
             "FLASK_APP": os.getenv("FLASK_APP", "not set"),
             "SUPABASE_URL": "set" if os.getenv("SUPABASE_URL") else "not set",
             "SMPP_HOST": os.getenv("SMPP_HOST", "not set"),
             "SMS_GATEWAY_TYPE": os.getenv("SMS_GATEWAY_TYPE", "not set"),
         }
-            
-        return jsonify({
-            'status': 'ok',
-            'timestamp': datetime.now().isoformat(),
-            'supabase_connection': 'ok' if supabase_ok else 'failed',
-            'smpp_connection': 'ok' if smpp_ok else 'failed',
-            'environment': env_vars
-        })
+    }
+
+def cached_health():
+    """Last probe result, refreshed by at most one caller once it is HEALTH_CACHE_TTL old"""
+    if time.time() - _health['checked_at'] < HEALTH_CACHE_TTL:
+        return _health['result']
+    if not _health_lock.acquire(blocking=_health['result'] is None):
+        # Another request is probing, answer with the previous result
+        return _health['result']
+    try:
+        if time.time() - _health['checked_at'] >= HEALTH_CACHE_TTL:
+            _health['result'] = probe_health()
+            _health['checked_at'] = time.time()
+        return _health['result']
+    finally:
+        _health_lock.release()
+
+# Improved health check with diagnostics
+@app.route('/api/health')
+def health_check():
+    try:
+        result = dict(cached_health())
+        result['age'] = round(time.time() - _health['checked_at'], 1)
+        return jsonify(result)
     except Exception as e:
         logger.error(f"Health check failed: {str(e)}")
         return jsonify({